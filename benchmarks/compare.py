@@ -0,0 +1,46 @@
+# ------------------------------------------------------------------------------- #
+# Compares the results of two benchmark runs (JSON files from run_benchmarks.py)
+#
+# Usage:
+#   python benchmarks/compare.py benchmarks/results/<old>.json benchmarks/results/<new>.json
+# ------------------------------------------------------------------------------- #
+
+
+def compare(path_old, path_new):
+    """
+    Prints the wall time and peak RSS of each stage for two benchmark runs and the
+    ratio new / old
+
+    Args:
+        path_old: Path to the JSON results of the reference run
+        path_new: Path to the JSON results of the new run
+    """
+
+    import json
+
+    with open(path_old) as f:
+        old = json.load(f)
+    with open(path_new) as f:
+        new = json.load(f)
+
+    if old["config"] != new["config"]:
+        print("WARNING: The benchmark configurations are different\n")
+
+    print(f"{'stage':<20} {'wall old':>10} {'wall new':>10} {'ratio':>7} "
+          f"{'RSS old':>10} {'RSS new':>10} {'ratio':>7}")
+    for stage in old["stages"].keys():
+        if stage not in new["stages"].keys():
+            continue
+        o, n = old["stages"][stage], new["stages"][stage]
+        print(f"{stage:<20} {o['wall_s']:10.2f} {n['wall_s']:10.2f} "
+              f"{n['wall_s'] / o['wall_s']:7.2f} "
+              f"{o['peak_rss_mb']:10.1f} {n['peak_rss_mb']:10.1f} "
+              f"{n['peak_rss_mb'] / o['peak_rss_mb']:7.2f}")
+
+
+if __name__ == "__main__":
+    import sys
+    compare(sys.argv[1], sys.argv[2])
+
+
+# ------------------------------------------------------------------------------- #
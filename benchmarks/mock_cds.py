@@ -0,0 +1,179 @@
+# ------------------------------------------------------------------------------- #
+# Local mock of the CDS API (submit/poll protocol used by cdsapi), serving synthetic
+# ERA5-land like datasets, to test the downloads offline
+#
+# Usage:
+#   python benchmarks/mock_cds.py --port 8080 --delay 5 --fail-rate 0.1
+#
+#   import emme_roch as er
+#   er.downloadAsyncCDS([(2000, 1), (2000, 2)], "data_mock/", poll_interval=1,
+#                       url="http://localhost:8080/api/v2", key="1:mock")
+# ------------------------------------------------------------------------------- #
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# CDS variable names: short names of the synthetic variables
+VARIABLES = {"2m_dewpoint_temperature": "d2m", "2m_temperature": "t2m",
+             "forecast_albedo": "fal", "skin_reservoir_content": "src",
+             "surface_sensible_heat_flux": "sshf", "total_evaporation": "e",
+             "total_precipitation": "tp"}
+
+
+# ------------------------------------------------------------------------------- #
+def makeResult(request, resolution=0.1):
+    """
+    Creates the netcdf (bytes) for a request, on the grid of the requested area
+
+    Args:
+        request: CDS request (see emme_roch.downloadCDS.cdsRequest)
+        resolution: Grid cell size in degrees (default: 0.1)
+
+    Returns:
+        bytes of the netcdf
+    """
+
+    from tempfile import mkstemp
+    from calendar import monthrange
+    from pandas import DatetimeIndex, Timestamp
+    from synthetic import makeGrid, makeClimate
+
+    year, month = int(request["year"]), int(request["month"])
+    days = [int(d) for d in request["day"] if int(d) <= monthrange(year, month)[1]]
+    times = DatetimeIndex([Timestamp(year, month, d, int(t[:2])) for d in days
+                           for t in request["time"]])
+
+    north, west, south, east = request.get("area", [43, 18, 33, 36])
+    lats, lons = makeGrid(round((north - south) / resolution) + 1,
+                          round((east - west) / resolution) + 1,
+                          area=[north, west, south, east], resolution=resolution)
+    ds = makeClimate(times, lats, lons, variables=[VARIABLES[v] for v in request["variable"]],
+                     seed=year * 100 + month)
+
+    fd, path = mkstemp(suffix=".nc")
+    os.close(fd)
+    try:
+        ds.to_netcdf(path)
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+# ------------------------------------------------------------------------------- #
+def serve(port=8080, delay=5.0, fail_rate=0.0, seed=0, counts=None, server=None):
+    """
+    Runs the mock CDS API server: POST /api/v2/resources/<dataset> submits a request,
+    GET /api/v2/tasks/<id> returns its state (queued -> running -> completed after delay
+    seconds, or failed) and GET /download/<id> returns the dataset
+
+    Args:
+        port: Port to listen on (default: 8080)
+        delay: Seconds until a request is completed (default: 5)
+        fail_rate: Fraction of the requests which fail (default: 0)
+        seed: Random number generator seed
+        counts: Dictionary to count the requests in, per HTTP method (default: None)
+        server: List to append the server to, so it can be shut down from another thread
+                (default: None)
+    """
+
+    import json
+    import uuid
+    import random
+    import threading
+    from time import monotonic
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    rng = random.Random(seed)
+    tasks = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self, code, body, content_type="application/json"):
+            data = json.dumps(body).encode() if content_type == "application/json" else body
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def state(self, rid):
+            task = tasks[rid]
+            elapsed = monotonic() - task["submitted"]
+            if elapsed < delay / 2:
+                return {"request_id": rid, "state": "queued"}
+            if elapsed < delay:
+                return {"request_id": rid, "state": "running"}
+            if task["fail"]:
+                return {"request_id": rid, "state": "failed",
+                        "error": {"message": "Mock failure", "reason": "fail-rate"}}
+            if task["result"] is None:
+                task["result"] = makeResult(task["request"])
+            return {"request_id": rid, "state": "completed", "location": f"/download/{rid}",
+                    "content_length": len(task["result"]), "content_type": "application/x-netcdf"}
+
+        def count(self):
+            if counts is not None:
+                with lock:
+                    counts[self.command] = counts.get(self.command, 0) + 1
+
+        def do_POST(self):
+            self.count()
+            if "/resources/" not in self.path:
+                return self.reply(404, {"message": "Not found"})
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            rid = uuid.uuid4().hex
+            with lock:
+                tasks[rid] = {"request": request, "submitted": monotonic(),
+                              "fail": rng.random() < fail_rate, "result": None}
+            self.reply(202, {"request_id": rid, "state": "queued"})
+
+        def do_GET(self):
+            self.count()
+            if self.path.endswith("/status.json"):
+                return self.reply(200, {})
+            rid = self.path.rstrip("/").split("/")[-1]
+            if rid not in tasks:
+                return self.reply(404, {"message": f"Request {rid} not found"})
+            with lock:
+                state = self.state(rid)
+            if "/tasks/" in self.path:
+                return self.reply(200, state)
+            if self.path.startswith("/download/") and state["state"] == "completed":
+                return self.reply(200, tasks[rid]["result"], "application/x-netcdf")
+            self.reply(404, {"message": "Not found"})
+
+        def do_DELETE(self):
+            rid = self.path.rstrip("/").split("/")[-1]
+            with lock:
+                tasks.pop(rid, None)
+            self.reply(200, {})
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("localhost", port), Handler)
+    if server is not None:
+        server.append(httpd)
+    print(f"Mock CDS API on http://localhost:{port}/api/v2 (key: 1:mock)")
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Mock CDS API server")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--delay", type=float, default=5.0,
+                        help="Seconds until a request is completed")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="Fraction of the requests which fail")
+    args = parser.parse_args()
+
+    serve(port=args.port, delay=args.delay, fail_rate=args.fail_rate)
+
+
+# ------------------------------------------------------------------------------- #
@@ -0,0 +1,223 @@
+# ------------------------------------------------------------------------------- #
+# Benchmarks of the emme_roch pipeline stages on synthetic (offline) datasets
+#
+# Usage:
+#   python benchmarks/run_benchmarks.py --n-lat 101 --n-lon 181 --years 2000 2001
+#   python benchmarks/compare.py benchmarks/results/<old>.json benchmarks/results/<new>.json
+#
+# Each stage runs in a fresh process, so the peak RSS reported is the one of the stage.
+# ------------------------------------------------------------------------------- #
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+STAGES = ["add_hurs_wb", "hourly_to_daily", "combine_clim", "weekly_cdo",
+          "getNutsClimAll", "mergeEurostatClim", "TLCC"]
+# Stages which use the outputs of other stages
+DEPENDS = {"combine_clim": ["hourly_to_daily"],
+           "mergeEurostatClim": ["getNutsClimAll"],
+           "TLCC": ["mergeEurostatClim"]}
+
+
+# ------------------------------------------------------------------------------- #
+def setupData(path_work, config):
+    """
+    Creates the synthetic datasets used by the stages (not timed)
+
+    Args:
+        path_work: Working directory of the benchmarks
+        config: Benchmark configuration (dictionary)
+    """
+
+    import pickle
+    from synthetic import makeHourlyMonths, makeWeekly, makeNuts, makeEurostat
+
+    print("Creating synthetic datasets. . .\n")
+    makeHourlyMonths(os.path.join(path_work, "hourly"), years=config["years"],
+                     months=config["months"], n_lat=config["n_lat"], n_lon=config["n_lon"],
+                     variables=config["variables"])
+    makeWeekly(os.path.join(path_work, "weekly.nc"), years=config["years"],
+               n_lat=config["n_lat"], n_lon=config["n_lon"], variables=config["variables"])
+
+    nuts = makeNuts(n_lat=config["n_lat"], n_lon=config["n_lon"], n_regions=config["n_regions"])
+    nuts3 = nuts[nuts.LEVL_CODE == 3].reset_index(drop=True)
+    with open(os.path.join(path_work, "nuts3.pkl"), "wb") as f:
+        pickle.dump(nuts3, f)
+
+    df = makeEurostat(nuts3.NUTS_ID.values, years=config["years"])
+    df.to_pickle(os.path.join(path_work, "eurostat.pkl"))
+
+
+# ------------------------------------------------------------------------------- #
+def runStage(stage, path_work, config):
+    """
+    Runs a pipeline stage and returns its wall time and peak RSS. Called in a fresh process.
+
+    Args:
+        stage: Name of the stage (see STAGES)
+        path_work: Working directory of the benchmarks
+        config: Benchmark configuration (dictionary)
+
+    Returns:
+        dictionary with the wall time (s) and the peak RSS (MB) of the stage
+    """
+
+    import pickle
+    import shutil
+    import resource
+    from time import perf_counter
+    from pandas import read_pickle
+    import emme_roch as er
+
+    def path(x):
+        return os.path.join(path_work, x)
+
+    def rss_mb():
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes on Linux
+        return rss / 1e6 if sys.platform == "darwin" else rss / 1e3
+
+    # Remove the outputs of previous runs, as the functions skip the existing files
+    outputs = {"add_hurs_wb": "hourly_wb", "hourly_to_daily": "daily",
+               "weekly_cdo": "hourly_cdo"}
+    if stage in outputs.keys() and os.path.isdir(path(outputs[stage])):
+        shutil.rmtree(path(outputs[stage]))
+    if stage == "weekly_cdo":
+        shutil.copytree(path("hourly"), path("hourly_cdo"))
+
+    with open(path("nuts3.pkl"), "rb") as f:
+        nuts3 = pickle.load(f)
+    years, months = config["years"], config["months"]
+    rss_start = rss_mb()
+
+    t0 = perf_counter()
+    if stage == "add_hurs_wb":
+        er.add_hurs_wb(path_in=path("hourly"), path_out=path("hourly_wb"))
+    elif stage == "hourly_to_daily":
+        er.hourly_to_daily(path_hourly=path("hourly"), path_daily=path("daily"))
+    elif stage == "combine_clim":
+        er.combine_clim(path_dat=path("daily"), name_prefix="ERA_land",
+                        mon_start=min(months), mon_end=max(months),
+                        year_start=min(years), year_end=max(years)).load()
+    elif stage == "weekly_cdo":
+        er.weekly_cdo(path_dat=path("hourly_cdo"), name_prefix="ERA_land")
+    elif stage == "getNutsClimAll":
+        df_clim = er.getNutsClimAll(path_nc=path("weekly.nc"), nuts_shp=nuts3)
+        df_clim.to_pickle(path("df_clim.pkl"))
+    elif stage == "mergeEurostatClim":
+        df = er.mergeEurostatClim(read_pickle(path("eurostat.pkl")),
+                                  read_pickle(path("df_clim.pkl")))
+        df.to_pickle(path("df_merged.pkl"))
+    elif stage == "TLCC":
+        df = read_pickle(path("df_merged.pkl"))
+        for nuts_id in nuts3.NUTS_ID.values:
+            er.TLCC(df.loc[df.sex == "T"], nuts_id=nuts_id, start=-20, end=21)
+    wall = perf_counter() - t0
+
+    return {"wall_s": wall, "peak_rss_mb": rss_mb(), "start_rss_mb": rss_start}
+
+
+# ------------------------------------------------------------------------------- #
+def gitCommit():
+    """
+    Returns the current git commit of the repository (and if the working tree is dirty)
+    """
+
+    import subprocess
+
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root,
+                                capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               cwd=root, capture_output=True, text=True).stdout.strip() != ""
+        return commit, dirty
+    except Exception:
+        return "unknown", False
+
+
+# ------------------------------------------------------------------------------- #
+def main():
+
+    import json
+    import shutil
+    import argparse
+    import platform
+    from datetime import datetime
+    from tempfile import mkdtemp
+    from multiprocessing import get_context
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the emme_roch pipeline stages")
+    parser.add_argument("--n-lat", type=int, default=41, help="Grid cells in latitude")
+    parser.add_argument("--n-lon", type=int, default=61, help="Grid cells in longitude")
+    parser.add_argument("--years", type=int, nargs="+", default=[2000], help="Years")
+    parser.add_argument("--months", type=int, nargs="+", default=[1, 2, 3], help="Months")
+    parser.add_argument("--variables", nargs="+", default=None,
+                        help="Variables of the synthetic datasets (default: all)")
+    parser.add_argument("--n-regions", type=int, default=9,
+                        help="NUTS3 regions per synthetic country")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES,
+                        help="Stages to run")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Times to run each stage (the fastest run is kept)")
+    parser.add_argument("--path-work", default=None,
+                        help="Working directory (default: temporary directory)")
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(__file__), "results"),
+                        help="Directory to save the results JSON in")
+    args = parser.parse_args()
+
+    config = {"n_lat": args.n_lat, "n_lon": args.n_lon, "years": args.years,
+              "months": args.months, "variables": args.variables,
+              "n_regions": args.n_regions, "repeat": args.repeat}
+
+    path_work = mkdtemp() if args.path_work is None else args.path_work
+    os.makedirs(path_work, exist_ok=True)
+    setupData(path_work, config)
+
+    # CDO is needed for the weekly_cdo stage
+    stages = args.stages
+    if "weekly_cdo" in stages and shutil.which("cdo") is None:
+        print("CDO not found, skipping the weekly_cdo stage\n")
+        stages = [s for s in stages if s != "weekly_cdo"]
+
+    # Add the stages that produce the inputs of the selected ones
+    required = set(stages)
+    for stage in reversed(STAGES):
+        if stage in required:
+            required.update(DEPENDS.get(stage, []))
+    stages = [s for s in STAGES if s in required]
+
+    results = {}
+    ctx = get_context("spawn")
+    for stage in stages:
+        runs = []
+        for _ in range(args.repeat):
+            with ctx.Pool(1) as pool:
+                runs.append(pool.apply(runStage, (stage, path_work, config)))
+        results[stage] = min(runs, key=lambda x: x["wall_s"])
+        print(f"{stage:<20} {results[stage]['wall_s']:10.2f} s "
+              f"{results[stage]['peak_rss_mb']:10.1f} MB")
+
+    commit, dirty = gitCommit()
+    record = {"commit": commit, "dirty": dirty,
+              "date": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "config": config, "stages": results}
+
+    os.makedirs(args.out, exist_ok=True)
+    path_json = os.path.join(args.out, f"{commit}{'-dirty' if dirty else ''}.json")
+    with open(path_json, "w") as f:
+        json.dump(record, f, indent=2)
+    print(f"\nResults saved in {path_json}")
+
+    if args.path_work is None:
+        shutil.rmtree(path_work)
+
+
+if __name__ == "__main__":
+    main()
+
+
+# ------------------------------------------------------------------------------- #
@@ -0,0 +1,234 @@
+# ------------------------------------------------------------------------------- #
+# Synthetic ERA5-land like datasets, NUTS regions and Eurostat tables, so the
+# pipeline benchmarks can run offline
+# ------------------------------------------------------------------------------- #
+
+# Short name: (long name, units, mean, amplitude of the seasonal and daily cycles, noise)
+VARIABLES = {"d2m": ("2 metre dewpoint temperature", "K", 283.0, 8.0, 2.0),
+             "t2m": ("2 metre temperature", "K", 290.0, 10.0, 2.0),
+             "fal": ("Forecast albedo", "(0 - 1)", 0.2, 0.05, 0.01),
+             "src": ("Skin reservoir content", "m of water equivalent", 1e-4, 5e-5, 2e-5),
+             "sshf": ("Surface sensible heat flux", "J m**-2", -1e5, 5e5, 1e5),
+             "e": ("Total evaporation", "m of water equivalent", -1e-4, 1e-4, 5e-5),
+             "tp": ("Total precipitation", "m", 0.0, 0.0, 1e-4)}
+
+
+# ------------------------------------------------------------------------------- #
+def makeGrid(n_lat, n_lon, area=[43, 18, 33, 36], resolution=0.1):
+    """
+    Returns the latitudes (descending, as ERA5) and longitudes of a synthetic grid
+
+    Args:
+        n_lat, n_lon: Number of grid cells in each direction
+        area: Bounding box [north, west, south, east], the grid starts on the north-west
+              corner (default: EMME area)
+        resolution: Grid cell size in degrees (default: 0.1, ERA5-land)
+
+    Returns:
+        lats, lons: numpy arrays
+    """
+
+    from numpy import arange
+
+    lats = (area[0] - arange(n_lat) * resolution).round(2)
+    lons = (area[1] + arange(n_lon) * resolution).round(2)
+
+    return lats, lons
+
+
+# ------------------------------------------------------------------------------- #
+def makeClimate(times, lats, lons, variables=None, seed=0):
+    """
+    Creates a synthetic climate dataset with seasonal and daily cycles
+
+    Args:
+        times: pandas DatetimeIndex
+        lats, lons: Grid coordinates
+        variables: List of short variable names (keys of VARIABLES) (default: all)
+        seed: Random number generator seed
+
+    Returns:
+        xarray dataset
+    """
+
+    from numpy import pi, sin, newaxis, float32
+    from numpy.random import default_rng
+    from xarray import Dataset
+
+    variables = list(VARIABLES.keys()) if variables is None else variables
+    rng = default_rng(seed)
+
+    # Seasonal and daily cycles
+    doy = times.dayofyear.values
+    hour = times.hour.values
+    cycle = (0.7 * sin(2 * pi * (doy - 110) / 365.25) + 0.3 * sin(2 * pi * (hour - 9) / 24))
+    cycle = cycle[:, newaxis, newaxis]
+    # Colder in the north
+    gradient = ((lats - lats.mean()) / 10)[newaxis, :, newaxis]
+
+    data_vars = {}
+    shape = (len(times), len(lats), len(lons))
+    # The dew point is derived from the temperature, so it's created last
+    for var in sorted(variables, key=lambda x: x == "d2m"):
+        long_name, units, mean, amplitude, noise = VARIABLES[var]
+        if var == "tp":
+            values = rng.gamma(0.3, noise, size=shape)
+        elif var == "d2m" and "t2m" in data_vars:
+            # Dew point can't be higher than the temperature
+            values = data_vars["t2m"][1] - abs(rng.normal(3, noise, size=shape))
+        else:
+            values = mean + amplitude * (cycle - gradient) + rng.normal(0, noise, size=shape)
+        data_vars[var] = (("time", "latitude", "longitude"), values.astype(float32),
+                          {"long_name": long_name, "units": units})
+
+    return Dataset(data_vars, coords={"time": times, "latitude": lats, "longitude": lons})
+
+
+# ------------------------------------------------------------------------------- #
+def makeHourlyMonths(path_save, years, months=range(1, 13), n_lat=101, n_lon=181,
+                     variables=None, name_prefix="ERA_land"):
+    """
+    Writes synthetic hourly monthly netcdfs, named and packed (int16) as the downloaded
+    CDS datasets
+
+    Args:
+        path_save: Directory to save the datasets in
+        years: List of years
+        months: List of months (default: all)
+        n_lat, n_lon: Grid size
+        variables: List of short variable names (default: all in VARIABLES)
+        name_prefix: Prefix identifier for the filenames
+
+    Returns:
+        list of the paths of the datasets
+    """
+
+    import os
+    from calendar import monthrange
+    from pandas import date_range
+    from emme_roch.storage import netcdfEncoding
+
+    if not os.path.isdir(path_save):
+        os.makedirs(path_save)
+
+    lats, lons = makeGrid(n_lat, n_lon)
+
+    paths = []
+    for year in years:
+        for month in months:
+            times = date_range(f"{year}-{month:02d}-01", freq="h",
+                               periods=24 * monthrange(year, month)[1])
+            ds = makeClimate(times, lats, lons, variables=variables, seed=year * 100 + month)
+            path = os.path.join(path_save, f"{name_prefix}_yr_{year}_mnth_{month}.nc")
+            ds.to_netcdf(path, encoding=netcdfEncoding(ds, {"dtype": "int16", "complevel": 0}))
+            paths.append(path)
+
+    return paths
+
+
+# ------------------------------------------------------------------------------- #
+def makeWeekly(path_nc, years, n_lat=101, n_lon=181, variables=None):
+    """
+    Writes a synthetic weekly dataset (weeks starting on Mondays), as the output of weekly_cdo
+
+    Args:
+        path_nc: Path of the netcdf to write
+        years: List of years
+        n_lat, n_lon: Grid size
+        variables: List of short variable names (default: all in VARIABLES)
+    """
+
+    from pandas import date_range
+
+    lats, lons = makeGrid(n_lat, n_lon)
+    times = date_range(f"{min(years)}-01-01", f"{max(years)}-12-31", freq="W-MON")
+    ds = makeClimate(times, lats, lons, variables=variables, seed=min(years))
+    ds.to_netcdf(path_nc)
+
+
+# ------------------------------------------------------------------------------- #
+def makeNuts(n_lat=101, n_lon=181, n_regions=20, countries=["XA", "XB"]):
+    """
+    Creates a synthetic NUTS shapefile covering the synthetic grid, with NUTS3 regions
+    of equal size and their NUTS2/1/0 unions (same columns as the Eurostat shapefile)
+
+    Args:
+        n_lat, n_lon: Grid size
+        n_regions: Number of NUTS3 regions per country
+        countries: Country codes
+
+    Returns:
+        geopandas GeoDataFrame (epsg 4326)
+    """
+
+    from math import ceil
+    from shapely.geometry import box
+    from shapely.ops import unary_union
+    from geopandas import GeoDataFrame
+
+    lats, lons = makeGrid(n_lat, n_lon)
+    north, south, west, east = lats.max(), lats.min(), lons.min(), lons.max()
+
+    # Split the area in vertical bands (countries) and each band in rows x cols regions
+    band = (east - west) / len(countries)
+    cols = ceil(n_regions ** 0.5)
+    rows = ceil(n_regions / cols)
+
+    records = []
+    for c, country in enumerate(countries):
+        for i in range(n_regions):
+            x0 = west + c * band + (i % cols) * band / cols
+            y0 = south + (i // cols) * (north - south) / rows
+            nuts_id = f"{country}{i // 9 + 1}{(i // 3) % 3 + 1}{i % 3 + 1}"
+            records.append({"NUTS_ID": nuts_id, "LEVL_CODE": 3, "CNTR_CODE": country,
+                            "NAME_LATN": nuts_id,
+                            "geometry": box(x0, y0, x0 + band / cols,
+                                            y0 + (north - south) / rows)})
+
+    # Higher NUTS levels as unions of the NUTS3 regions
+    for level in [2, 1, 0]:
+        parents = {}
+        for r in records:
+            if r["LEVL_CODE"] == 3:
+                parents.setdefault(r["NUTS_ID"][:2 + level], []).append(r["geometry"])
+        for nuts_id, geoms in parents.items():
+            records.append({"NUTS_ID": nuts_id, "LEVL_CODE": level, "CNTR_CODE": nuts_id[:2],
+                            "NAME_LATN": nuts_id, "geometry": unary_union(geoms)})
+
+    return GeoDataFrame(records, crs="EPSG:4326")
+
+
+# ------------------------------------------------------------------------------- #
+def makeEurostat(nuts_ids, years, sexes=["T", "M", "F"],
+                 ages=["TOTAL", "Y_LT20", "Y20-39", "Y40-59", "Y60-79", "Y_GE80"], seed=0):
+    """
+    Creates a synthetic weekly deaths table, in the wide format returned by
+    eurostat.get_data_df (one column per week)
+
+    Args:
+        nuts_ids: List of NUTS IDs
+        years: List of years
+        sexes: Sex codes
+        ages: Age group codes
+        seed: Random number generator seed
+
+    Returns:
+        pandas dataframe
+    """
+
+    from numpy.random import default_rng
+    from pandas import DataFrame, MultiIndex
+
+    rng = default_rng(seed)
+
+    weeks = [f"{year}W{week:02d}" for year in sorted(years, reverse=True)
+             for week in range(52, 0, -1)]
+    index = MultiIndex.from_product([["NR"], sexes, ages, nuts_ids],
+                                    names=["unit", "sex", "age", "geo\\time"])
+    df = DataFrame(rng.poisson(20, size=(len(index), len(weeks))).astype(float),
+                   index=index, columns=weeks)
+
+    return df.reset_index()
+
+
+# ------------------------------------------------------------------------------- #
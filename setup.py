@@ -11,12 +11,16 @@ setup(name='EMME_ROCH',
       python_requires='>=3.7',
       install_requires=['cdsapi', 
                         'geopandas',
-                        'shapely<2.0',
+                        'shapely>=1.8,<2.0',
                         'xarray',
                         'numpy',
                         'pandas',
                         'tqdm',
                         'eurostat',
                         'netcdf4',
-                        'h5py']
+                        'h5py'],
+      extras_require={'zarr': ['zarr'],
+                      'dask': ['dask'],
+                      'parquet': ['pyarrow'],
+                      'metrics': ['psutil']}
      )
\ No newline at end of file
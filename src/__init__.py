@@ -3,10 +3,24 @@
 # --------------------------------------------------------------------- #
 
 from .climate_temporal import parse_name, weekly_cdo, hourly_to_daily, \
-    combine_clim, add_hurs_wb
-from .downloadCDS import downloadCDS, downloadMultipleCDS
-from .eurostat_data import weekToDate, weeklyEurostat, TLCC
+    combine_clim, add_hurs_wb, weekly_daily, weeklyStats
+from .downloadCDS import downloadCDS, downloadMultipleCDS, completeDataset, planUpdate
+from .cds_planner import estimateRequestCost, planRequests
+from .cds_jobs import downloadAsyncCDS, submitJobs, pollJobs
+from .streaming import streamCDS
+from .coverage import buildCoverage, coverageGaps, repairGaps
+from .derived import DERIVED, registerDerived, resolveDerived, computeDerived, openDerived
+from .events import percentileThresholds, detectEvents, eventsNuts
+from .climatology import updateClimatology, readClimatology, anomalies
+from .panels import writePanel, readPanel
+from .eurostat_data import weekToDate, weeklyEurostat, mergeEurostatClim, TLCC, \
+    readEurostat, downloadEurostat
 from .geometries import readNuts, make_polygon, \
-    getNutsclim, getNutsClimAll
+    getNutsclim, getNutsClimAll, latLonNames, nutsArea, cropDataset, nutsAreas, \
+    rollupNuts, cellAreas, gridCells, nutsWeights
+from .pipeline import runPipeline
+from .instrument import logger, setMetricsSink, setProgress, stage
+from .storage import isZarr, writeZarr, openClim, ENCODING, netcdfEncoding, \
+    benchmarkEncoding, memoryChunks
 
 # --------------------------------------------------------------------- #
\ No newline at end of file
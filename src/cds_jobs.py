@@ -0,0 +1,319 @@
+# ------------------------------------------------------------------------------- #
+# Asynchronous CDS downloads: all the requests are submitted up front, their remote
+# request IDs are kept in a JSON state file and polled until they are completed, so a
+# restarted process resumes polling the existing requests instead of re-submitting them.
+# The requests of the legacy keys (uid:key) are polled through the cdsapi Result, those of
+# the token-only keys of the current CDS (cdsapi>=0.7) through the ecmwf-datastores remotes.
+# ------------------------------------------------------------------------------- #
+
+# Request states which still need polling
+ACTIVE = ["queued", "running", "completed"]
+
+# States of the ecmwf-datastores requests as the states of the legacy API
+STATES = {"accepted": "queued", "running": "running", "successful": "completed",
+          "failed": "failed", "rejected": "failed", "dismissed": "failed", "deleted": "failed"}
+
+
+# ------------------------------------------------------------------------------- #
+def readJobs(path_state):
+    """
+    Reads the state file of the CDS jobs (empty if it doesn't exist)
+    """
+
+    import os
+    import json
+
+    if not os.path.isfile(path_state):
+        return {}
+    with open(path_state) as f:
+        return json.load(f)
+
+
+# ------------------------------------------------------------------------------- #
+def writeJobs(path_state, jobs):
+    """
+    Writes the state file of the CDS jobs (atomically, so a killed process can't corrupt it)
+    """
+
+    import os
+    import json
+
+    with open(f"{path_state}.tmp", "w") as f:
+        json.dump(jobs, f, indent=1)
+    os.replace(f"{path_state}.tmp", path_state)
+
+
+# ------------------------------------------------------------------------------- #
+def cdsClient(url=None, key=None):
+    """
+    Returns a CDS client which doesn't wait for the requests to complete and doesn't
+    delete them on the server (url and key are read from ~/.cdsapirc if not given)
+    """
+
+    import cdsapi
+
+    return cdsapi.Client(url=url, key=key, wait_until_complete=False, delete=False, quiet=True)
+
+
+# ------------------------------------------------------------------------------- #
+def isLegacyClient(c):
+    """
+    Returns True if the client is the legacy cdsapi client (uid:key keys, /tasks API),
+    False if it's the ecmwf-datastores client of the token-only keys (cdsapi>=0.7)
+    """
+
+    from cdsapi.api import Client
+
+    return isinstance(c, Client)
+
+
+# ------------------------------------------------------------------------------- #
+def remoteJob(c, job):
+    """
+    Returns the state of a submitted request, its error and a function to download its
+    result to a path, through the cdsapi Result (legacy client) or the ecmwf-datastores
+    remote of the request
+
+    Args:
+        c: CDS client (see cdsClient)
+        job: Job of the state file (with the request_id and state)
+
+    Returns:
+        state (see ACTIVE), error (None if it didn't fail), download function
+    """
+
+    if isLegacyClient(c):
+        from cdsapi.api import Result
+        result = Result(c, {"request_id": job["request_id"], "state": job["state"]})
+        result.update()
+        return result.reply["state"], result.reply.get("error"), result.download
+
+    remote = c.client.get_remote(job["request_id"])
+    status = remote.status
+    state = STATES.get(status, status)
+
+    return state, f"request {status}" if state == "failed" else None, remote.download
+
+
+# ------------------------------------------------------------------------------- #
+def submitJobs(requests, path_state, url=None, key=None):
+    """
+    Submits the CDS requests which are not already submitted (or which failed) and records
+    their request IDs in the state file
+
+    Args:
+        requests: List of dictionaries with the dataset, request (see cdsRequest), target
+                  (path to save the dataset to), month_target (path of the monthly dataset
+                  the target is part of) and n_parts (number of parts of the month)
+        path_state: Path to the JSON state file
+        url, key: CDS API url and key (default: None, read from ~/.cdsapirc)
+
+    Returns:
+        dictionary of the jobs (target: job)
+    """
+
+    import os
+    from datetime import datetime
+    from .instrument import logger, stage
+
+    jobs = readJobs(path_state)
+    c = None
+
+    for r in requests:
+        job = jobs.get(r["target"])
+        if os.path.isfile(r["target"]) or os.path.isfile(r["month_target"]) or \
+                (job is not None and job["state"] in ACTIVE + ["downloaded"]):
+            continue
+
+        c = cdsClient(url, key) if c is None else c
+        with stage("submitCDS", dataset=r["dataset"], file=os.path.basename(r["target"])) as record:
+            try:
+                submitted = c.retrieve(r["dataset"], r["request"])
+                if isLegacyClient(c):
+                    request_id = submitted.reply["request_id"]
+                    state = submitted.reply.get("state", "queued")
+                else:
+                    request_id, state = submitted.request_id, "queued"
+                jobs[r["target"]] = {**r, "request_id": request_id, "state": state,
+                                     "submitted": datetime.now().isoformat(timespec="seconds")}
+                record["request_id"] = request_id
+            except Exception as e:
+                record["status"] = "failed"
+                record["error"] = repr(e)
+                logger.error(f"{os.path.basename(r['target'])} failed to be submitted because of: {e}")
+                continue
+
+        # Saved after every submission, so a killed process doesn't lose the request IDs
+        writeJobs(path_state, jobs)
+
+    return jobs
+
+
+# ------------------------------------------------------------------------------- #
+def pollJobs(path_state, poll_interval=30, timeout=None, url=None, key=None, encoding=None):
+    """
+    Polls the submitted CDS requests, downloads the completed ones and combines the parts
+    of each month (see downloadCDS) when all of them are downloaded
+
+    Args:
+        path_state: Path to the JSON state file
+        poll_interval: Seconds between polls (default: 30)
+        timeout: Seconds to poll for before returning (default: None, until all are done)
+        url, key: CDS API url and key (default: None, read from ~/.cdsapirc)
+        encoding: Encoding policy for the merged monthly datasets (default: None)
+
+    Returns:
+        dictionary of the jobs (target: job)
+    """
+
+    import os
+    from time import sleep, monotonic
+    from .downloadCDS import mergeParts
+    from .instrument import logger, stage, fileSize
+
+    jobs = readJobs(path_state)
+    c = None
+    t0 = monotonic()
+
+    while True:
+        for target, job in jobs.items():
+            if job["state"] not in ACTIVE:
+                continue
+
+            c = cdsClient(url, key) if c is None else c
+            try:
+                state, error, download = remoteJob(c, job)
+            except Exception as e:
+                if getattr(getattr(e, "response", None), "status_code", None) == 404:
+                    # Unknown (eg. expired) requests are submitted again in the next run
+                    job["state"], job["error"] = "failed", repr(e)
+                    logger.error(f"{os.path.basename(target)} is unknown to the CDS: {e}")
+                else:
+                    # Eg. a timeout or a server error, the request is polled again
+                    logger.warning(f"{os.path.basename(target)} failed to be polled because "
+                                   f"of: {e}, retrying in the next poll")
+                continue
+
+            if state != job["state"]:
+                logger.info(f"{os.path.basename(target)} is {state}")
+            job["state"] = state
+            if state == "failed":
+                job["error"] = str(error)
+                logger.error(f"{os.path.basename(target)} failed on the CDS: {job['error']}")
+            elif state == "completed":
+                with stage("downloadCDS", dataset=job["dataset"], file=os.path.basename(target),
+                           request_id=job["request_id"]) as record:
+                    try:
+                        download(f"{target}.tmp")
+                        os.replace(f"{target}.tmp", target)
+                        job["state"] = "downloaded"
+                        record["bytes_written"] = fileSize(target)
+                    except Exception as e:
+                        # Still completed, the download is attempted again in the next poll
+                        record["status"] = "failed"
+                        record["error"] = repr(e)
+                        logger.error(f"{os.path.basename(target)} failed to download because of: {e}")
+
+        # Combine the months whose parts are all downloaded
+        months = {}
+        for target, job in jobs.items():
+            months.setdefault(job["month_target"], []).append(job)
+        for month_target, parts in months.items():
+            if len(parts) != parts[0].get("n_parts", 1) or \
+                    not all(job["state"] == "downloaded" for job in parts):
+                continue
+            if len(parts) > 1 or parts[0]["target"] != month_target:
+                mergeParts([job["target"] for job in parts], month_target, encoding=encoding)
+                for job in parts:
+                    os.remove(job["target"])
+            for job in parts:
+                job["state"] = "merged"
+
+        writeJobs(path_state, jobs)
+
+        if not any(job["state"] in ACTIVE for job in jobs.values()):
+            break
+        if timeout is not None and monotonic() - t0 + poll_interval > timeout:
+            logger.info("Polling timed out, the remaining requests are resumed in the next run")
+            break
+        sleep(poll_interval)
+
+    # Forget the finished jobs, keep the failed ones to be submitted again
+    jobs = {target: job for target, job in jobs.items() if job["state"] != "merged"}
+    writeJobs(path_state, jobs)
+
+    return jobs
+
+
+# ------------------------------------------------------------------------------- #
+def downloadAsyncCDS(months, path_save,
+                     days = range(1, 32),
+                     area = [43, 18, 33, 36],
+                     dataset = "reanalysis-era5-land",
+                     name_prefix = "ERA_land",
+                     variables = ["2m_dewpoint_temperature", "2m_temperature",
+                                  "forecast_albedo", "skin_reservoir_content",
+                                  "surface_sensible_heat_flux", "total_evaporation",
+                                  "total_precipitation"],
+                     max_fields = None,
+                     max_cost = None,
+                     path_state = None,
+                     poll_interval = 30,
+                     timeout = None,
+                     url = None,
+                     key = None):
+    """
+    Submits the requests of all the months up front (split as in downloadCDS), then polls
+    them and downloads the completed ones. The request IDs are kept in a state file, so
+    calling it again after a restart resumes polling the submitted requests.
+
+    Args:
+        months: List of (year, month) tuples to download
+        path_save: Path to directory where downloaded data will be stored
+        days: Days of the month (default range(1, 32))
+        area: Bounding box for the dataset
+        dataset: User specified CDS identifier for the dataset (default: reanalysis-era5-land)
+        name_prefix: Prefix identifier for the downloaded dataset filename
+        variables: User specified variables to download from CDS
+        max_fields: Maximum fields per request (see downloadCDS) (default: None)
+        max_cost: Maximum cost (fields x grid points) per request (default: None)
+        path_state: Path to the JSON state file (default: <path_save>/.cds_jobs.json)
+        poll_interval: Seconds between polls (default: 30)
+        timeout: Seconds to poll for before returning (default: None, until all are done)
+        url, key: CDS API url and key, eg. of a mock server (default: None, read from ~/.cdsapirc)
+
+    Returns:
+        dictionary of the jobs not finished (target: job)
+    """
+
+    import os
+    from .cds_planner import planRequests
+    from .downloadCDS import cdsRequest
+
+    os.makedirs(path_save, exist_ok=True)
+    path_save = path_save if path_save.endswith('/') else f"{path_save}/"
+    path_state = f"{path_save}.cds_jobs.json" if path_state is None else path_state
+
+    requests = []
+    for year, month in months:
+        month_target = f"{path_save}{name_prefix}_yr_{year}_mnth_{month}.nc"
+        if os.path.isfile(month_target):
+            continue
+        parts = planRequests(year, month, variables, days=days, area=area, dataset=dataset,
+                             max_fields=max_fields, max_cost=max_cost)
+        if len(parts) > 1:
+            os.makedirs(f"{path_save}.parts", exist_ok=True)
+        for i, part in enumerate(parts):
+            requests.append({
+                "dataset": dataset,
+                "request": cdsRequest(year, month, part["variables"], part["days"], area),
+                "target": month_target if len(parts) == 1 else
+                f"{path_save}.parts/{name_prefix}_yr_{year}_mnth_{month}_part_{i + 1}_of_{len(parts)}.nc",
+                "month_target": month_target, "n_parts": len(parts)})
+
+    submitJobs(requests, path_state, url=url, key=key)
+
+    return pollJobs(path_state, poll_interval=poll_interval, timeout=timeout, url=url, key=key)
+
+
+# ------------------------------------------------------------------------------- #
@@ -0,0 +1,109 @@
+# ------------------------------------------------------------------------------- #
+# Request planner for the CDS downloads: estimates the cost of a request (fields x grid
+# points) and splits a month into sub-requests (by variable group or day range) which
+# fit the CDS per-request limits
+# ------------------------------------------------------------------------------- #
+
+# Grid resolution of the datasets in degrees (used to estimate the grid points)
+RESOLUTION = {"reanalysis-era5-land": 0.1,
+              "reanalysis-era5-single-levels": 0.25,
+              "reanalysis-era5-pressure-levels": 0.25}
+
+# Maximum number of fields (variables x days x hours) per request accepted by the CDS
+MAX_FIELDS = {"reanalysis-era5-land": 12000,
+              "reanalysis-era5-single-levels": 120000,
+              "reanalysis-era5-pressure-levels": 120000}
+
+
+# ------------------------------------------------------------------------------- #
+def estimateRequestCost(variables, days, times=24, area=None, dataset="reanalysis-era5-land"):
+    """
+    Estimates the cost of a CDS request
+
+    Args:
+        variables: List of the variables requested
+        days: List of the days requested
+        times: Number of hours requested per day (default: 24)
+        area: Bounding box [north, west, south, east], global if None (default: None)
+        dataset: CDS identifier of the dataset (default: reanalysis-era5-land)
+
+    Returns:
+        dictionary with the number of fields, grid points and the cost (fields x grid points)
+    """
+
+    res = RESOLUTION.get(dataset, 0.25)
+    north, west, south, east = [90, -180, -90, 180] if area is None else area
+
+    fields = len(variables) * len(days) * times
+    points = (round((north - south) / res) + 1) * (round((east - west) / res) + 1)
+
+    return {"fields": fields, "points": points, "cost": fields * points}
+
+
+# ------------------------------------------------------------------------------- #
+def splitEvenly(x, n):
+    """
+    Splits a list in n contiguous parts of (almost) equal size
+    """
+
+    k, r = divmod(len(x), n)
+    return [list(x[i * k + min(i, r):(i + 1) * k + min(i + 1, r)]) for i in range(n)]
+
+
+# ------------------------------------------------------------------------------- #
+def planRequests(year, month, variables, days=range(1, 32), area=None,
+                 dataset="reanalysis-era5-land", max_fields=None, max_cost=None):
+    """
+    Splits the request of a month into the fewest sub-requests which fit the limits. The
+    variables are split in groups first (each sub-request covers the whole month) and only
+    if a single variable doesn't fit, the month is split in day ranges.
+
+    Args:
+        year: Calendar year
+        month: Month of the year (1-12)
+        variables: List of the variables requested
+        days: Days of the month (default: range(1, 32))
+        area: Bounding box [north, west, south, east] (default: None, global)
+        dataset: CDS identifier of the dataset (default: reanalysis-era5-land)
+        max_fields: Maximum fields per request (default: the CDS limit of the dataset)
+        max_cost: Maximum cost (fields x grid points) per request (default: None, no limit)
+
+    Returns:
+        list of dictionaries with the variables and days of each sub-request
+    """
+
+    from math import ceil, floor
+    from calendar import monthrange
+
+    days = [d for d in days if d <= monthrange(year, month)[1]]
+    max_fields = MAX_FIELDS.get(dataset) if max_fields is None else max_fields
+
+    def fits(variables, days):
+        cost = estimateRequestCost(variables, days, area=area, dataset=dataset)
+        return (max_fields is None or cost["fields"] <= max_fields) and \
+            (max_cost is None or cost["cost"] <= max_cost)
+
+    # The whole month in one request
+    if fits(variables, days):
+        return [{"variables": list(variables), "days": days}]
+
+    # Largest number of variables per request for the whole month
+    per_group = max([k for k in range(1, len(variables) + 1) if fits(variables[:k], days)],
+                    default=0)
+    if per_group > 0:
+        return [{"variables": group, "days": days}
+                for group in splitEvenly(list(variables), ceil(len(variables) / per_group))]
+
+    # One variable per request, split in day ranges
+    cost_day = estimateRequestCost(variables[:1], [1], area=area, dataset=dataset)
+    per_range = min([floor(max_fields / cost_day["fields"]) if max_fields is not None else len(days),
+                     floor(max_cost / cost_day["cost"]) if max_cost is not None else len(days)])
+    if per_range < 1:
+        raise ValueError("A single variable and day doesn't fit the request limits, "
+                         "reduce the area of the request")
+
+    return [{"variables": [var], "days": day_range} for var in variables
+            for day_range in splitEvenly(days, ceil(len(days) / per_range))]
+
+
+# ------------------------------------------------------------------------------- #
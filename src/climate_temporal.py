@@ -11,6 +11,7 @@ def parse_name(x):
 
     import re
     from pandas import DataFrame
+    from .instrument import logger
 
     try:
         year = re.search("yr_[0-9]*", x)
@@ -27,7 +28,39 @@ def parse_name(x):
                           "temp_res": [temp_resolution],
                           "filename": [x]})
     except Exception as e:
-        print(f"\nERROR: {x} failed to be parsed.\n")
+        logger.error(f"{x} failed to be parsed.")
+
+
+# ------------------------------------------------------------------------------- # 
+def listFiles(path_dat, name_prefix):
+    """
+    Lists and parses the monthly netcdf datasets of a directory, without changing the
+    working directory (the filenames are the basenames of the datasets)
+
+    Args:
+        path_dat: Directory where netcdf datasets are stored
+        name_prefix: Dataset identifier
+
+    Returns:
+        Dataframe with the parsed details of the datasets, sorted wrt date
+    """
+
+    import os
+    from glob import glob, escape
+    from pandas import concat
+
+    files_dir = glob(os.path.join(escape(path_dat), f"{name_prefix}*.nc"))
+    # The combined weekly datasets (eg. <name_prefix>_<start>_<end>_weekly.nc of weekly_cdo
+    # and weekly_daily) aren't monthly datasets
+    files_dir = [x for x in files_dir if not (x.endswith("_weekly.nc") and "yr_" not in
+                                              os.path.basename(x))]
+    files = concat(map(parse_name, [os.path.basename(x) for x in files_dir]))
+
+    # Sort wrt date
+    files.sort_values(by=['year', 'month'], ascending=True, inplace=True)
+    files.reset_index(drop=True, inplace=True)
+
+    return files
 
 
 # ------------------------------------------------------------------------------- # 
@@ -88,25 +121,16 @@ def checkVariables(path_dat, name_prefix="ERA_land"):
         different: list of datasets with different variables
     """
 
-    import os
-    from glob import glob
-    from pandas import concat
     from xarray import open_dataset
-    from tqdm import tqdm
+    from .instrument import progress
 
     # List the contents of the directory
-    os.chdir(path_dat)
-    files_dir = glob(f"{name_prefix}*.nc")
-    files = concat(map(parse_name, files_dir))
-    del files_dir
-    # Sort wrt date
-    files.sort_values(by=['year', 'month'], ascending=True, inplace=True)
-    files.reset_index(drop=True, inplace=True)
+    files = listFiles(path_dat, name_prefix)
 
     # Loop through the datasets and not the unique sets of variables
     variables = []
     different = []
-    for f in tqdm(files.filename.values):
+    for f in progress(files.filename.values):
         # Read it
         ds = open_dataset(f"{path_dat if path_dat.endswith('/') else f'{path_dat}/'}{f}")
         # List the variables
@@ -122,7 +146,7 @@ def checkVariables(path_dat, name_prefix="ERA_land"):
 
 
 # ------------------------------------------------------------------------------- # 
-def weekly_cdo(path_dat, name_prefix, path_out=None):
+def weekly_cdo(path_dat, name_prefix, path_out=None, zarr_store=None, encoding=None):
     """
     Uses the system's CDO operations to calculate the weekly mean of a climate
     netcdf variables, starting on a Monday
@@ -131,6 +155,8 @@ def weekly_cdo(path_dat, name_prefix, path_out=None):
         path_dat: Path to where the hourly netcdf files are located
         name_prefix: Prefix str to identify the dataset
         path_out: Directory to save the output dataset (optional)
+        zarr_store: Path to a zarr store to also write the weekly dataset to (optional)
+        encoding: Encoding policy for the outputs (see storage.ENCODING) (optional)
 
     Returns:
         Nothing - saves the aggregated and weekly averaged netcdfs in the same folder
@@ -139,19 +165,12 @@ def weekly_cdo(path_dat, name_prefix, path_out=None):
     import os
     import re
     import datetime
-    from glob import glob
-    from pandas import concat
-    from warnings import warn
+    from shlex import quote
+    from .storage import cdoOptions
+    from .instrument import logger, stage, logMissingDates, fileSize
 
     # List the contents of the directory
-    os.chdir(path_dat)
-    files_dir = glob(f"{name_prefix}*.nc")
-    files = concat(map(parse_name, files_dir))
-    del files_dir
-
-    # Sort wrt date
-    files.sort_values(by=['year', 'month'], ascending=True, inplace=True)
-    files.reset_index(drop=True, inplace=True)
+    files = listFiles(path_dat, name_prefix)
 
     # Check if all the datasets are the same (ie contain the same variables)
     different_datasets = checkVariables(path_dat=path_dat, name_prefix=name_prefix)
@@ -161,36 +180,35 @@ def weekly_cdo(path_dat, name_prefix, path_out=None):
 
     # Check if the datasets are complete (if there are missing dates between start and end)
     df_data_complete = checkYears(files)
-    if df_data_complete is not None:
-        warn("\n        WARNING: There are missing dates in the datasets\n \
-            ----------- SEE BELOW MISSING DATES -----------\n")
-        print(df_data_complete)
-        print("\n         ------------------------------------------------")
+    logMissingDates(df_data_complete, "weekly_cdo")
 
 
-    # Combine the data
+    # Combine the data (absolute paths, the working directory is not changed)
+    path_dat = os.path.abspath(path_dat)
     files_to_join = files[files.temp_res == 'hourly'].filename.values
-    files_to_join = [f"{path_dat}/{x}" for x in files_to_join]
+    files_to_join = [os.path.join(path_dat, x) for x in files_to_join]
 
     start_date = f"{files.year.min()}{files[files.year == files.year.min()].month.values[0]}"
     end_date = f"{files.year.max()}{files[files.year == files.year.max()].month.values[-1]}"
-    out_file = f"{name_prefix}_{start_date}_{end_date}.nc"
+    out_file = os.path.join(path_dat, f"{name_prefix}_{start_date}_{end_date}.nc")
 
     if not os.path.isfile(out_file):
-        print("Combining datasets. This could take a while. . .\n")
-        os.system(f"cd {path_dat} && cdo -b F32 -f nc4 -P 4 -O -z zip_5 -s --verbose mergetime \
-            {' '.join(files[files.temp_res == 'hourly'].filename.values)} \
-                {out_file}")
+        logger.info("Combining datasets. This could take a while. . .")
+        with stage("weekly_cdo.mergetime", file=os.path.basename(out_file),
+                   n_files=len(files_to_join)) as record:
+            os.system(f"cdo {cdoOptions(encoding)} -P 4 -O -s --verbose mergetime \
+                {' '.join(quote(x) for x in files_to_join)} {quote(out_file)}")
+            record["bytes_read"] = sum(fileSize(x) for x in files_to_join)
+            record["bytes_written"] = fileSize(out_file)
 
     # Get number of time steps in the file
-    steps = os.popen(f"cdo -s -ntime {path_dat}/{out_file}").read()
+    steps = os.popen(f"cdo -s -ntime {quote(out_file)}").read()
     steps = int(re.search("[0-9]*", steps).group())
 
     # Get the start date of the file
-    start_date = os.popen(f"cdo -s -infov {path_dat}/{out_file} | head -2").read()
+    start_date = os.popen(f"cdo -s -infov {quote(out_file)} | head -2").read()
     start_date = re.search("[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}", 
                            start_date).group()
-    start_date_string = f"{start_date.split('-')[0]}{int(start_date.split('-')[1])}"
 
     # Get the name of the first day in the file
     # Starts from Monday (=0)
@@ -208,24 +226,186 @@ def weekly_cdo(path_dat, name_prefix, path_out=None):
     tstep_range = ndays_range*daily_steps
 
     # If the user wants to use a different directory to save the data
-    if path_out is not None:
-        out_file = f"{path_out}{out_file}" if out_file.endswith('/') else f"{path_out}/{out_file}"
+    weekly_file = os.path.join(path_dat if path_out is None else os.path.abspath(path_out),
+                               os.path.basename(out_file).replace('.nc', '_weekly.nc'))
 
     # Run the weekly averaging procedure using cdo
-    cdo_params = "-O -P 8 -f nc4 -z zip_5 -s --verbose"
-    if not os.path.isfile(f"{out_file.replace('.nc', '_weekly.nc')}"):
-        print('Performing temporal averaging. This could take a while. . .\n')
-        os.system(f"cd {path_dat} && \
-            time cdo {cdo_params} --timestat_date first -timselmean,{tstep_range} \
-            -seltimestep,{tstep_start}/{tstep_end} {name_prefix}_{start_date_string}_{end_date}.nc \
-                {out_file.replace('.nc', '_weekly.nc')}")
+    cdo_params = f"-O -P 8 {cdoOptions(encoding)} -s --verbose"
+    if not os.path.isfile(weekly_file):
+        logger.info('Performing temporal averaging. This could take a while. . .')
+        with stage("weekly_cdo.timselmean", file=os.path.basename(weekly_file)) as record:
+            os.system(f"cdo {cdo_params} --timestat_date first -timselmean,{tstep_range} \
+                -seltimestep,{tstep_start}/{tstep_end} {quote(out_file)} {quote(weekly_file)}")
+            record["bytes_read"] = fileSize(out_file)
+            record["bytes_written"] = fileSize(weekly_file)
+
+    # Add the weekly dataset to the zarr store
+    if zarr_store is not None:
+        from xarray import open_dataset
+        from .storage import writeZarr
+        with open_dataset(weekly_file) as ds:
+            writeZarr(ds, zarr_store, encoding=encoding)
 
     return
 
 
+# ------------------------------------------------------------------------------- # 
+# Weekly statistic of the daily variables (the rest are averaged)
+WEEKLY_STATS = {"tp": "sum", "t2m_min": "min", "t2m_max": "max"}
+
+
+# ------------------------------------------------------------------------------- # 
+def completeWeeks(times):
+    """
+    Returns the Mondays of the weeks with data on all their 7 days (eg. not the last week
+    of the data, if it ends before a Sunday)
+
+    Args:
+        times: Timestamps of a daily or hourly dataset
+    """
+
+    from pandas import DatetimeIndex
+
+    days = DatetimeIndex(times).floor("D").unique().to_series()
+    counts = days.resample("W-MON", closed="left", label="left").count()
+
+    return counts.index[counts.values == 7].values
+
+
+# ------------------------------------------------------------------------------- # 
+def weeklyStats(ds):
+    """
+    Calculates the weekly statistics (weeks starting on a Monday) of a daily dataset: the
+    total precipitation is summed, the minimum (maximum) temperatures are the minimum 
+    (maximum) of the week and the rest of the variables are averaged (see WEEKLY_STATS).
+    Only the complete weeks are kept (the sum of a partial week isn't a weekly total).
+
+    Args:
+        ds: Daily xarray dataset (see hourly_to_daily)
+
+    Returns:
+        ds: Weekly xarray dataset, labeled with the Monday of each week
+    """
+
+    from xarray import merge
+
+    out = [getattr(ds[[var]].resample(time="W-MON", closed="left", label="left"),
+                   WEEKLY_STATS.get(var, "mean"))() for var in ds.data_vars]
+
+    return merge(out).sel(time=completeWeeks(ds.time.values))
+
+
+# ------------------------------------------------------------------------------- # 
+def weekly_daily(path_daily, name_prefix, path_out=None, zarr_store=None, encoding=None):
+    """
+    Calculates the weekly statistics (weeks starting on a Monday, see weeklyStats) from the
+    daily datasets of hourly_to_daily, instead of the hourly datasets as weekly_cdo (24x
+    less data read)
+
+    Args:
+        path_daily: Directory of the daily netcdf datasets
+        name_prefix: Dataset identifier
+        path_out: Directory to save the weekly dataset to (default: None, path_daily)
+        zarr_store: Path to a zarr store to also write the weekly dataset to (default: None)
+        encoding: Encoding policy for the outputs (see storage.ENCODING) (default: None)
+
+    Returns:
+        Path of the weekly dataset
+    """
+
+    import os
+    from .pipeline import weeklyUpdate
+    from .instrument import logMissingDates
+
+    files = listFiles(path_daily, name_prefix)
+    files = files[files.temp_res != "weekly"].reset_index(drop=True)
+    logMissingDates(checkYears(files), "weekly_daily")
+
+    # Same filename as the weekly_cdo output
+    start_date = f"{files.year.values[0]}{files.month.values[0]}"
+    end_date = f"{files.year.values[-1]}{files.month.values[-1]}"
+    weekly_file = os.path.join(path_daily if path_out is None else path_out,
+                               f"{name_prefix}_{start_date}_{end_date}_weekly.nc")
+
+    if not os.path.isfile(weekly_file):
+        weeklyUpdate(files.assign(path=[os.path.join(path_daily, x) for x in files.filename]),
+                     weekly_file, encoding=encoding, daily=True)
+
+    # Add the weekly dataset to the zarr store
+    if zarr_store is not None:
+        from xarray import open_dataset
+        from .storage import writeZarr
+        with open_dataset(weekly_file) as ds:
+            writeZarr(ds, zarr_store, encoding=encoding)
+
+    return weekly_file
+
+
+# ------------------------------------------------------------------------------- # 
+def hourly_to_daily_file(path_in, path_out, zarr_store=None, encoding=None,
+                         area=None, nuts_shp=None, derived=(), memory_budget=None):
+    """
+    Convert one hourly ERA-land dataset (month) to daily and save it. Also calculates the 
+    relative humidity and minimum and maximum temperatures for each day
+
+    Args:
+        path_in: Path to the hourly netcdf dataset
+        path_out: Path to save the daily netcdf dataset to (not used if zarr_store is set)
+        zarr_store: Path to a zarr store to write the daily dataset to (default: None)
+        encoding: Encoding policy for the output (see storage.ENCODING) (default: None)
+        area: Bounding box [north, west, south, east] to crop the dataset to (default: None)
+        nuts_shp: NUTS shapefile to crop the dataset to, if area is not set (default: None)
+        derived: Other derived variables to add, eg. ["humidex", "wbgt"] (see derived.DERIVED)
+                 (default: none)
+        memory_budget: Memory budget (eg. "2GB") to process the dataset lazily in chunks
+                       within (see storage.memoryChunks) (default: None, loaded at once)
+    """
+
+    import os
+    from xarray import open_dataset
+    from .storage import writeZarr, netcdfEncoding, memoryChunks
+    from .instrument import stage, fileSize
+    from .geometries import cropDataset
+    from .derived import computeDerived
+
+    # Convert it and record the metrics of the file
+    with stage("hourly_to_daily", file=os.path.basename(path_in),
+               memory_budget=memory_budget) as record:
+        # Read the file
+        with open_dataset(path_in) as ds_in:
+            # Crop it before any computation (only reads the cropped area from disk)
+            ds = cropDataset(ds_in, area=area, nuts_shp=nuts_shp)
+            # Chunked mode, the days of each spatial tile are read, reduced and written in turn
+            if memory_budget is not None:
+                ds = ds.chunk(memoryChunks(ds, memory_budget))
+
+            # Relative Humidity (if not already in the dataset) and other derived variables
+            ds = computeDerived(ds, ["hurs"] + list(derived))
+
+            # Calculate the daily averages of the variables in the dataset
+            # Drop total precipitation, as this is calculated as the total, not mean
+            ds_daily = ds.drop("tp").resample(time="D").mean()
+            # Add the total precipitation
+            ds_daily = ds_daily.merge(ds["tp"].resample(time="D").sum())
+            # Also add the minimum and maximum daily temperatures
+            ds_daily = ds_daily.merge(ds["t2m"].resample(time="D").min().rename("t2m_min"))
+            ds_daily = ds_daily.merge(ds["t2m"].resample(time="D").max().rename("t2m_max"))
+
+            # Save it in the zarr store (skips the days already in it) or to path_out
+            if zarr_store is not None:
+                writeZarr(ds_daily, zarr_store, encoding=encoding)
+            else:
+                ds_daily.to_netcdf(path_out, encoding=netcdfEncoding(ds_daily, encoding=encoding))
+                record["bytes_written"] = fileSize(path_out)
+
+            record["bytes_read"] = fileSize(path_in)
+            record["cells"] = int(ds["t2m"].size)
+
+
 # ------------------------------------------------------------------------------- # 
 def hourly_to_daily(path_hourly, path_daily, name_prefix="ERA_land", 
-                    merge_daily=False, path_save_all=None):
+                    merge_daily=False, path_save_all=None, zarr_store=None, encoding=None,
+                    area=None, nuts_shp=None, derived=(), memory_budget=None):
     """
     Convert the hourly ERA-land data to daily (temporal interpolations).
     Also calculates the relative humidity and minimum and maximum temperatures for each day
@@ -237,6 +417,16 @@ def hourly_to_daily(path_hourly, path_daily, name_prefix="ERA_land",
         merge_daily: Option to return a single xarray with all the data (all months)
         path_save_all: Path to save the combined dataset (default: None). If nothing is set, 
                        it won't save it
+        zarr_store: Path to a zarr store to write the daily datasets to, instead of the 
+                    monthly netcdfs in path_daily (default: None)
+        encoding: Encoding policy for the outputs (see storage.ENCODING) (default: None)
+        area: Bounding box [north, west, south, east] to crop the datasets to (default: None)
+        nuts_shp: NUTS shapefile (eg. from readNuts) to crop the datasets to, if area is 
+                  not set (default: None)
+        derived: Other derived variables to add, eg. ["humidex", "wbgt"] (see derived.DERIVED)
+                 (default: none)
+        memory_budget: Memory budget (eg. "2GB") to process the dataset lazily in chunks
+                       within (see storage.memoryChunks) (default: None, loaded at once)
 
     Returns:
         ds: Combined xarray of all the months processed (boolean, default=False)
@@ -244,27 +434,16 @@ def hourly_to_daily(path_hourly, path_daily, name_prefix="ERA_land",
     
     # imports
     import os
-    from glob import glob
-    from warnings import warn
-
-    from numpy import exp
-    from pandas import concat
-    from tqdm import tqdm
     from xarray import open_dataset
+    from .storage import openClim, netcdfEncoding
+    from .instrument import progress, logMissingDates
 
     # Check if the path_daily (target directory) exists
-    if not os.path.isdir(path_daily):
+    if zarr_store is None and not os.path.isdir(path_daily):
         os.mkdir(path_daily)
 
-    # List the contents of the directory (hourly datasets)
-    os.chdir(path_hourly)
-    files_dir = glob(f"{name_prefix}*.nc")
-    files = concat(map(parse_name, files_dir))
-    del files_dir
-
-    # Sort wrt date
-    files.sort_values(by=['year', 'month'], ascending=True, inplace=True)
-    files.reset_index(drop=True, inplace=True)
+    # List the contents of the directory
+    files = listFiles(path_hourly, name_prefix)
 
     # Check if all the datasets are the same (ie contain the same variables)
     different_datasets = checkVariables(path_dat=path_hourly, name_prefix=name_prefix)
@@ -274,49 +453,34 @@ def hourly_to_daily(path_hourly, path_daily, name_prefix="ERA_land",
 
     # Check if the datasets are complete (if there are missing dates between start and end)
     df_data_complete = checkYears(files)
-    if df_data_complete is not None:
-        warn("\n        WARNING: There are missing dates in the datasets\n \
-            ----------- SEE BELOW MISSING DATES -----------\n")
-        print(df_data_complete)
-        print("\n         ------------------------------------------------")
+    logMissingDates(df_data_complete, "hourly_to_daily")
 
 
     # Loop through the hourly datasets, convert them to daily averages and save them in the
     # path_daily directory with the same filename
-    for f in tqdm(files.filename.values):
+    for f in progress(files.filename.values):
 
         # Check if the dataset is already present in the directory and skip it if it does
-        if os.path.isfile(f"{path_daily if path_daily.endswith('/') else f'{path_daily}/'}{f}"):
+        if zarr_store is None and \
+            os.path.isfile(f"{path_daily if path_daily.endswith('/') else f'{path_daily}/'}{f}"):
             continue
         
-        # Read the file
-        ds = open_dataset(f"{path_hourly if path_hourly.endswith('/') else f'{path_hourly}/'}{f}")
-        
-        # Relative Humidity
-        if 'hurs' not in ds.variables:
-            # Calculate the relative humidity variable
-            # https://www.omnicalculator.com/physics/relative-humidity
-            RH = 100 * (exp( ( 17.625 * (ds["d2m"]-273.15) ) / ( 243.04 + (ds["d2m"]-273.15) ) ) / \
-                exp( ( 17.625 * (ds["t2m"]-273.15) ) / ( 243.04 + (ds["t2m"] - 273.15) ) ))
-            RH.name = "hurs"
-            RH.attrs = dict(description="Relative Humidity", units="%")
-            # Add it to the ds netcdf
-            ds = ds.merge(RH)
-        
-        # Calculate the daily averages of the variables in the dataset
-        # Drop total precipitation, as this is calculated as the total, not mean
-        ds_daily = ds.drop("tp").resample(time="D").mean()
-        # Add the total precipitation
-        ds_daily = ds_daily.merge(ds["tp"].resample(time="D").sum())
-        # Also add the minimum and maximum daily temperatures
-        ds_daily = ds_daily.merge(ds["t2m"].resample(time="D").min().rename("t2m_min"))
-        ds_daily = ds_daily.merge(ds["t2m"].resample(time="D").max().rename("t2m_max"))
-        
-        # Save it in the path_daily directory
-        ds_daily.to_netcdf(f"{path_daily if path_daily.endswith('/') else f'{path_daily}/'}{f}")
+        # Convert it (the metrics of the file are recorded)
+        hourly_to_daily_file(f"{path_hourly if path_hourly.endswith('/') else f'{path_hourly}/'}{f}",
+                             f"{path_daily if path_daily.endswith('/') else f'{path_daily}/'}{f}"
+                             if zarr_store is None else None,
+                             zarr_store=zarr_store, encoding=encoding,
+                             area=area, nuts_shp=nuts_shp, derived=derived,
+                             memory_budget=memory_budget)
+
+    if merge_daily and zarr_store is not None:
+        ds = openClim(zarr_store)
+        if path_save_all is not None:
+            ds.to_netcdf(path_save_all, encoding=netcdfEncoding(ds, encoding=encoding))
+        return ds
 
     if merge_daily:
-        for f in tqdm(files.filename.values):
+        for f in progress(files.filename.values):
             # If it's the first set it as ds to merge the rest on it
             if f == files.filename.values[0]:
                 ds = open_dataset(f"{path_daily if path_daily.endswith('/') else f'{path_daily}/'}{f}")
@@ -325,7 +489,7 @@ def hourly_to_daily(path_hourly, path_daily, name_prefix="ERA_land",
                 ds = ds.merge(open_dataset(f"{path_daily if path_daily.endswith('/') else f'{path_daily}/'}{f}"))
             # Save it to the user defined path as netcdf (if the user has set one, otherwise skip)
             if path_save_all is not None:
-                ds.to_netcdf(path_save_all)
+                ds.to_netcdf(path_save_all, encoding=netcdfEncoding(ds, encoding=encoding))
         return ds
 
 
@@ -333,10 +497,10 @@ def hourly_to_daily(path_hourly, path_daily, name_prefix="ERA_land",
 def combine_clim(path_dat, name_prefix, mon_start, mon_end, year_start, year_end):
     """
     Return an xarray which contains the data between the start and end user defined dates
-    from a directory (path_dat)
+    from a directory (path_dat) or a zarr store
 
     Args:
-        path_dat: Directory where datasets are stored
+        path_dat: Directory where datasets are stored (or path to a zarr store)
         name_prefix: Dataset identifier
         mon_start: Month to start the dataset
         mon_end: Month to end the dataset
@@ -348,26 +512,20 @@ def combine_clim(path_dat, name_prefix, mon_start, mon_end, year_start, year_end
     """
 
     # imports
-    import os
-    from glob import glob
-    from warnings import warn
-
-    from pandas import concat
-    from tqdm import tqdm
     from xarray import open_dataset
+    from .storage import isZarr, openClim
+    from .instrument import logger, progress, logMissingDates
+
+    # Zarr stores hold the whole time-series, so only the time period needs to be selected
+    if isZarr(path_dat):
+        ds = openClim(path_dat)
+        return ds.sel(time=slice(f"{year_start}-{mon_start:02d}", f"{year_end}-{mon_end:02d}"))
 
     # Check if path_dat ends with the / character and add it if not
     path_dat = path_dat if path_dat.endswith("/") else f"{path_dat}/"
 
-    # List the contents of the directory (hourly datasets)
-    os.chdir(path_dat)
-    files_dir = glob(f"{name_prefix}*.nc")
-    files = concat(map(parse_name, files_dir))
-    del files_dir
-
-    # Sort wrt date
-    files.sort_values(by=['year', 'month'], ascending=True, inplace=True)
-    files.reset_index(drop=True, inplace=True)
+    # List the contents of the directory
+    files = listFiles(path_dat, name_prefix)
 
     # Subset based on the year start
     files = files.loc[files.year >= year_start]
@@ -380,14 +538,10 @@ def combine_clim(path_dat, name_prefix, mon_start, mon_end, year_start, year_end
 
     # Check if the datasets are complete (if there are missing dates between start and end)
     df_data_complete = checkYears(files)
-    if df_data_complete is not None:
-        warn("\n        WARNING: There are missing dates in the datasets\n \
-            ----------- SEE BELOW MISSING DATES -----------\n")
-        print(df_data_complete)
-        print("\n         ------------------------------------------------")
+    logMissingDates(df_data_complete, "combine_clim")
 
     # Loop through the dates, read the dataset and combine them
-    for year in tqdm(range(year_start, year_end+1)):
+    for year in progress(range(year_start, year_end+1)):
         if year == year_start:
             for month in range(mon_start, 13):
                 try:
@@ -399,7 +553,7 @@ def combine_clim(path_dat, name_prefix, mon_start, mon_end, year_start, year_end
                         ds = ds_
                     del ds_
                 except Exception as e:
-                    print(f"Year: {year} -- Month: {month} has failed because of \n{e}")
+                    logger.error(f"Year: {year} -- Month: {month} has failed because of: {e}")
         elif year == year_end:
             for month in range(1, mon_end+1):
                 try:
@@ -411,7 +565,7 @@ def combine_clim(path_dat, name_prefix, mon_start, mon_end, year_start, year_end
                         ds = ds_
                     del ds_
                 except Exception as e:
-                    print(f"Year: {year} -- Month: {month} has failed because of \n{e}")
+                    logger.error(f"Year: {year} -- Month: {month} has failed because of: {e}")
         else:
             for month in range(1, 13):
                 try:
@@ -423,13 +577,74 @@ def combine_clim(path_dat, name_prefix, mon_start, mon_end, year_start, year_end
                         ds = ds_
                     del ds_
                 except Exception as e:
-                    print(f"Year: {year} -- Month: {month} has failed because of \n{e}")
+                    logger.error(f"Year: {year} -- Month: {month} has failed because of: {e}")
 
     return ds
 
 
 # ------------------------------------------------------------------------------- # 
-def add_hurs_wb(path_in, path_out, name_prefix="ERA_land", hurs=True, wb=True):
+def add_hurs_wb_file(path_in, path_out, hurs=True, wb=True, zarr_store=None, encoding=None,
+                     area=None, nuts_shp=None, derived=(), memory_budget=None):
+    """
+    Adds the Relative Humidity and wet bulb temperature variables in one netcdf dataset
+    (month) and saves it elsewhere
+
+    Args:
+        path_in: Path to the netcdf dataset without hurs
+        path_out: Path to save the dataset with the hurs variable (not used if zarr_store is set)
+        hurs: Boolean to calculate the relative humidity variable (default: True)
+        wb: Boolean to calculate the Wet Bulb Temperature variable (default: True)
+        zarr_store: Path to a zarr store to write the dataset to (default: None)
+        encoding: Encoding policy for the output (see storage.ENCODING) (default: None)
+        area: Bounding box [north, west, south, east] to crop the dataset to (default: None)
+        nuts_shp: NUTS shapefile to crop the dataset to, if area is not set (default: None)
+        derived: Other derived variables to add, eg. ["humidex", "wbgt"] (see derived.DERIVED)
+                 (default: none)
+        memory_budget: Memory budget (eg. "2GB") to process the dataset lazily in chunks
+                       within (see storage.memoryChunks) (default: None, loaded at once)
+    """
+
+    import os
+    from gc import collect
+    from xarray import open_dataset
+    from .storage import writeZarr, netcdfEncoding, memoryChunks
+    from .instrument import stage, fileSize
+    from .geometries import cropDataset
+    from .derived import computeDerived
+
+    # Add the variables and record the metrics of the file
+    with stage("add_hurs_wb", file=os.path.basename(path_in),
+               memory_budget=memory_budget) as record:
+        # Read the dataset and crop it before any computation
+        with open_dataset(path_in) as ds_in:
+            ds = cropDataset(ds_in, area=area, nuts_shp=nuts_shp)
+            # Chunked mode, each spatial tile and block of days is calculated and written in turn
+            if memory_budget is not None:
+                ds = ds.chunk(memoryChunks(ds, memory_budget))
+
+            # Relative humidity, wet bulb temperature and any other derived variables 
+            # (see derived.DERIVED), hurs is calculated once even if only wb is requested
+            ds = computeDerived(ds, (["hurs"] if hurs else []) + (["wb"] if wb else []) + list(derived))
+
+            # Save it (the zarr store skips the time steps already in it)
+            if zarr_store is not None:
+                writeZarr(ds, zarr_store, encoding=encoding)
+            else:
+                ds.to_netcdf(path_out, encoding=netcdfEncoding(ds, encoding=encoding))
+                record["bytes_written"] = fileSize(path_out)
+
+            record["bytes_read"] = fileSize(path_in)
+            record["cells"] = int(ds["t2m"].size)
+
+    # Tidy up
+    del ds
+    collect()
+
+
+# ------------------------------------------------------------------------------- # 
+def add_hurs_wb(path_in, path_out, name_prefix="ERA_land", hurs=True, wb=True,
+                zarr_store=None, encoding=None, area=None, nuts_shp=None, derived=(),
+                memory_budget=None):
     """
     Adds the Relative Humidity and wet bulb temperature variables in the netcdf dataset 
     and saves it elsewhere
@@ -440,40 +655,38 @@ def add_hurs_wb(path_in, path_out, name_prefix="ERA_land", hurs=True, wb=True):
         name_prefix: Dataset identifier (default: "ERA_land")
         hurs: Boolean to calculate the relative humidity variable (default: True)
         wb: Boolean to calculate the Wet Bulb Temperature variable (default: True)
+        zarr_store: Path to a zarr store to write the datasets to, instead of the monthly
+                    netcdfs in path_out (default: None)
+        encoding: Encoding policy for the outputs (see storage.ENCODING) (default: None)
+        area: Bounding box [north, west, south, east] to crop the datasets to (default: None)
+        nuts_shp: NUTS shapefile (eg. from readNuts) to crop the datasets to, if area is 
+                  not set (default: None)
+        derived: Other derived variables to add, eg. ["humidex", "wbgt"] (see derived.DERIVED)
+                 (default: none)
+        memory_budget: Memory budget (eg. "2GB") to process the dataset lazily in chunks
+                       within (see storage.memoryChunks) (default: None, loaded at once)
     """
 
-    if not hurs and not wb:
-        print("ERROR: Either hurs or wb boolean indicators (or both) must be True. . .")
+    from .instrument import logger
+
+    if not hurs and not wb and len(derived) == 0:
+        logger.error("Either hurs or wb boolean indicators (or both) must be True. . .")
         return None
 
     # imports
     import os
-    from glob import glob
-    from warnings import warn
-    from gc import collect
-
-    from pandas import concat
-    from numpy import exp, arctan, sqrt
-    from tqdm import tqdm
-    from xarray import open_dataset
+    from .instrument import progress, logMissingDates
 
     # Check if paths end with the / character and add it if not
     path_in = path_in if path_in.endswith("/") else f"{path_in}/"
     path_out = path_out if path_out.endswith("/") else f"{path_out}/"
 
     # Check if the path_out directory exists and create it if not
-    if not os.path.isdir(path_out):
+    if zarr_store is None and not os.path.isdir(path_out):
         os.mkdir(path_out)
 
-    # List the contents of the directory (hourly datasets)
-    os.chdir(path_in)
-    files_dir = glob(f"{name_prefix}*.nc")
-    files = concat(map(parse_name, files_dir))
-    del files_dir
-
-    # Sort wrt date
-    files.sort_values(by=['year', 'month'], ascending=True, inplace=True)
-    files.reset_index(drop=True, inplace=True)
+    # List the contents of the directory
+    files = listFiles(path_in, name_prefix)
 
     # Check if all the datasets are the same (ie contain the same variables)
     different_datasets = checkVariables(path_dat=path_in, name_prefix=name_prefix)
@@ -483,53 +696,22 @@ def add_hurs_wb(path_in, path_out, name_prefix="ERA_land", hurs=True, wb=True):
 
     # Check if the datasets are complete (if there are missing dates between start and end)
     df_data_complete = checkYears(files)
-    if df_data_complete is not None:
-        warn("\n        WARNING: There are missing dates in the datasets\n \
-            ----------- SEE BELOW MISSING DATES -----------\n")
-        print(df_data_complete)
-        print("\n         ------------------------------------------------")
+    logMissingDates(df_data_complete, "add_hurs_wb")
 
 
     # Loop through the datasets in files and add the hurs variable and save 
     # them in the path_out directory
-    for f in tqdm(files.filename.values):
+    for f in progress(files.filename.values):
         
         # Check if the dataset is already present in the directory and skip it if it does
-        if os.path.isfile(f"{path_out}{f}"):
+        if zarr_store is None and os.path.isfile(f"{path_out}{f}"):
             continue
         
-        # Read the dataset
-        ds = open_dataset(f"{path_in}{f}")
-
-        if hurs:
-            # Calculate the Relative Humidity Variable
-            # https://www.omnicalculator.com/physics/relative-humidity
-            RH = 100 * (exp( ( 17.625 * (ds["d2m"]-273.15) ) / ( 243.04 + (ds["d2m"]-273.15) ) ) / \
-                exp( ( 17.625 * (ds["t2m"]-273.15) ) / ( 243.04 + (ds["t2m"] - 273.15) ) ))
-            RH.name = "hurs"
-            RH.attrs = dict(description="Relative Humidity", units="%")
-            # Add it to the ds netcdf
-            ds = ds.merge(RH)
-
-        if wb:
-            # Wet bulb temperature
-            # https://www.omnicalculator.com/physics/wet-bulb
-            WB = (ds["t2m"] - 273.15) * arctan(0.151977 * sqrt(ds["hurs"] + 8.313659) ) + \
-                arctan( (ds["t2m"] - 273.15) + ds['hurs'] ) - \
-                    arctan( ds['hurs'] - 1.676331) + \
-                        0.00391838 * ds["hurs"] ** 1.5 * arctan(0.023101 * ds["hurs"]) - \
-                            4.668035
-            WB.name = "wb"
-            WB.attrs = dict(description="Wet Bulb Temperature", units="degrees Celcius")
-            # Add it to the ds xarray
-            ds = ds.merge(WB)
-
-        # Save it
-        ds.to_netcdf(f"{path_out}{f}")
-
-        # Tidy up
-        del ds, RH, WB
-        collect()
+        # Add the variables and save it (the metrics of the file are recorded)
+        add_hurs_wb_file(f"{path_in}{f}", f"{path_out}{f}" if zarr_store is None else None,
+                         hurs=hurs, wb=wb, zarr_store=zarr_store, encoding=encoding,
+                         area=area, nuts_shp=nuts_shp, derived=derived,
+                         memory_budget=memory_budget)
 
 
 # ------------------------------------------------------------------------------- # 
\ No newline at end of file
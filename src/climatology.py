@@ -0,0 +1,213 @@
+# ------------------------------------------------------------------------------- #
+# Incremental climatology store: running count, mean and sum of squared differences (M2)
+# per calendar slot (day or week of the year) and grid cell, updated with the new days
+# only (Chan et al. parallel variance), so the anomalies of a new dataset don't need the
+# whole archive to be read again
+# ------------------------------------------------------------------------------- #
+
+# Calendar slots of the climatology: number of slots
+SLOTS = {"doy": 365, "week": 53}
+
+
+# ------------------------------------------------------------------------------- #
+def slotIndex(times, slot="doy"):
+    """
+    Returns the calendar slot (1-based) of the timestamps: day of the year on a 365 day
+    calendar (see events.noLeapDoy) or ISO week of the year
+
+    Args:
+        times: Timestamps
+        slot: "doy" or "week" (default: "doy")
+    """
+
+    from pandas import DatetimeIndex
+    from .events import noLeapDoy
+
+    if slot == "doy":
+        return noLeapDoy(times)
+    if slot == "week":
+        return DatetimeIndex(times).isocalendar().week.values.astype(int)
+
+    raise ValueError(f"slot must be one of {list(SLOTS.keys())}")
+
+
+# ------------------------------------------------------------------------------- #
+def toDaily(ds):
+    """
+    Returns the daily values of a dataset. Hourly datasets are reduced to the daily means
+    (total precipitation summed) of their complete days, so a partially downloaded day
+    isn't added to the climatology before all its hours are available.
+
+    Args:
+        ds: xarray dataset (hourly or daily)
+
+    Returns:
+        xarray dataset of the daily values
+    """
+
+    from numpy import diff, timedelta64
+
+    if ds.time.size < 2 or diff(ds.time.values).min() >= timedelta64(1, "D"):
+        return ds
+
+    hours = ds.time.resample(time="D").count()
+    complete = hours.time.values[hours.values == 24]
+
+    daily = ds.drop_vars("tp", errors="ignore").resample(time="D").mean()
+    if "tp" in ds.data_vars:
+        daily = daily.merge(ds["tp"].resample(time="D").sum())
+
+    return daily.sel(time=complete)
+
+
+# ------------------------------------------------------------------------------- #
+def updateClimatology(path_clim, paths, slot="doy", variables=None):
+    """
+    Adds the days of a set of datasets to a climatology store (netcdf), creating it if it
+    doesn't exist. The days already in the store are skipped, so datasets can be added
+    again (eg. refreshed months). The count, mean and M2 of each slot are combined with
+    those of the new days (Chan et al.), so the cost only depends on the new data.
+
+    Args:
+        path_clim: Path to the climatology store (netcdf)
+        paths: Paths to the daily (or hourly, see toDaily) datasets, or xarray datasets
+        slot: Calendar slot, "doy" or "week" (see slotIndex), of a new store (default: "doy")
+        variables: Variables to include, of a new store (default: None, all of them)
+
+    Returns:
+        number of days added
+    """
+
+    import os
+    from numpy import arange, zeros, isfinite, where, nansum, maximum, unique, concatenate, \
+        sort, array, float64
+    from xarray import open_dataset, Dataset
+    from .storage import openClim
+    from .geometries import latLonNames
+    from .instrument import stage, progress
+
+    clim = None
+    if os.path.isfile(path_clim):
+        with open_dataset(path_clim) as ds:
+            clim = ds.load()
+        slot = clim.attrs["slot"]
+        variables = clim.attrs["variables"].split(",")
+
+    n_days = 0
+    with stage("updateClimatology", file=os.path.basename(path_clim), slot=slot,
+               n_files=len(paths)) as record:
+        for path in progress(paths):
+            ds = toDaily(openClim(path))
+            lat_name, lon_name = latLonNames(ds)
+
+            # New store on the grid of the first dataset
+            if clim is None:
+                variables = list(ds.data_vars) if variables is None else list(variables)
+                shape = (SLOTS[slot], ds.sizes[lat_name], ds.sizes[lon_name])
+                clim = Dataset(
+                    {f"{var}_{x}": (("slot", lat_name, lon_name), zeros(shape))
+                     for var in variables for x in ["count", "mean", "m2"]},
+                    coords={"slot": arange(1, SLOTS[slot] + 1), lat_name: ds[lat_name].values,
+                            lon_name: ds[lon_name].values, "ingested": array([], dtype="datetime64[ns]")},
+                    attrs={"slot": slot, "variables": ",".join(variables)})
+
+            # Only the days which are not already in the store
+            ds = ds.sel(time=~ds.time.isin(clim.ingested.values))
+            if ds.time.size == 0:
+                continue
+            slots = slotIndex(ds.time.values, slot)
+
+            for var in variables:
+                x = ds[var].transpose("time", lat_name, lon_name).values.astype(float64)
+                count, mean, m2 = [clim[f"{var}_{s}"].values for s in ["count", "mean", "m2"]]
+                for s in unique(slots):
+                    xs = x[slots == s]
+                    # Count, mean and M2 of the new days of the slot (missing values excluded)
+                    nb = isfinite(xs).sum(axis=0)
+                    mb = where(nb > 0, nansum(xs, axis=0) / maximum(nb, 1), 0)
+                    m2b = nansum((xs - mb) ** 2, axis=0)
+                    # Combined with the running statistics of the slot
+                    na, ma = count[s - 1], mean[s - 1]
+                    n = na + nb
+                    delta = mb - ma
+                    w = where(n > 0, nb / maximum(n, 1), 0)
+                    mean[s - 1] = ma + delta * w
+                    m2[s - 1] = m2[s - 1] + m2b + delta ** 2 * na * w
+                    count[s - 1] = n
+
+            clim = clim.drop_vars("ingested").assign_coords(
+                ingested=sort(concatenate([clim.ingested.values, ds.time.values])))
+            n_days += ds.time.size
+
+        record["days_added"] = n_days
+
+    if n_days > 0:
+        clim.to_netcdf(f"{path_clim}.tmp")
+        os.replace(f"{path_clim}.tmp", path_clim)
+
+    return n_days
+
+
+# ------------------------------------------------------------------------------- #
+def readClimatology(path_clim):
+    """
+    Reads the mean, standard deviation and number of values of each slot from a
+    climatology store
+
+    Args:
+        path_clim: Path to the climatology store (see updateClimatology)
+
+    Returns:
+        xarray dataset with <var> (mean), <var>_std and <var>_count (slot, lat, lon)
+    """
+
+    from numpy import sqrt, nan
+    from xarray import open_dataset, Dataset
+
+    with open_dataset(path_clim) as ds:
+        ds = ds.drop_vars("ingested").load()
+
+    out = Dataset(attrs=ds.attrs)
+    for var in ds.attrs["variables"].split(","):
+        count = ds[f"{var}_count"]
+        out[var] = ds[f"{var}_mean"].where(count > 0)
+        out[f"{var}_std"] = sqrt(ds[f"{var}_m2"] / (count - 1)).where(count > 1, nan)
+        out[f"{var}_count"] = count
+
+    return out
+
+
+# ------------------------------------------------------------------------------- #
+def anomalies(ds, path_clim, standardize=False):
+    """
+    Returns the anomalies of a dataset from the climatology of its calendar slots (eg. the
+    t2m anomalies of a new daily dataset). Only the climatology is read, so the cost doesn't
+    depend on the length of the archive.
+
+    Args:
+        ds: Daily (or weekly, for a "week" climatology) xarray dataset or path to it
+        path_clim: Path to the climatology store (see updateClimatology)
+        standardize: Divide the anomalies by the standard deviation (default: False)
+
+    Returns:
+        xarray dataset of the anomalies of the variables in the climatology
+    """
+
+    from xarray import DataArray, Dataset
+    from .storage import openClim
+
+    ds = openClim(ds)
+    clim = readClimatology(path_clim)
+    slots = DataArray(slotIndex(ds.time.values, clim.attrs["slot"]), dims="time",
+                      coords={"time": ds.time.values})
+
+    out = Dataset()
+    for var in ds.data_vars:
+        if var not in clim.attrs["variables"].split(","):
+            continue
+        a = ds[var] - clim[var].sel(slot=slots).drop_vars("slot")
+        if standardize:
+            a = a / clim[f"{var}_std"].sel(slot=slots).drop_vars("slot")
+        out[var] = a.assign_attrs(ds[var].attrs)
+
+    return out
@@ -0,0 +1,228 @@
+# ------------------------------------------------------------------------------- #
+# Coverage index of the hourly archive: the timestamps present in each dataset (run-length
+# encoded hours), cached by file size and modification time, used to report the missing
+# days/hours and to download only the affected days again
+# ------------------------------------------------------------------------------- #
+
+
+# ------------------------------------------------------------------------------- #
+def fileCoverage(path):
+    """
+    Reads the time axis of a dataset and run-length encodes its hours
+
+    Args:
+        path: Path to the netcdf dataset
+
+    Returns:
+        list of [first hour (iso format), number of consecutive hours] runs
+    """
+
+    from numpy import unique, diff, flatnonzero, int64, datetime64
+    from xarray import open_dataset
+
+    # Only the time coordinate is read
+    with open_dataset(path) as ds:
+        hours = unique(ds.time.values.astype("datetime64[h]").astype(int64))
+
+    if len(hours) == 0:
+        return []
+
+    # Start of each run of consecutive hours
+    starts = flatnonzero(diff(hours) != 1) + 1
+    starts = [0] + list(starts)
+    ends = starts[1:] + [len(hours)]
+
+    return [[str(datetime64(int(hours[s]), "h")), int(e - s)] for s, e in zip(starts, ends)]
+
+
+# ------------------------------------------------------------------------------- #
+def buildCoverage(path_dat, name_prefix="ERA_land", path_index=None, n_jobs=1):
+    """
+    Builds (or updates) the coverage index of the hourly datasets in a directory. The
+    datasets which didn't change (size and modification time) since the last build are
+    not read again, the rest are read in n_jobs processes.
+
+    Args:
+        path_dat: Directory of the hourly datasets
+        name_prefix: Dataset identifier (default: "ERA_land")
+        path_index: Path to the JSON index (default: <path_dat>/.coverage_<name_prefix>.json)
+        n_jobs: Number of processes (default: 1)
+
+    Returns:
+        dictionary of filename: {"year", "month", "size", "mtime_ns", "runs"}
+    """
+
+    import os
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+    from .climate_temporal import listFiles
+    from .instrument import stage, progress
+
+    path_index = os.path.join(path_dat, f".coverage_{name_prefix}.json") \
+        if path_index is None else path_index
+    index = {}
+    if os.path.isfile(path_index):
+        with open(path_index) as f:
+            index = json.load(f)
+
+    files = listFiles(path_dat, name_prefix)
+    files = files[files.temp_res == "hourly"]
+
+    with stage("buildCoverage", n_files=files.shape[0]) as record:
+        # Datasets which are new or changed since the last build
+        todo, updated = [], {}
+        for year, month, f in zip(files.year.values, files.month.values, files.filename.values):
+            st = os.stat(os.path.join(path_dat, f))
+            entry = index.get(f)
+            if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                updated[f] = entry
+            else:
+                todo.append(f)
+                updated[f] = {"year": int(year), "month": int(month), "size": st.st_size,
+                              "mtime_ns": st.st_mtime_ns}
+
+        paths = [os.path.join(path_dat, f) for f in todo]
+        if n_jobs > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(n_jobs) as executor:
+                runs = list(progress(executor.map(fileCoverage, paths), total=len(paths)))
+        else:
+            runs = [fileCoverage(x) for x in progress(paths)]
+        for f, r in zip(todo, runs):
+            updated[f]["runs"] = r
+        record["files_read"] = len(todo)
+
+    with open(f"{path_index}.tmp", "w") as f:
+        json.dump(updated, f)
+    os.replace(f"{path_index}.tmp", path_index)
+
+    return updated
+
+
+# ------------------------------------------------------------------------------- #
+def coverageGaps(index, until=None):
+    """
+    Reports the missing hours of the datasets in a coverage index, per day, including the
+    months missing between the first and the last dataset
+
+    Args:
+        index: Coverage index (see buildCoverage)
+        until: Last timestamp expected (eg. the last day available on the CDS), the hours after
+               it are not reported (default: None, the end of each month)
+
+    Returns:
+        pandas dataframe with the year, month, day, number of missing hours and if the
+        dataset of the month is missing, one row per day with missing hours
+    """
+
+    from numpy import int64, setdiff1d, concatenate, arange, datetime64
+    from pandas import DataFrame, Timestamp, date_range, to_datetime
+
+    columns = ["year", "month", "day", "missing_hours", "missing_file"]
+    if len(index) == 0:
+        return DataFrame(columns=columns)
+
+    until = None if until is None else Timestamp(until)
+    by_month = {(entry["year"], entry["month"]): entry for entry in index.values()}
+    first, last = min(by_month.keys()), max(by_month.keys())
+
+    rows = []
+    for month_start in date_range(Timestamp(*first, 1), Timestamp(*last, 1), freq="MS"):
+        expected = date_range(month_start, periods=24 * month_start.days_in_month, freq="h")
+        if until is not None:
+            expected = expected[expected <= until]
+        if len(expected) == 0:
+            continue
+        entry = by_month.get((month_start.year, month_start.month))
+        if entry is None:
+            missing = expected
+        else:
+            # Hours since the epoch of the runs and the expected hours
+            present = [datetime64(start, "h").astype(int64) + arange(n) for start, n in entry["runs"]]
+            present = concatenate(present) if len(present) > 0 else arange(0)
+            missing = setdiff1d(expected.values.astype("datetime64[h]").astype(int64), present)
+            missing = to_datetime(missing.astype("datetime64[h]"))
+        if len(missing) == 0:
+            continue
+        counts = missing.to_series().groupby(missing.day).size()
+        for day, n in counts.items():
+            rows.append({"year": month_start.year, "month": month_start.month, "day": int(day),
+                         "missing_hours": int(n), "missing_file": entry is None})
+
+    return DataFrame(rows, columns=columns)
+
+
+# ------------------------------------------------------------------------------- #
+def repairGaps(path_dat, gaps,
+               area = [43, 18, 33, 36],
+               dataset = "reanalysis-era5-land",
+               name_prefix = "ERA_land",
+               variables = ["2m_dewpoint_temperature", "2m_temperature",
+                            "forecast_albedo", "skin_reservoir_content",
+                            "surface_sensible_heat_flux", "total_evaporation",
+                            "total_precipitation"],
+               encoding = None):
+    """
+    Downloads only the days with missing hours (see coverageGaps) and merges them into the
+    existing datasets (the months without a dataset are downloaded as usual)
+
+    Args:
+        path_dat: Directory of the hourly datasets
+        gaps: Output of coverageGaps
+        area, dataset, name_prefix, variables: see downloadCDS (must match the datasets)
+        encoding: Encoding policy for the repaired datasets (see storage.ENCODING)
+                  (default: None, the int16 packing of the source variables is kept)
+
+    Returns:
+        list of the (year, month) repaired
+    """
+
+    import os
+    import shutil
+    from xarray import open_dataset, concat
+    from .downloadCDS import downloadCDS
+    from .storage import netcdfEncoding
+    from .instrument import logger, stage
+
+    path_repair = os.path.join(path_dat, ".repair")
+    repaired = []
+    for (year, month), df in gaps.groupby(["year", "month"]):
+        days = sorted(int(x) for x in df.day.values)
+        target = os.path.join(path_dat, f"{name_prefix}_yr_{year}_mnth_{month}.nc")
+
+        # Missing months are downloaded directly
+        if df.missing_file.values[0]:
+            downloadCDS(month=month, year=year, path_save=path_dat, days=days, area=area,
+                        dataset=dataset, name_prefix=name_prefix, variables=variables)
+            if os.path.isfile(target):
+                repaired.append((year, month))
+            continue
+
+        downloadCDS(month=month, year=year, path_save=path_repair, days=days, area=area,
+                    dataset=dataset, name_prefix=name_prefix, variables=variables)
+        path_days = os.path.join(path_repair, os.path.basename(target))
+        if not os.path.isfile(path_days):
+            logger.error(f"Year: {year} -- Month: {month}: the missing days failed to download")
+            continue
+
+        # Add the time steps missing from the dataset
+        with stage("repairGaps", file=os.path.basename(target), days=len(days)) as record:
+            with open_dataset(target) as ds, open_dataset(path_days) as ds_days:
+                # Variables packed as int16 in the source (eg. the CDS files) stay packed
+                source = encoding if encoding is not None else \
+                    {"variables": {var: {"dtype": "int16"} for var in ds.data_vars
+                                   if str(ds[var].encoding.get("dtype")) == "int16"}}
+                ds_days = ds_days.sel(time=~ds_days.time.isin(ds.time.values))
+                record["hours_added"] = int(ds_days.time.size)
+                ds = concat([ds.load(), ds_days.load()], dim="time").sortby("time")
+            ds.to_netcdf(f"{target}.tmp", encoding=netcdfEncoding(ds, encoding=source))
+            os.replace(f"{target}.tmp", target)
+        os.remove(path_days)
+        repaired.append((year, month))
+
+    if os.path.isdir(path_repair) and len(os.listdir(path_repair)) == 0:
+        shutil.rmtree(path_repair)
+
+    return repaired
+
+
+# ------------------------------------------------------------------------------- #
@@ -0,0 +1,177 @@
+# ------------------------------------------------------------------------------- #
+# Registry of the derived variables (relative humidity, wet bulb temperature, heat
+# indices), with their inputs and units. The requested outputs are computed in
+# dependency order, each intermediate once, from only the source variables they need.
+# ------------------------------------------------------------------------------- #
+
+# name: {"inputs", "units", "description", "func"}
+DERIVED = {}
+
+
+# ------------------------------------------------------------------------------- #
+def registerDerived(name, inputs, units, description):
+    """
+    Decorator which adds a derived variable to the registry. The function is called with
+    its inputs (xarray DataArrays) as keyword arguments.
+
+    Example:
+        @registerDerived("t2m_c", inputs=["t2m"], units="degrees Celcius",
+                         description="2m temperature")
+        def t2m_c(t2m):
+            return t2m - 273.15
+
+    Args:
+        name: Name of the derived variable
+        inputs: Names of the source or derived variables it's calculated from
+        units: Units of the derived variable
+        description: Description of the derived variable
+    """
+
+    def register(func):
+        DERIVED[name] = {"inputs": list(inputs), "units": units, "description": description,
+                         "func": func}
+        return func
+
+    return register
+
+
+# ------------------------------------------------------------------------------- #
+@registerDerived("hurs", inputs=["t2m", "d2m"], units="%", description="Relative Humidity")
+def relativeHumidity(t2m, d2m):
+    # https://www.omnicalculator.com/physics/relative-humidity
+    from numpy import exp
+    return 100 * (exp( ( 17.625 * (d2m-273.15) ) / ( 243.04 + (d2m-273.15) ) ) / \
+        exp( ( 17.625 * (t2m-273.15) ) / ( 243.04 + (t2m - 273.15) ) ))
+
+
+@registerDerived("wb", inputs=["t2m", "hurs"], units="degrees Celcius",
+                 description="Wet Bulb Temperature")
+def wetBulb(t2m, hurs):
+    # https://www.omnicalculator.com/physics/wet-bulb
+    from numpy import arctan, sqrt
+    return (t2m - 273.15) * arctan(0.151977 * sqrt(hurs + 8.313659) ) + \
+        arctan( (t2m - 273.15) + hurs ) - \
+            arctan( hurs - 1.676331) + \
+                0.00391838 * hurs ** 1.5 * arctan(0.023101 * hurs) - \
+                    4.668035
+
+
+@registerDerived("vp", inputs=["d2m"], units="hPa", description="Vapour Pressure")
+def vapourPressure(d2m):
+    # Saturation vapour pressure at the dew point (same Magnus coefficients as hurs)
+    from numpy import exp
+    return 6.1094 * exp( ( 17.625 * (d2m-273.15) ) / ( 243.04 + (d2m-273.15) ) )
+
+
+@registerDerived("at", inputs=["t2m", "vp"], units="degrees Celcius",
+                 description="Apparent Temperature (Steadman, without wind)")
+def apparentTemperature(t2m, vp):
+    # Australian Bureau of Meteorology formula, with zero wind speed
+    return (t2m - 273.15) + 0.33 * vp - 4.0
+
+
+@registerDerived("humidex", inputs=["t2m", "vp"], units="degrees Celcius",
+                 description="Humidex")
+def humidex(t2m, vp):
+    return (t2m - 273.15) + 0.5555 * (vp - 10.0)
+
+
+@registerDerived("wbgt", inputs=["t2m", "vp"], units="degrees Celcius",
+                 description="Wet Bulb Globe Temperature (simplified, shade)")
+def wbgt(t2m, vp):
+    # Australian Bureau of Meteorology approximation
+    return 0.567 * (t2m - 273.15) + 0.393 * vp + 3.94
+
+
+# ------------------------------------------------------------------------------- #
+def resolveDerived(outputs, available=()):
+    """
+    Works out the derived variables to calculate (in dependency order) and the source
+    variables needed for a set of outputs. Outputs (or intermediates) already available
+    are not calculated again.
+
+    Args:
+        outputs: Names of the requested derived variables
+        available: Names of the variables already in the dataset (default: none)
+
+    Returns:
+        order: list of the derived variables to calculate, in order
+        sources: list of the source variables to read
+    """
+
+    order, sources = [], []
+
+    def visit(name, path):
+        if name in available:
+            if name not in sources:
+                sources.append(name)
+            return
+        if name not in DERIVED:
+            raise KeyError(f"{name} is not a derived variable or a variable of the dataset")
+        if name in path:
+            raise ValueError(f"Circular dependency of the derived variables: {path + [name]}")
+        if name in order:
+            return
+        for x in DERIVED[name]["inputs"]:
+            visit(x, path + [name])
+        order.append(name)
+
+    for name in outputs:
+        visit(name, [])
+
+    return order, sources
+
+
+# ------------------------------------------------------------------------------- #
+def computeDerived(ds, outputs):
+    """
+    Adds the requested derived variables to a dataset. Shared intermediates (eg. hurs for
+    wb) are calculated once and only added if requested.
+
+    Args:
+        ds: xarray dataset with the source variables
+        outputs: Names of the derived variables to add
+
+    Returns:
+        xarray dataset with the derived variables added
+    """
+
+    order, _ = resolveDerived(outputs, available=list(ds.data_vars))
+
+    cache = {}
+    for name in order:
+        spec = DERIVED[name]
+        da = spec["func"](**{x: cache[x] if x in cache else ds[x] for x in spec["inputs"]})
+        da.name = name
+        da.attrs = dict(description=spec["description"], units=spec["units"])
+        cache[name] = da
+
+    return ds.assign({x: cache[x] for x in outputs if x in cache})
+
+
+# ------------------------------------------------------------------------------- #
+def openDerived(path, outputs, keep=(), chunks=None):
+    """
+    Opens a dataset (netcdf or zarr store) with only the source variables needed for the
+    requested derived variables and calculates them
+
+    Args:
+        path: Path to the dataset
+        outputs: Names of the derived variables
+        keep: Other variables of the dataset to keep (default: none)
+        chunks: Dask chunks to open the dataset with (default: None)
+
+    Returns:
+        xarray dataset with the outputs and the kept variables
+    """
+
+    from .storage import openClim
+
+    ds = openClim(path, chunks=chunks)
+    _, sources = resolveDerived(outputs, available=list(ds.data_vars))
+    ds = ds[list(dict.fromkeys(sources + [x for x in outputs if x in ds.data_vars] + list(keep)))]
+
+    return computeDerived(ds, outputs)[list(dict.fromkeys(list(outputs) + list(keep)))]
+
+
+# ------------------------------------------------------------------------------- #
@@ -1,3 +1,94 @@
+# ------------------------------------------------------------------------------- #
+def cdsRequest(year, month, variables, days=range(1, 32), area=[43, 18, 33, 36]):
+    """
+    Returns the CDS request (dictionary) for the hourly data of the given days of a month
+
+    Args:
+        year: Calendar year
+        month: Month of the year (1-12)
+        variables: Variables to request
+        days: Days of the month (default range(1, 32))
+        area: Bounding box for the dataset
+
+    Returns:
+        dictionary of the request
+    """
+
+    return {
+        'format': 'netcdf',
+        'variable': list(variables),
+        'year': str(year),
+        'month': str(month),
+        'day': [str(x) for x in days],
+        'time': [f"{h:02d}:00" for h in range(24)],
+        'area': area,
+    }
+
+
+# ------------------------------------------------------------------------------- #
+def retrieveCDS(dataset, request, target, **fields):
+    """
+    Retrieves a CDS request and saves it to target (through a temporary file, so an
+    interrupted download doesn't leave a partial dataset). Failures are logged and recorded.
+
+    Args:
+        dataset: CDS identifier of the dataset
+        request: CDS request (see cdsRequest)
+        target: Path to save the dataset to
+        fields: Additional fields for the metrics record (eg. year, month)
+
+    Returns:
+        True if the dataset was downloaded, False otherwise
+    """
+
+    import os
+    import cdsapi
+    from .instrument import logger, stage, fileSize
+
+    # A client per call, so requests can be submitted from multiple threads
+    c = cdsapi.Client()
+
+    with stage("downloadCDS", dataset=dataset, file=os.path.basename(target), **fields) as record:
+        try:
+            c.retrieve(dataset, request, f"{target}.tmp")
+            os.replace(f"{target}.tmp", target)
+            record["bytes_written"] = fileSize(target)
+        except Exception as e:
+            # Failed requests are recorded, but don't stop the calling loops
+            record["status"] = "failed"
+            record["error"] = repr(e)
+            logger.error(f"{os.path.basename(target)} has failed to download because of: {e}")
+            return False
+
+    return True
+
+
+# ------------------------------------------------------------------------------- #
+def mergeParts(paths, target, encoding=None):
+    """
+    Combines the datasets of the sub-requests of a month (variable groups and/or day
+    ranges) into a single dataset
+
+    Args:
+        paths: Paths to the datasets of the sub-requests
+        target: Path to save the combined dataset to
+        encoding: Encoding policy for the output (see storage.ENCODING) (default: None)
+    """
+
+    import os
+    from xarray import open_dataset, combine_by_coords
+    from .storage import netcdfEncoding
+
+    dss = [open_dataset(x) for x in paths]
+    try:
+        ds = combine_by_coords(dss, combine_attrs="override")
+        ds.to_netcdf(f"{target}.tmp", encoding=netcdfEncoding(ds, encoding=encoding))
+        os.replace(f"{target}.tmp", target)
+    finally:
+        for x in dss:
+            x.close()
+
+
 # ------------------------------------------------------------------------------- #
 def downloadCDS(month, year,
                 path_save,
@@ -8,9 +99,16 @@ def downloadCDS(month, year,
                 variables = ["2m_dewpoint_temperature", "2m_temperature",
                              "forecast_albedo", "skin_reservoir_content",
                              "surface_sensible_heat_flux", "total_evaporation",
-                             "total_precipitation"]):
+                             "total_precipitation"],
+                zarr_store = None,
+                max_fields = None,
+                max_cost = None,
+                n_jobs = 1):
     """
-    Downloads data for a specified month and year from the Copernicus DataStore
+    Downloads data for a specified month and year from the Copernicus DataStore. If the
+    request of the month exceeds the request limits, it's split into sub-requests (see 
+    cds_planner.planRequests) which are submitted concurrently and merged into the 
+    monthly dataset.
     
     Args:
         month: User specified month of the year (1-12)
@@ -21,10 +119,18 @@ def downloadCDS(month, year,
         dataset: User specified CDS identifier for the dataset (default: reanalysis-era5-land)
         name_prefix: Prefix identifier for the downloaded dataset filename
         variables: User specified variables to download from CDS
+        zarr_store: Path to a zarr store to append the downloaded month to, an already
+                    downloaded month is appended too if it's not in it (default: None)
+        max_fields: Maximum fields (variables x days x hours) per request 
+                    (default: the CDS limit of the dataset)
+        max_cost: Maximum cost (fields x grid points) per request (default: None, no limit)
+        n_jobs: Number of sub-requests submitted concurrently (default: 1)
     """
 
     import os
-    import cdsapi
+    from concurrent.futures import ThreadPoolExecutor
+    from .cds_planner import planRequests
+    from .instrument import logger
 
     # Check if the path_save directory exists and create it if not
     if not os.path.isdir(path_save):
@@ -32,40 +138,56 @@ def downloadCDS(month, year,
     if not path_save.endswith('/'):
         path_save = f"{path_save}/"
 
-    # If file exists, skip it
-    if os.path.isfile(f"{path_save}{name_prefix}_yr_{year}_mnth_{month}.nc"):
+    # Add the month to the zarr store (the time steps already in it are skipped)
+    def toZarr():
+        if zarr_store is not None:
+            from xarray import open_dataset
+            from .storage import writeZarr
+            with open_dataset(target) as ds:
+                writeZarr(ds, zarr_store)
+
+    # If file exists, skip the download, but add it to the zarr store if it was downloaded
+    # before the store was set
+    target = f"{path_save}{name_prefix}_yr_{year}_mnth_{month}.nc"
+    if os.path.isfile(target):
+        toZarr()
         return
-    
-    # CDS call
-    c = cdsapi.Client()
 
-    try:
-        c.retrieve(
-        dataset,
-        {
-            'format': 'netcdf',
-            'variable': variables,
-            'year': str(year),
-            'month': str(month),
-            'day': [str(x) for x in days],
-            'time': [
-                '00:00', '01:00', '02:00',
-                '03:00', '04:00', '05:00',
-                '06:00', '07:00', '08:00',
-                '09:00', '10:00', '11:00',
-                '12:00', '13:00', '14:00',
-                '15:00', '16:00', '17:00',
-                '18:00', '19:00', '20:00',
-                '21:00', '22:00', '23:00',
-            ],
-            'area': area,
-        },
-            f"{path_save}{name_prefix}_yr_{year}_mnth_{month}.nc"
-        )
-    except Exception as e:
-        print("ERROR ERROR ERROR ERROR \n")
-        print(e)
-        print("\n")
+    # Split the month into sub-requests which fit the request limits
+    parts = planRequests(year, month, variables, days=days, area=area, dataset=dataset,
+                         max_fields=max_fields, max_cost=max_cost)
+
+    if len(parts) == 1:
+        if not retrieveCDS(dataset, cdsRequest(year, month, variables, days, area), target,
+                           year=year, month=month):
+            return
+    else:
+        # The sub-requests are saved in the .parts directory, so the ones already 
+        # downloaded are not requested again if the month fails
+        path_parts = f"{path_save}.parts/"
+        os.makedirs(path_parts, exist_ok=True)
+        targets = [f"{path_parts}{name_prefix}_yr_{year}_mnth_{month}_part_{i + 1}_of_{len(parts)}.nc"
+                   for i in range(len(parts))]
+        logger.info(f"Year: {year} -- Month: {month} is split in {len(parts)} requests")
+
+        def retrieve(part, path):
+            return os.path.isfile(path) or \
+                retrieveCDS(dataset, cdsRequest(year, month, part["variables"], part["days"], area),
+                            path, year=year, month=month, part=os.path.basename(path))
+
+        with ThreadPoolExecutor(max(n_jobs, 1)) as executor:
+            done = list(executor.map(retrieve, parts, targets))
+        if not all(done):
+            logger.error(f"Year: {year} -- Month: {month}: {len(done) - sum(done)} of "
+                         f"{len(parts)} requests failed, the rest are kept in {path_parts}")
+            return
+
+        # Combine them into the monthly dataset
+        mergeParts(targets, target)
+        for path in targets:
+            os.remove(path)
+
+    toZarr()
 
 
 # ------------------------------------------------------------------------------- #
@@ -77,7 +199,13 @@ def downloadMultipleCDS(month_start, month_end, year_start, year_end, path_save,
                         variables = ["2m_dewpoint_temperature", "2m_temperature",
                                      "forecast_albedo", "skin_reservoir_content",
                                      "surface_sensible_heat_flux", "total_evaporation",
-                                     "total_precipitation"]):
+                                     "total_precipitation"],
+                        zarr_store = None,
+                        max_fields = None,
+                        max_cost = None,
+                        n_jobs = 1,
+                        asynchronous = False,
+                        path_state = None):
     """
     Downloads a range of datasets between month_start/year_start and month_end/year_end
 
@@ -91,31 +219,135 @@ def downloadMultipleCDS(month_start, month_end, year_start, year_end, path_save,
         dataset: User specified CDS identifier for the dataset (default: reanalysis-era5-land)
         name_prefix: Prefix identifier for the downloaded dataset filename
         variables: User specified variables to download from CDS
+        zarr_store: Path to a zarr store to append the downloaded months to (default: None)
+        max_fields: Maximum fields per request (see downloadCDS) (default: None)
+        max_cost: Maximum cost (fields x grid points) per request (default: None)
+        n_jobs: Number of sub-requests of a month submitted concurrently (default: 1)
+        asynchronous: Submit all the requests up front and poll them, resuming the submitted
+                      requests after a restart (see cds_jobs.downloadAsyncCDS) (default: False)
+        path_state: Path to the state file of the asynchronous requests 
+                    (default: <path_save>/.cds_jobs.json)
     """
 
+    # Submit all the months up front and poll them
+    if asynchronous:
+        from .cds_jobs import downloadAsyncCDS
+        months = [(year, month) for year in range(year_start, year_end + 1) for month in range(1, 13)
+                  if (year_start, month_start) <= (year, month) <= (year_end, month_end)]
+        downloadAsyncCDS(months, path_save, days=days, area=area, dataset=dataset,
+                         name_prefix=name_prefix, variables=variables, max_fields=max_fields,
+                         max_cost=max_cost, path_state=path_state)
+        # Add the downloaded months to the zarr store
+        if zarr_store is not None:
+            import os
+            from xarray import open_dataset
+            from .storage import writeZarr
+            for year, month in months:
+                path = os.path.join(path_save, f"{name_prefix}_yr_{year}_mnth_{month}.nc")
+                if os.path.isfile(path):
+                    with open_dataset(path) as ds:
+                        writeZarr(ds, zarr_store)
+        return
+
     # Downlaod the data
     if (year_start == year_end):
         for month in range(month_start, month_end + 1):
             downloadCDS(month=month, year=year_start, path_save=path_save,
                         days=days, dataset=dataset, name_prefix=name_prefix,
-                        variables=variables, area=area)
+                        variables=variables, area=area, zarr_store=zarr_store,
+                        max_fields=max_fields, max_cost=max_cost, n_jobs=n_jobs)
     else:
         for year in range(year_start, year_end+1):
             if year == year_start:
                 for month in range(month_start, 13):
                     downloadCDS(month=month, year=year, path_save=path_save,
                                 days=days, dataset=dataset, name_prefix=name_prefix,
-                                variables=variables, area=area)
+                                variables=variables, area=area, zarr_store=zarr_store,
+                                max_fields=max_fields, max_cost=max_cost, n_jobs=n_jobs)
             elif year == year_end:
                 for month in range(1, month_end+1):
                     downloadCDS(month=month, year=year, path_save=path_save,
                                 days=days, dataset=dataset, name_prefix=name_prefix,
-                                variables=variables, area=area)
+                                variables=variables, area=area, zarr_store=zarr_store,
+                                max_fields=max_fields, max_cost=max_cost, n_jobs=n_jobs)
             else:
                 for month in range(1, 13):
                     downloadCDS(month=month, year=year, path_save=path_save,
                                 days=days, dataset=dataset, name_prefix=name_prefix,
-                                variables=variables, area=area)
+                                variables=variables, area=area, zarr_store=zarr_store,
+                                max_fields=max_fields, max_cost=max_cost, n_jobs=n_jobs)
+
+
+# ------------------------------------------------------------------------------- #
+def planUpdate(files, path_save, diff_threshold=65, start=None, refresh_days=1, today=None,
+               name_prefix="ERA_land"):
+    """
+    Plans the (year, month) chunks to download or refresh, from the catalog of the downloaded
+    datasets and the lag of the dataset. The last complete day of each dataset is taken from
+    its time axis, through the coverage index (see buildCoverage, only the new or changed
+    datasets are read), so rewritten datasets (eg. repaired) aren't taken as complete. The
+    processed months whose raw dataset was deleted (see streamCDS) are read from their catalog. A
+    dataset is refreshed once more days are available than it contains.
+
+    Args:
+        files: Pandas dataframe of the downloaded datasets (see climate_temporal.listFiles)
+               or None if there are none
+        path_save: Path to directory of the downloaded datasets
+        diff_threshold: Time the dataset lags behind the current date in days (default: 65)
+        start: (year, month) to start from, the first downloaded month if None (default: None)
+        refresh_days: Minimum number of new days available to refresh a month (default: 1)
+        today: Current date (date, datetime or string) (default: None, now)
+        name_prefix: Dataset identifier, of the coverage index (default: "ERA_land")
+
+    Returns:
+        pandas dataframe with the year, month, days, action ("download" or "refresh") and
+        reason of each chunk
+    """
+
+    import os
+    from datetime import date, timedelta
+    from calendar import monthrange
+    from pandas import DataFrame, Timestamp
+    from .coverage import buildCoverage
+    from .streaming import readProcessed
+
+    today = Timestamp.now() if today is None else Timestamp(today)
+    # Last day available on the CDS
+    latest = (today - timedelta(days=diff_threshold)).date()
+
+    catalog = {} if files is None else \
+        {(int(y), int(m)): os.path.join(path_save, f)
+         for y, m, f in zip(files.year.values, files.month.values, files.filename.values)}
+    coverage = buildCoverage(path_save, name_prefix) if len(catalog) > 0 else {}
+    # Processed months whose raw dataset was deleted (see streamCDS), with their time axis
+    for f, entry in readProcessed(path_save, name_prefix).items():
+        if (entry["year"], entry["month"]) not in catalog:
+            catalog[(entry["year"], entry["month"])] = os.path.join(path_save, f)
+            coverage[f] = entry
+    if start is None and len(catalog) == 0:
+        raise ValueError("There are no datasets in path_save, set the month to start from")
+    year, month = min(catalog.keys()) if start is None else tuple(start)
+
+    plan = []
+    while (year, month) <= (latest.year, latest.month):
+        month_end = date(year, month, monthrange(year, month)[1])
+        available = min(latest, month_end)
+        days = list(range(1, available.day + 1))
+        if (year, month) not in catalog:
+            plan.append({"year": year, "month": month, "days": days, "action": "download",
+                         "reason": "missing"})
+        else:
+            # Last complete day (all its hours) in the dataset
+            runs = coverage.get(os.path.basename(catalog[(year, month)]), {}).get("runs", [])
+            last = max([Timestamp(t) + timedelta(hours=n) for t, n in runs], default=None)
+            downloaded = date(year, month, 1) - timedelta(days=1) if last is None else \
+                min(last.date() - timedelta(days=1), month_end)
+            if (available - downloaded).days >= refresh_days:
+                plan.append({"year": year, "month": month, "days": days, "action": "refresh",
+                             "reason": f"downloaded up to {downloaded}, available up to {available}"})
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    return DataFrame(plan, columns=["year", "month", "days", "action", "reason"])
 
 
 # ------------------------------------------------------------------------------- #
@@ -127,10 +359,20 @@ def completeDataset(path_save,
                     variables = ["2m_dewpoint_temperature", "2m_temperature",
                                  "forecast_albedo", "skin_reservoir_content",
                                  "surface_sensible_heat_flux", "total_evaporation",
-                                 "total_precipitation"]):
+                                 "total_precipitation"],
+                    start = None,
+                    refresh_days = 1,
+                    n_jobs = 1,
+                    max_fields = None,
+                    max_cost = None,
+                    dry_run = False,
+                    path_clim = None):
 
     """
-    Download missing data and checks for the most up to date data on the CDS dataserver
+    Download missing data and checks for the most up to date data on the CDS dataserver. 
+    The months to download or refresh are planned from the filenames and time axes of the
+    downloaded datasets (see planUpdate) and downloaded concurrently. A refreshed 
+    dataset is renamed to .bak until its new version is downloaded (restored if it fails).
 
     Args:
         path_save: Path to directory where downloaded data will be stored
@@ -139,115 +381,72 @@ def completeDataset(path_save,
         area: Bounding box for the dataset
         dataset: User specified CDS identifier for the dataset (default: reanalysis-era5-land)
         variables: User specified variables to download from CDS
+        start: (year, month) to start from, if there are no datasets in path_save (default: None)
+        refresh_days: Minimum number of new days available to refresh a month (default: 1)
+        n_jobs: Number of concurrent downloads (default: 1)
+        max_fields, max_cost: Request limits (see downloadCDS) (default: None)
+        dry_run: Only return the plan (default: False)
+        path_clim: Climatology store to add the new days of the downloaded months to (see
+                   updateClimatology) (default: None)
+
+    Returns:
+        pandas dataframe of the plan (with the status of each download if not a dry run)
     """
 
-    import emme_roch as er
-    from os import chdir, remove
-    from glob import glob
-    from pandas import concat
-    from warnings import warn
-    from datetime import datetime
-    from xarray import open_dataset
-    from math import floor
-    from calendar import monthrange
+    import os
+    from glob import glob, escape
+    from concurrent.futures import ThreadPoolExecutor
+    from .climate_temporal import listFiles, checkYears
+    from .instrument import logger, logMissingDates
 
     # List the contents of the directory
-    chdir(path_save)
-    files_dir = glob(f"{name_prefix}*.nc")
-    files = concat(map(er.climate_temporal.parse_name, files_dir))
-    files = files.sort_values(by=['year', 'month'], ascending=True).reset_index(drop=True)
-    del files_dir
-
-    files = files.drop(files.index[[2, 17, 18, 19]])  # <---------------------- DELETE THIS
-
-    # Check if the datasets are complete (if there are missing dates between start and end)
-    df_data_complete = er.climate_temporal.checkYears(files)
-    if df_data_complete is not None:
-        df_data_complete.reset_index(drop=True, inplace=True)
-        warn("\n\n        WARNING: There are missing dates in the datasets\n \
-            ----------- SEE BELOW MISSING DATES -----------\n")
-        print(df_data_complete)
-        print("\n         ------------------------------------------------")
-
-    # Attempt to download the missing data
-    if df_data_complete is not None:
-        print("---- Attempting to download missing data ----\n")
-        for year in df_data_complete.year.values:
-            for month in df_data_complete.loc[df_data_complete.year == year].months_missing.values[0]:
-                try:
-                    print(f"Downloading: Year: {year} -- Month: {month}")
-                    downloadCDS(year=year, month=month,
-                                area = area,
-                                path_save=path_save,
-                                dataset = dataset,
-                                name_prefix = name_prefix,
-                                variables = variables)
-                    print(f"Finished: Year: {year} -- Month: {month}\n")
-                except Exception as e:
-                    print(f"ERROR:\nYear: {year} -- Month: {month} has failed to download because of: \n{e}")
-
-    # Get the last date in the saved datasets
-    # Read the latest netcdf file
-    ds = open_dataset(f"{path_save if path_save.endswith('/') else f'{path_save}/'}{files.filename.values[-1]}")
-    # Get the last date in the dataset
-    last_date = ds.time.values.max()
-    last_date = datetime.utcfromtimestamp(last_date.tolist()/1e9)
-    # Get the current date
-    current_date = datetime.now()
-    # Get the time difference between them in days
-    time_diff = (current_date - last_date).days
-    # Check if the last dataset is complete (ie. all days are present)
-    delete_file = False if last_date.day == monthrange(last_date.year, last_date.month)[1] else True
-
-    # If the time_diff is larger that the user defined diff_threshold, download the latest datasets
-    if time_diff > diff_threshold:
-        # Delete the last dataset if it's not complete
-        if delete_file:
-            remove(f"{path_save if path_save.endswith('/') else f'{path_save}/'}{files.filename.values[-1]}")
-        # Get the details of the deleted file
-        year, month = files.loc[files.index[-1]].year, files.loc[files.index[-1]].month
-        # If the last file is the same year as the current one, download the data up to two months ago
-        if year == current_date.year:
-            for mnth in range(month, current_date.month-floor(diff_threshold/30)+1, 1):
-                try:
-                    print(f"Downloading: Year: {year} -- Month: {mnth}")
-                    downloadCDS(year=year, month=mnth,
-                                area = area,
-                                path_save=path_save,
-                                dataset = dataset,
-                                name_prefix = name_prefix,
-                                variables = variables)
-                    print(f"Finished: Year: {year} -- Month: {mnth}\n")
-                except Exception as e:
-                    print(f"ERROR:\nYear: {year} -- Month: {mnth} has failed to download because of: \n{e}")
-        else:
-            # Previous year
-            for mnth in range(month, 13, 1):
-                try:
-                    print(f"Downloading: Year: {year} -- Month: {mnth}")
-                    downloadCDS(year=year, month=mnth,
-                                area = area,
-                                path_save=path_save,
-                                dataset = dataset,
-                                name_prefix = name_prefix,
-                                variables = variables)
-                    print(f"Finished: Year: {year} -- Month: {mnth}\n")
-                except Exception as e:
-                    print(f"ERROR:\nYear: {year} -- Month: {mnth} has failed to download because of: \n{e}")
-            # Current year
-            if current_date.month > 2:
-                for mnth in range(1, current_date.month-floor(diff_threshold/30)+1, 1):
-                    try:
-                        print(f"Downloading: Year: {year} -- Month: {mnth}")
-                        downloadCDS(year=current_date.year, month=mnth,
-                                    area = area,
-                                    path_save=path_save,
-                                    dataset = dataset,
-                                    name_prefix = name_prefix,
-                                    variables = variables)
-                        print(f"Finished: Year: {year} -- Month: {mnth}\n")
-                    except Exception as e:
-                        print(f"ERROR:\nYear: {year} -- Month: {mnth} has failed to download because of: \n{e}")
-
-
-# ------------------------------------------------------------------------------- #
\ No newline at end of file
+    files = listFiles(path_save, name_prefix) \
+        if len(glob(os.path.join(escape(path_save), f"{name_prefix}*.nc"))) > 0 else None
+    if files is not None:
+        files = files[files.temp_res == "hourly"]
+        logMissingDates(checkYears(files), "completeDataset")
+
+    plan = planUpdate(files, path_save, diff_threshold=diff_threshold, start=start,
+                      refresh_days=refresh_days, name_prefix=name_prefix)
+    for year, month, action, reason in zip(plan.year.values, plan.month.values,
+                                           plan.action.values, plan.reason.values):
+        logger.info(f"Year: {year} -- Month: {month}: {action} ({reason})")
+    if dry_run or plan.shape[0] == 0:
+        return plan
+
+    def fetch(year, month, days, action):
+        target = os.path.join(path_save, f"{name_prefix}_yr_{year}_mnth_{month}.nc")
+        # Keep the old version until the new one is downloaded (a deleted processed month
+        # has none, see streamCDS)
+        backup = action == "refresh" and os.path.isfile(target)
+        if backup:
+            os.replace(target, f"{target}.bak")
+        try:
+            downloadCDS(year=year, month=month, days=days, area=area, path_save=path_save,
+                        dataset=dataset, name_prefix=name_prefix, variables=variables,
+                        max_fields=max_fields, max_cost=max_cost)
+        except Exception as e:
+            logger.error(f"Year: {year} -- Month: {month} has failed to download because of: {e}")
+        if os.path.isfile(target):
+            if backup:
+                os.remove(f"{target}.bak")
+            return "ok"
+        if backup:
+            os.replace(f"{target}.bak", target)
+        return "failed"
+
+    with ThreadPoolExecutor(max(n_jobs, 1)) as executor:
+        status = list(executor.map(fetch, plan.year.values, plan.month.values,
+                                   plan.days.values, plan.action.values))
+
+    # Add the new days to the climatology (only the downloaded months are read)
+    if path_clim is not None:
+        from .climatology import updateClimatology
+        updateClimatology(path_clim, [os.path.join(path_save, f"{name_prefix}_yr_{y}_mnth_{m}.nc")
+                                      for y, m, x in zip(plan.year.values, plan.month.values, status)
+                                      if x == "ok"])
+
+    return plan.assign(status=status)
+
+
+# ------------------------------------------------------------------------------- #
@@ -1,3 +1,8 @@
+# Eurostat dissemination API, gzipped TSV of a dataset
+EUROSTAT_TSV = "https://ec.europa.eu/eurostat/api/dissemination/sdmx/2.1/data/{dataset}" \
+    "?format=TSV&compressed=true"
+
+
 # ------------------------------------------------------------------------------- #
 def weekToDate(date):
     """Convert a yearWweek format date to date (Monday of week)
@@ -18,14 +23,132 @@ def weekToDate(date):
     return r
 
 
+# ------------------------------------------------------------------------------- # 
+def downloadEurostat(dataset, path_save):
+    """
+    Downloads the gzipped TSV of a Eurostat dataset as it is (streamed to disk), to read it
+    later with readEurostat
+
+    Args:
+        dataset: Eurostat dataset identifier (eg. demo_r_mweek3)
+        path_save: Path to save the TSV to (eg. demo_r_mweek3.tsv.gz)
+
+    Returns:
+        path_save
+    """
+
+    import os
+    import shutil
+    from urllib.request import urlopen
+    from .instrument import stage, fileSize
+
+    with stage("downloadEurostat", dataset=dataset) as record:
+        with urlopen(EUROSTAT_TSV.format(dataset=dataset)) as response, \
+                open(f"{path_save}.tmp", "wb") as f:
+            shutil.copyfileobj(response, f)
+        os.replace(f"{path_save}.tmp", path_save)
+        record["bytes_written"] = fileSize(path_save)
+
+    return path_save
+
+
+# ------------------------------------------------------------------------------- # 
+def readEurostat(source, geo=None, sex=None, age=None, unit=None, chunksize=10000, flags=False):
+    """
+    Reads a Eurostat TSV (from the dissemination API or a local .tsv/.tsv.gz bulk download)
+    line by line, keeping only the rows of the selected regions, sexes, age groups and units,
+    and converts them to the long format in chunks. The memory used depends on the selected
+    rows, not on the size of the table.
+
+    Args:
+        source: Eurostat dataset identifier (read from the API) or path to a local TSV
+        geo: NUTS IDs to keep (default: None, all of them)
+        sex: Sex codes to keep, eg. ["T"] (default: None, all of them)
+        age: Age groups to keep, eg. ["TOTAL"] (default: None, all of them)
+        unit: Units to keep (default: None, all of them)
+        chunksize: Number of table rows converted at a time (default: 10000)
+        flags: Keep the flags of the values (eg. p for provisional) (default: False)
+
+    Returns:
+        pandas dataframe with the dimensions of the table (categorical, geo as nuts_id),
+        Week, time (Monday of the week) and value (float32) columns, without the missing
+        values
+    """
+
+    import os
+    import io
+    import gzip
+    from urllib.request import urlopen
+    from pandas import DataFrame, concat, to_numeric, to_datetime
+    from .instrument import stage
+
+    filters = {d: set(v) for d, v in {"geo": geo, "sex": sex, "age": age, "unit": unit}.items()
+               if v is not None}
+
+    def toLong(rows, dims, periods):
+        df = DataFrame([x[1] for x in rows], columns=periods)
+        for i, d in enumerate(dims):
+            df[d] = [x[0][i] for x in rows]
+        df = df.melt(id_vars=dims, var_name="Week", value_name="cell")
+        # Values are "<value> <flags>" or ":" if missing
+        cell = df.pop("cell").str.strip().str.split(" ", n=1, expand=True)
+        df = df.assign(value=to_numeric(cell[0], errors="coerce").astype("float32"))
+        if flags:
+            df = df.assign(flag=cell[1] if cell.shape[1] > 1 else None)
+        return df[df.value.notna()]
+
+    local = os.path.isfile(source)
+    with stage("readEurostat", source=os.path.basename(source) if local else source) as record:
+        raw = open(source, "rb") if local else urlopen(EUROSTAT_TSV.format(dataset=source))
+        try:
+            compressed = source.endswith(".gz") if local else True
+            f = io.TextIOWrapper(gzip.GzipFile(fileobj=raw) if compressed else raw,
+                                 encoding="utf-8")
+            # eg. "freq,unit,sex,age,geo\TIME_PERIOD", "2020-W01 ", "2020-W02 ", ...
+            header = f.readline().rstrip("\n").split("\t")
+            dims = header[0].split("\\")[0].split(",")
+            periods = [x.strip() for x in header[1:]]
+            index = {d: dims.index(d) for d in filters if d in dims}
+
+            chunks, rows, n_lines = [], [], 0
+            for line in f:
+                n_lines += 1
+                fields = line.rstrip("\n").split("\t")
+                keys = fields[0].split(",")
+                if all(keys[i] in filters[d] for d, i in index.items()):
+                    rows.append((keys, fields[1:]))
+                if len(rows) >= chunksize:
+                    chunks.append(toLong(rows, dims, periods))
+                    rows = []
+            if len(rows) > 0:
+                chunks.append(toLong(rows, dims, periods))
+        finally:
+            raw.close()
+
+        columns = [d for d in dims if d != "freq"] + ["Week", "value"] + (["flag"] if flags else [])
+        df = concat(chunks)[columns] if len(chunks) > 0 else DataFrame(columns=columns)
+        record["lines"] = n_lines
+        record["rows"] = df.shape[0]
+
+    # Weeks as in the bulk downloads (2020W01) and the date of their Monday
+    df = df.rename(columns={"geo": "nuts_id"})
+    df = df.assign(Week=df.Week.str.replace("-W", "W", regex=False))
+    df = df.assign(time=to_datetime(df.Week + "-1", format="%YW%W-%w", errors="coerce"))
+    for d in [x for x in dims if x not in ["freq", "geo"]] + ["nuts_id"]:
+        df[d] = df[d].astype("category")
+
+    return df.reset_index(drop=True)
+
+
 # ------------------------------------------------------------------------------- # 
 def weeklyEurostat(dataset, path_nc, nuts_shp, n_jobs=1):
     """
     Downloads a weekly dataset from Eurostat based on the dataset code ID and
-    combines it with a weekly climate dataset (Netcdf)
+    combines it with a weekly climate dataset (Netcdf). Only the rows of the NUTS regions
+    of the climate dataset are kept while the table is read (see readEurostat).
 
     Args:
-        dataset: Eurostat dataset identifier
+        dataset: Eurostat dataset identifier (or path to a local TSV of it)
         path_nc: Path to the weekly averaged climate dataset
         nuts_shp: NUTS administrative level shapefile
         n_jobs: Number of processes to calculate the climate spatial averaged data
@@ -34,18 +157,43 @@ def weeklyEurostat(dataset, path_nc, nuts_shp, n_jobs=1):
         pandas dataframe with the eurostat and climate variables within
     """
 
-    import eurostat
-    from pandas import merge
     # Local import
-    from emme_roch import getNutsClimAll
+    from .geometries import getNutsClimAll
+    from .instrument import logger
 
     # Get the NUTS3 averaged dataset
-    print('Creating NUTS level area averaged climate dataset. . . \n')
+    logger.info('Creating NUTS level area averaged climate dataset. . .')
     df_clim = getNutsClimAll(path_nc, nuts_shp, n_jobs=1)
 
-    # Read the eurostat dataset
-    print('\nDownloading dataset from Eurostat. . . \n')
-    df = eurostat.get_data_df(dataset, flags=False)
+    # Read the rows of the NUTS regions from the eurostat dataset
+    logger.info('Downloading dataset from Eurostat. . .')
+    df = readEurostat(dataset, geo=df_clim.nuts_id.unique())
+
+    return mergeEurostatClim(df, df_clim)
+
+
+# ------------------------------------------------------------------------------- # 
+def mergeEurostatClim(df, df_clim):
+    """
+    Combines a weekly Eurostat dataset (wide format, as returned by eurostat.get_data_df,
+    or long format, as returned by readEurostat) with the NUTS level area averaged climate
+    dataset
+
+    Args:
+        df: Eurostat dataset (pandas dataframe)
+        df_clim: NUTS level area averaged climate dataset (see getNutsClimAll)
+
+    Returns:
+        pandas dataframe with the eurostat and climate variables within
+    """
+
+    from pandas import merge
+
+    # Long format (readEurostat), already typed
+    if "nuts_id" in df.columns:
+        df = df[df.nuts_id.isin(df_clim.nuts_id.unique())]
+        return merge(df.assign(nuts_id=df.nuts_id.astype(str)), df_clim,
+                     on=['nuts_id', 'time'], how='left')
 
     # Subset for the NUTS regions in the climate dataset
     df = df[df['geo\\time'].isin(df_clim.nuts_id.unique())]
@@ -74,7 +222,8 @@ def TLCC(df, nuts_id, age_group="TOTAL", start=-30, end=30, plot=False, plot_cor
 
     Args:
         df: Pandas dataframe which contains both the values of the variable 
-            to investigate and the climatic variables
+            to investigate and the climatic variables, or the path to a Parquet panel of 
+            it (see writePanel), of which only the nuts_id and age_group are read
         nuts_id: NUTS3 ID to perform the TLCC analysis
         age_group: Age group to investigate
         start: Lag times window start
@@ -90,6 +239,11 @@ def TLCC(df, nuts_id, age_group="TOTAL", start=-30, end=30, plot=False, plot_cor
     from pandas import DataFrame, to_datetime
     from matplotlib import pyplot as plt
 
+    # Read only the NUTS ID and age group from a Parquet panel
+    if isinstance(df, str):
+        from .panels import readPanel
+        df = readPanel(df, nuts_ids=[nuts_id], where={"age": [age_group]})
+
     # Select data for the specified NUTS ID and age group
     df_ = df.loc[(df.nuts_id == nuts_id) & (df.age == age_group)]
     # Convert time to datetime objects
@@ -108,7 +262,8 @@ def TLCC(df, nuts_id, age_group="TOTAL", start=-30, end=30, plot=False, plot_cor
         return
 
     # List the climate variables
-    list_clim = df_.drop(['unit', 'age', 'sex', 'nuts_id', 'Week', 'value', 'time'], axis=1).columns
+    list_clim = df_.drop(['unit', 'age', 'sex', 'nuts_id', 'Week', 'value', 'time',
+                          'level', 'country', 'year'], axis=1, errors='ignore').columns
 
     # Calculate the time lagged cross correlations
     lagged_correlation = DataFrame.from_dict(
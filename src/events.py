@@ -0,0 +1,302 @@
+# ------------------------------------------------------------------------------- #
+# Extreme event (heatwave, warm night) detection over the daily datasets: day of year
+# percentile thresholds and run length based events (count, days, duration and intensity
+# per year), vectorized over the whole grid and processed one year at a time
+# ------------------------------------------------------------------------------- #
+
+
+# ------------------------------------------------------------------------------- #
+def noLeapDoy(times):
+    """
+    Returns the day of the year (1 - 365) of the timestamps, on a 365 day calendar (the
+    29th of February shares the day of the 1st of March)
+    """
+
+    from pandas import DatetimeIndex
+
+    times = DatetimeIndex(times)
+
+    return (times.dayofyear - (times.is_leap_year & (times.month > 2))).values
+
+
+# ------------------------------------------------------------------------------- #
+def readDaily(path_daily, var, years, name_prefix="ERA_land", lat_slice=None):
+    """
+    Reads a variable of the daily datasets for a set of years
+
+    Args:
+        path_daily: Directory of the daily netcdf datasets (see hourly_to_daily) or a zarr store
+        var: Variable to read (eg. "t2m_max")
+        years: Years to read
+        name_prefix: Dataset identifier (default: "ERA_land")
+        lat_slice: Slice of the latitude indices to read (default: None, all of them)
+
+    Returns:
+        xarray DataArray (time, lat, lon) loaded in memory, None if there's no data
+    """
+
+    import os
+    from xarray import open_dataset, concat
+    from .storage import isZarr, openClim
+    from .geometries import latLonNames
+    from .climate_temporal import listFiles
+
+    years = list(years)
+
+    def select(da):
+        lat_name, lon_name = latLonNames(da)
+        da = da.transpose("time", lat_name, lon_name)
+        return da if lat_slice is None else da.isel({lat_name: lat_slice})
+
+    if isZarr(path_daily):
+        da = openClim(path_daily)[var]
+        da = select(da.sel(time=da.time.dt.year.isin(years)))
+        return da.load() if da.time.size > 0 else None
+
+    files = listFiles(path_daily, name_prefix)
+    files = files[files.year.isin(years) & (files.temp_res != "weekly")]
+    das = []
+    for f in files.filename.values:
+        with open_dataset(os.path.join(path_daily, f)) as ds:
+            das.append(select(ds[var]).load())
+
+    return concat(das, dim="time").sortby("time") if len(das) > 0 else None
+
+
+# ------------------------------------------------------------------------------- #
+def percentileThresholds(path_daily, var="t2m_max", q=0.9, window=15,
+                         base_years=range(1991, 2021), name_prefix="ERA_land", n_tiles=1):
+    """
+    Calculates the percentile thresholds of a daily variable for each day of the year, from
+    the days of the base period within a window centred on that day (eg. the 90th percentile
+    of the maximum temperature of the 15 days around each day over 1991-2020)
+
+    Args:
+        path_daily: Directory of the daily netcdf datasets or a zarr store
+        var: Daily variable (default: "t2m_max", "t2m_min" for warm nights)
+        q: Quantile (default: 0.9)
+        window: Number of days of the window around each day of the year (default: 15)
+        base_years: Years of the base period (default: 1991 - 2020)
+        name_prefix: Dataset identifier (default: "ERA_land")
+        n_tiles: Number of latitude bands to read the base period in, to limit the memory
+                 (default: 1)
+
+    Returns:
+        xarray DataArray of the thresholds (doy, lat, lon)
+    """
+
+    import warnings
+    from numpy import abs, minimum, nanquantile, empty, arange, array_split, float32
+    from xarray import DataArray, concat
+    from .geometries import latLonNames
+    from .instrument import stage
+
+    half = window // 2
+
+    with stage("percentileThresholds", var=var, q=q, window=window, n_tiles=n_tiles) as record:
+        tiles = []
+        first = readDaily(path_daily, var, [min(base_years)], name_prefix)
+        lat_name, lon_name = latLonNames(first)
+        for rows in array_split(arange(first.sizes[lat_name]), n_tiles):
+            da = readDaily(path_daily, var, base_years, name_prefix,
+                           lat_slice=slice(rows[0], rows[-1] + 1))
+            doy = noLeapDoy(da.time.values)
+            x = da.values
+            record["days"] = x.shape[0]
+
+            thr = empty((365,) + x.shape[1:], dtype=float32)
+            with warnings.catch_warnings():
+                # All-NaN cells (eg. sea)
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                for d in range(1, 366):
+                    dist = abs(doy - d)
+                    thr[d - 1] = nanquantile(x[minimum(dist, 365 - dist) <= half], q, axis=0)
+
+            tiles.append(DataArray(thr, dims=("doy", lat_name, lon_name),
+                                   coords={"doy": arange(1, 366), lat_name: da[lat_name].values,
+                                           lon_name: da[lon_name].values}))
+
+    return concat(tiles, dim=lat_name).rename(f"{var}_q{round(q * 100)}").assign_attrs(
+        variable=var, quantile=q, window=window,
+        base_period=f"{min(base_years)}-{max(base_years)}")
+
+
+# ------------------------------------------------------------------------------- #
+def runLengths(exceed, anomaly, carry_run, carry_sum):
+    """
+    Returns the length and the cumulative anomaly of the run of exceedances up to each
+    day (0 on the days without an exceedance), continuing the runs of the previous chunk
+
+    Args:
+        exceed: Boolean array (time, cells) of the exceedances
+        anomaly: Array (time, cells) of the differences from the thresholds
+        carry_run: Length of the runs at the end of the previous chunk (cells)
+        carry_sum: Cumulative anomaly of the runs at the end of the previous chunk (cells)
+
+    Returns:
+        run, total: arrays (time, cells)
+    """
+
+    from numpy import arange, where, maximum, cumsum, take_along_axis, vstack, zeros
+
+    idx = arange(1, exceed.shape[0] + 1)[:, None]
+    # Last day without an exceedance (1-based, 0 if none in the chunk yet)
+    last = maximum.accumulate(where(~exceed, idx, 0), axis=0)
+    run = idx - last + where(last == 0, carry_run, 0)
+
+    cs = vstack([zeros((1, exceed.shape[1])), cumsum(where(exceed, anomaly, 0), axis=0)])
+    total = cs[1:] - take_along_axis(cs, last, axis=0) + where(last == 0, carry_sum, 0)
+
+    return run, total
+
+
+# ------------------------------------------------------------------------------- #
+def detectEvents(path_daily, thresholds, var=None, min_duration=3, years=None,
+                 name_prefix="ERA_land", path_out=None):
+    """
+    Detects the events (runs of at least min_duration days above the day of year thresholds)
+    over the whole grid, one year at a time, and calculates their statistics per year (the
+    events are counted in the year they start):
+        - n_events: number of events
+        - event_days: number of days in events
+        - max_duration: duration of the longest event (days)
+        - total_intensity: sum of the differences from the thresholds over the event days
+        - mean_intensity: mean difference from the thresholds over the event days
+
+    Args:
+        path_daily: Directory of the daily netcdf datasets or a zarr store
+        thresholds: Day of year thresholds (see percentileThresholds), on the same grid
+        var: Daily variable (default: None, the variable of the thresholds)
+        min_duration: Minimum number of consecutive days above the thresholds (default: 3)
+        years: Years to process (default: None, all of them)
+        name_prefix: Dataset identifier (default: "ERA_land")
+        path_out: Path to save the statistics to as netcdf (default: None)
+
+    Returns:
+        xarray dataset of the statistics (time: 1st of January of each year, lat, lon), which
+        can be aggregated to NUTS regions with eventsNuts
+    """
+
+    import os
+    from numpy import zeros, nonzero, isfinite, add, maximum, nan, vstack, asarray, \
+        int64, float32
+    from pandas import Timestamp
+    from xarray import Dataset
+    from .storage import isZarr, openClim, netcdfEncoding
+    from .geometries import latLonNames
+    from .climate_temporal import listFiles
+    from .instrument import stage, progress
+
+    var = thresholds.attrs.get("variable") if var is None else var
+    if years is None:
+        if isZarr(path_daily):
+            years = sorted(set(openClim(path_daily).time.dt.year.values.tolist()))
+        else:
+            files = listFiles(path_daily, name_prefix)
+            years = sorted(set(files[files.temp_res != "weekly"].year.values.tolist()))
+    years = sorted(years)
+
+    lat_name, lon_name = latLonNames(thresholds)
+    shape = (thresholds.sizes[lat_name], thresholds.sizes[lon_name])
+    n_cells = shape[0] * shape[1]
+    thr = thresholds.transpose("doy", lat_name, lon_name).values.reshape(365, n_cells)
+
+    names = ["n_events", "event_days", "max_duration", "total_intensity"]
+    stats = {x: zeros((len(years), n_cells)) for x in names}
+    valid = zeros(n_cells, dtype=bool)
+
+    def prepare(year):
+        da = readDaily(path_daily, var, [year], name_prefix)
+        if da is None:
+            return None
+        x = da.values.reshape(da.sizes["time"], n_cells)
+        anomaly = x - thr[noLeapDoy(da.time.values) - 1]
+        return {"year": year, "valid": isfinite(x).any(axis=0),
+                "exceed": anomaly > 0, "anomaly": anomaly}
+
+    with stage("detectEvents", var=var, years=len(years), cells=n_cells) as record:
+        carry_run, carry_sum = zeros(n_cells, dtype=int64), zeros(n_cells)
+        # Year of each day processed, to find the year the events started in
+        day_years = []
+        n_events = 0
+        previous_year = None
+        current = prepare(years[0])
+        for i in progress(range(len(years))):
+            following = prepare(years[i + 1]) if i + 1 < len(years) else None
+            if current is None:
+                # Missing year, the runs don't continue over it
+                carry_run, carry_sum = zeros(n_cells, dtype=int64), zeros(n_cells)
+                current = following
+                continue
+
+            if previous_year is None or current["year"] != previous_year + 1:
+                # Gap in the years (not in the archive or not selected), the runs don't
+                # continue over it
+                carry_run, carry_sum = zeros(n_cells, dtype=int64), zeros(n_cells)
+            previous_year = current["year"]
+
+            exceed, anomaly = current["exceed"], current["anomaly"]
+            valid |= current["valid"]
+            offset = len(day_years)
+            day_years += [i] * exceed.shape[0]
+            run, total = runLengths(exceed, anomaly, carry_run, carry_sum)
+
+            # Runs ending on each day (the first day of the next year decides the last one)
+            next_exceed = following["exceed"][:1] if following is not None and \
+                following["year"] == current["year"] + 1 else zeros((1, n_cells), dtype=bool)
+            ends = exceed & ~vstack([exceed[1:], next_exceed])
+
+            t, n = nonzero(ends & (run >= min_duration))
+            duration = run[t, n]
+            y = asarray(day_years)[offset + t - duration + 1]
+            add.at(stats["n_events"], (y, n), 1)
+            add.at(stats["event_days"], (y, n), duration)
+            maximum.at(stats["max_duration"], (y, n), duration)
+            add.at(stats["total_intensity"], (y, n), total[t, n])
+            n_events += len(t)
+
+            carry_run, carry_sum = run[-1], total[-1]
+            current = following
+
+        record["events"] = n_events
+
+    # Cells without data (eg. sea) are missing, not without events
+    for x in names:
+        stats[x][:, ~valid] = nan
+    stats["mean_intensity"] = stats["total_intensity"] / stats["event_days"]
+    stats["mean_intensity"][stats["event_days"] == 0] = nan
+
+    coords = {"time": [Timestamp(year, 1, 1) for year in years],
+              lat_name: thresholds[lat_name].values, lon_name: thresholds[lon_name].values}
+    ds = Dataset({x: (("time", lat_name, lon_name), v.reshape((len(years),) + shape).astype(float32))
+                  for x, v in stats.items()}, coords=coords)
+    ds.attrs = {"variable": var, "min_duration": min_duration,
+                "thresholds": thresholds.name or ""}
+
+    if path_out is not None:
+        ds.to_netcdf(f"{path_out}.tmp", encoding=netcdfEncoding(ds))
+        os.replace(f"{path_out}.tmp", path_out)
+
+    return ds
+
+
+# ------------------------------------------------------------------------------- #
+def eventsNuts(ds_events, nuts_shp, n_jobs=1, levels=None, weights=None):
+    """
+    Aggregates the gridded event statistics (see detectEvents) to the NUTS regions, through
+    getNutsClimAll (area weighted averages of the cells with data)
+
+    Args:
+        ds_events: Event statistics (xarray dataset or path to its netcdf)
+        nuts_shp: NUTS administrative level shapefile
+        n_jobs, levels, weights: see getNutsClimAll
+
+    Returns:
+        pandas dataframe of the NUTS level event statistics per year
+    """
+
+    from .geometries import getNutsClimAll
+
+    df = getNutsClimAll(ds_events, nuts_shp, n_jobs=n_jobs, levels=levels, weights=weights)
+
+    return df.assign(year=df.time.dt.year)
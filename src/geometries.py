@@ -29,6 +29,87 @@ def readNuts(shapefile="data-local/NUTS_RG_20M_2021_4326.shp/NUTS_RG_20M_2021_43
     return nuts_shp.reset_index(drop=True)
 
 
+# ------------------------------------------------------------------------------- # 
+def latLonNames(ds):
+    """
+    Returns the names of the latitude and longitude coordinates of a climate dataset
+    
+    Args:
+        ds: xarray dataset
+
+    Returns:
+        lat_name, lon_name: names of the latitude and longitude coordinates
+    """
+
+    lat_name, lon_name = None, None
+    for c in ds.coords:
+        if c in ["longitude", "Longitude", "lon", "Lon", "lons", "Lons"]:
+            lon_name = c
+        elif c in ["latitude", "Latitude", "lat", "Lat", "lats", "Lats"]:
+            lat_name = c
+
+    return lat_name, lon_name
+
+
+# ------------------------------------------------------------------------------- # 
+def nutsArea(nuts_shp, margin=0.1):
+    """
+    Returns the bounding box of the NUTS regions in a shapefile, in the same order as the
+    area argument of the CDS requests
+    
+    Args:
+        nuts_shp: NUTS administrative level shapefile (epsg 4326), eg. from readNuts
+        margin: Margin to add around the regions in degrees (default: 0.1)
+
+    Returns:
+        area: Bounding box [north, west, south, east]
+    """
+
+    west, south, east, north = nuts_shp.total_bounds
+
+    return [north + margin, west - margin, south - margin, east + margin]
+
+
+# ------------------------------------------------------------------------------- # 
+def cropDataset(ds, area=None, nuts_shp=None, margin=None):
+    """
+    Crops a climate dataset to a bounding box, or to the bounding box of a set of NUTS
+    regions. The grid cells partially covered by the bounding box are kept.
+    
+    Args:
+        ds: xarray dataset
+        area: Bounding box [north, west, south, east] (default: None)
+        nuts_shp: NUTS administrative level shapefile to derive the bounding box from,
+                  if area is not given (default: None)
+        margin: Margin to add around the bounding box in degrees (default: None, uses
+                the grid cell size)
+
+    Returns:
+        ds: cropped xarray dataset (the dataset as is if neither area or nuts_shp is set)
+    """
+
+    if area is None and nuts_shp is None:
+        return ds
+
+    lat_name, lon_name = latLonNames(ds)
+
+    # Grid cell size
+    if margin is None:
+        margin = float(abs(ds[lat_name].values[1] - ds[lat_name].values[0])) \
+            if ds.sizes[lat_name] > 1 else 0
+
+    north, west, south, east = area if area is not None else nutsArea(nuts_shp, margin=0)
+    north, west, south, east = north + margin, west - margin, south - margin, east + margin
+
+    # ERA5 datasets have descending latitudes
+    lats = ds[lat_name].values
+    lat_slice = slice(north, south) if lats[0] > lats[-1] else slice(south, north)
+    lons = ds[lon_name].values
+    lon_slice = slice(east, west) if lons[0] > lons[-1] else slice(west, east)
+
+    return ds.sel({lat_name: lat_slice, lon_name: lon_slice})
+
+
 # ------------------------------------------------------------------------------- # 
 def make_polygon(x, y, offset):
     """
@@ -42,26 +123,160 @@ def make_polygon(x, y, offset):
         polygon: Polygon shape (square)
     """
    
-    from shapely.geometry import Polygon
-    from shapely.validation import make_valid
-   
-    # Corners of Polygon
-    upper_left = (x+offset, y-offset)
-    upper_right = (x+offset, y+offset)
-    lower_left = (x-offset, y-offset)
-    lower_right = (x-offset, y+offset)
+    from shapely.geometry import box
+
+    return box(x - offset, y - offset, x + offset, y + offset)
+
+
+# ------------------------------------------------------------------------------- # 
+def gridSpacing(values, default=0.1):
+    """
+    Returns the spacing (degrees) of a regular latitude or longitude coordinate
+
+    Args:
+        values: Coordinate values
+        default: Spacing if the coordinate has a single value (default: 0.1)
+    """
+
+    from numpy import asarray, abs, diff
+
+    values = asarray(values, dtype=float)
+
+    return float(abs(diff(values)).min()) if len(values) > 1 else default
+
+
+# ------------------------------------------------------------------------------- # 
+def cellAreas(lats, lons):
+    """
+    Returns the true (spherical) area of the cells of a regular latitude/longitude grid,
+    R^2 * dlon * (sin(lat_north) - sin(lat_south)), which is ~20% smaller at 43N than at 33N
+
+    Args:
+        lats: Latitudes of the cell centres
+        lons: Longitudes of the cell centres
+
+    Returns:
+        numpy array (lat, lon) of the cell areas (km^2)
+    """
+
+    from numpy import asarray, radians, sin, clip, abs, outer, full
+
+    # Mean radius of the Earth (km)
+    R = 6371.0088
+
+    lats = asarray(lats, dtype=float)
+    dlat, dlon = gridSpacing(lats), gridSpacing(lons)
+    north = radians(clip(lats + dlat / 2, -90, 90))
+    south = radians(clip(lats - dlat / 2, -90, 90))
+
+    return outer(R ** 2 * abs(sin(north) - sin(south)), full(len(lons), radians(dlon)))
+
+
+# ------------------------------------------------------------------------------- # 
+def gridCells(lats, lons):
+    """
+    Returns the cells of a regular latitude/longitude grid as polygons
+
+    Args:
+        lats: Latitudes of the cell centres
+        lons: Longitudes of the cell centres
+
+    Returns:
+        geopandas dataframe (epsg 4326) with the lon, lat and area (km^2) of the cells
+    """
+
+    from numpy import asarray, meshgrid
+    from shapely.geometry import box
+    from geopandas import GeoDataFrame
+
+    dlat, dlon = gridSpacing(lats), gridSpacing(lons)
+    lat, lon = meshgrid(asarray(lats, dtype=float), asarray(lons, dtype=float), indexing="ij")
+    lat, lon = lat.ravel(), lon.ravel()
+
+    return GeoDataFrame({"lon": lon.round(4), "lat": lat.round(4),
+                         "cell_area": cellAreas(lats, lons).ravel()},
+                        geometry=[box(x - dlon / 2, y - dlat / 2, x + dlon / 2, y + dlat / 2)
+                                  for x, y in zip(lon, lat)],
+                        crs="EPSG:4326")
+
+
+# ------------------------------------------------------------------------------- # 
+def regionWeights(nuts_shp, cells):
+    """
+    Returns the area of the grid cells inside each NUTS region (see nutsWeights)
+    """
+
+    from numpy import asarray, concatenate, full
+    from pandas import DataFrame
+    from shapely.strtree import STRtree
+    from shapely.prepared import prep
+
+    # Cells intersecting each region from a spatial index of the cells (queried directly,
+    # geopandas.sjoin needs rtree or pygeos with shapely<2.0), then the intersections of
+    # all the pairs at once
+    cell_geoms = list(cells.geometry.values)
+    tree = STRtree(cell_geoms)
+    # Indices of the candidates (query returns them with shapely>=2.0)
+    query = getattr(tree, "query_items", tree.query)
+    cell_ind, nuts_ind = [full(0, 0, dtype=int)], [full(0, 0, dtype=int)]
+    for j, region in enumerate(nuts_shp.geometry.values):
+        region_prep = prep(region)
+        ind = [i for i in query(region) if region_prep.intersects(cell_geoms[i])]
+        cell_ind.append(asarray(ind, dtype=int))
+        nuts_ind.append(full(len(ind), j, dtype=int))
+    cell_ind, nuts_ind = concatenate(cell_ind), concatenate(nuts_ind)
+    geoms = cells.geometry.iloc[cell_ind].reset_index(drop=True)
+    inter = geoms.intersection(nuts_shp.geometry.iloc[nuts_ind].reset_index(drop=True))
+    # Fraction of the cell inside the region, times its true area
+    cover = (inter.area / geoms.area).values
+
+    weights = DataFrame({"nuts_id": nuts_shp.NUTS_ID.values[nuts_ind],
+                         "lon": cells.lon.values[cell_ind],
+                         "lat": cells.lat.values[cell_ind],
+                         "weight": cover * cells.cell_area.values[cell_ind]})
+
+    return weights[weights.weight > 0]
+
+
+# ------------------------------------------------------------------------------- # 
+def nutsWeights(lats, lons, nuts_shp, n_jobs=1):
+    """
+    Calculates the weights of the grid cells for the NUTS area averages: the true area
+    (km^2) of each cell inside each region. They only depend on the grid, so they can be
+    calculated once and used for all the datasets on the same grid (see getNutsClimAll).
+
+    Args:
+        lats: Latitudes of the grid
+        lons: Longitudes of the grid
+        nuts_shp: NUTS administrative level shapefile (epsg 4326)
+        n_jobs: Number of processes, each one calculates the weights of a part of the
+                regions (default: 1)
 
-    # Create Polygon shape and return it
-    polygon = Polygon([upper_left, upper_right, lower_left, lower_right])
+    Returns:
+        pandas dataframe with the nuts_id, lon, lat and weight of the cells in each region
+    """
 
-    if not polygon.is_valid:
-        polygon = make_valid(polygon)
+    from functools import partial
+    from multiprocessing import Pool
+    from numpy import array_split, arange
+    from pandas import concat
+    from .instrument import stage
 
-    return polygon
+    with stage("nutsWeights", cells=len(lats) * len(lons), n_regions=nuts_shp.shape[0]) as record:
+        cells = gridCells(lats, lons)
+        if n_jobs > 1 and nuts_shp.shape[0] > 1:
+            parts = [nuts_shp.iloc[x] for x in array_split(arange(nuts_shp.shape[0]), n_jobs)]
+            with Pool(n_jobs) as pool:
+                weights = concat(pool.map(partial(regionWeights, cells=cells), parts))
+        else:
+            weights = regionWeights(nuts_shp, cells)
+        record["rows"] = weights.shape[0]
+
+    return weights.reset_index(drop=True)
 
 
 # ------------------------------------------------------------------------------- # 
-def getNutsclim(nuts_ind, df, nuts_shp, coords):
+def getNutsclim(nuts_ind, df, nuts_shp, coords=None, weights=None):
     """
     Returns the NUTS level area averaged data for a given NUTS region
     
@@ -69,137 +284,209 @@ def getNutsclim(nuts_ind, df, nuts_shp, coords):
         nuts_ind: index of NUTS from the NUTS admin level shapefile
         df: Climate data pandas dataframe
         nuts_shp: NUTS administrative level shapefile (epsg 4326)
-        coords: coordinate shapefile from the climate dataset
+        coords: coordinate shapefile from the climate dataset (geopandas dataframe of the
+                grid cells with their lon and lat), used if weights is not set (default: None)
+        weights: Weights of the grid cells (see nutsWeights) (default: None, calculated
+                 from coords)
 
     Returns:
         pandas dataframe of the NUTS level area averaged climate variables
     """
 
-    from pandas import merge
+    nuts_id = nuts_shp.NUTS_ID.values[nuts_ind]
 
-    # Get the shape of the nuts region
-    nuts = nuts_shp.geometry.values[nuts_ind]
+    if weights is None:
+        if coords is None:
+            raise ValueError("Either the coords or the weights of the grid cells are needed")
+        # Weights of the cells of the region, from their true area
+        if "cell_area" not in coords.columns:
+            coords = coords.assign(cell_area=coords.to_crs(epsg=3035).area.values / 1e6)
+        weights = regionWeights(nuts_shp.iloc[[nuts_ind]],
+                                coords.assign(lon=coords.lon.round(4), lat=coords.lat.round(4)))
 
-    # Get the intersecting members of the coords dataset
-    coords_inter = coords[coords.intersects(nuts)]
-    coords_inter.reset_index(drop=True, inplace=True)
-    # Get the shape of the intersections
-    coords_inter = coords_inter.assign(surf_area=coords_inter.area,
-                                    area_inter=coords_inter.intersection(nuts).area)
-    # Get the percentage cover and the centroid of the grid boxes
-    coords_inter = coords_inter.assign(perc_cover=coords_inter.area_inter/coords_inter.surf_area,
-                                    lon=coords_inter.centroid.x.round(3),
-                                    lat=coords_inter.centroid.y.round(3))
+    return weightedMeans(df, weights[weights.nuts_id == nuts_id])
 
 
-    df = df.assign(lon=df.lon.round(3), lat=df.lat.round(3))
+# ------------------------------------------------------------------------------- # 
+def weightedMeans(df, weights, valid_weights=False):
+    """
+    Returns the area weighted averages of the climate variables for each NUTS region. The
+    cells with missing values (eg. sea in ERA5-land) are not counted.
 
-    # Add the percentage coverage column
-    df = merge(df, coords_inter[['lon', 'lat', 'perc_cover']], on=['lon', 'lat'], how='left')
-    df.dropna(inplace=True)
+    Args:
+        df: Climate data pandas dataframe (time, lon, lat and the variables)
+        weights: Weights of the grid cells (see nutsWeights)
+        valid_weights: Also return the total weight of the cells with data behind each
+                       average (default: False)
 
-    # normalise the percentage coverage for the grid cells in the df dataframe
-    grid_points = df.groupby(['lon', 'lat', 'perc_cover'], as_index=False).size().drop('size', axis=1)
-    grid_points = grid_points.assign(perc_cover=grid_points.perc_cover/grid_points.perc_cover.sum())
-    # Add it back to df
-    df = merge(df.drop('perc_cover', axis=1), grid_points, on=['lon', 'lat'], how='left')
+    Returns:
+        pandas dataframe of the NUTS level area averaged climate variables (and the
+        dataframe of the total weights, with the same columns, if valid_weights is set)
+    """
 
-    # Normalise the variables
-    for var in df.drop(['lon', 'lat', 'time', 'perc_cover'], axis=1).columns:
-        df[var] = df[var] * df['perc_cover']
+    variables = [x for x in df.columns if x not in ["time", "lon", "lat"]]
 
-    # Get the area averaged totals
-    df_clim = df.drop(['lon', 'lat', 'perc_cover'], axis=1).groupby('time', as_index=False).sum()
+    df = df.assign(lon=df.lon.round(4), lat=df.lat.round(4))
+    df = df.merge(weights[["nuts_id", "lon", "lat", "weight"]], on=["lon", "lat"], how="inner")
 
-    # Add the nuts_id
-    df_clim = df_clim.assign(nuts_id=nuts_shp.NUTS_ID.values[nuts_ind])
+    keys = [df.nuts_id, df.time]
+    valid = df[variables].notna().mul(df.weight, axis=0).groupby(keys).sum()
+    df_clim = df[variables].mul(df.weight, axis=0).groupby(keys).sum(min_count=1) / valid
+    df_clim = df_clim.reset_index().dropna(subset=variables, how="all")
+    df_clim = df_clim[["time"] + variables + ["nuts_id"]]
 
+    if valid_weights:
+        return df_clim, valid.reset_index()[["time"] + variables + ["nuts_id"]]
     return df_clim
 
 
 # ------------------------------------------------------------------------------- # 
-def getNutsClimAll(path_nc, nuts_shp, n_jobs=1):
+def getNutsClimAll(path_nc, nuts_shp, n_jobs=1, crop=True, levels=None, weights=None):
     """
     Calculates the NUTS area average climage dataset for a given netcdf file
 
     Args:
-        path_nc: path to the netcdf dataset
+        path_nc: path to the netcdf dataset (or zarr store)
         nuts_shp: NUTS administrative level shapefile
-        n_jobs: Number of parallel processes to open to calculate the NUTS 
-                area averaged climate data
+        n_jobs: Number of parallel processes to open to calculate the weights of the
+                grid cells (see nutsWeights)
+        crop: Crop the dataset to the bounding box of the NUTS regions before converting
+              it to a dataframe (default: True)
+        levels: NUTS levels to return, eg. [0, 1, 2, 3]. Only the NUTS3 regions of nuts_shp
+                are intersected with the grid, the other levels are aggregated from them
+                (see rollupNuts) (default: None, the regions of nuts_shp as they are)
+        weights: Weights of the grid cells from nutsWeights, to reuse them for datasets on
+                 the same grid (default: None, calculated)
 
     Returns:
-        df_clim: pandas dataframe which hold the NUTS level averaged climate data
+        df_clim: pandas dataframe which hold the NUTS level averaged climate data (with a
+                 level column if levels is set)
     """
 
     import warnings
-    from xarray import open_dataset
-    from pandas import DataFrame, concat
-    from tqdm import tqdm
-    from geopandas import GeoDataFrame
     from gc import collect
-    from multiprocessing import Pool
-    from functools import partial
-    from numpy import arange
+    from .storage import openClim
+    from .instrument import stage
     warnings.filterwarnings('ignore')
 
-    # Open the netcdf file into an xarray
-    ds = open_dataset(path_nc)
+    # Roll-up mode, the higher levels are derived from the NUTS3 averages
+    if levels is not None:
+        nuts_shp = nuts_shp[nuts_shp.LEVL_CODE == 3].reset_index(drop=True)
 
-    # Coordinate names
-    if "time_bnds" in ds.variables:
-        ds = ds.drop("time_bnds")
-    coord_names = ds.coords
-    for c in coord_names:
-        if c in ["longitude", "Longitude", "lon", "Lon", "lons", "Lons"]:
-            ds = ds.rename({c: 'lon'})
-        elif c in ["latitude", "Latitude", "lat", "Lat", "lats", "Lats"]:
-            ds = ds.rename({c: 'lat'})
-
-    # Get the grid cell size
-    grid_size = round(abs(ds.lat.values[1] - ds.lat.values[0]) / 2, 3)
-
-    # Create a dataframe of the coordinates
-    coords = DataFrame()
-    for lon in tqdm(ds.lon.values):
-        for lat in ds.lat.values:
-            coords = concat([coords, DataFrame({"lon": [lon], "lat": [lat]})])
-
-    coords.reset_index(drop=True, inplace=True)
-    # Round the numbers
-    coords = coords.round(1)
-
-    # Create a Polygon array based on the x, y positions of the centres and the grid_size
-    geometries = coords.apply(lambda x: make_polygon(x.lon, x.lat, grid_size), axis=1)
-    coords['geometry'] = geometries
-    coords = GeoDataFrame(coords)
-
-    # Set the projection
-    coords = coords.set_crs(epsg=4326)
-
-    # Convert xarray to pandas dataframe
-    df = ds.to_dataframe().reset_index(drop=False)
-
-    # Delete variables that are not needed anymore and run garbage collection
-    del ds, coord_names, c, geometries
-    collect()
-
-    # Run sequentially or parallel (if n_jobs > 1)
-    if n_jobs > 1:
-        pool = Pool(n_jobs)
-        df_clim = concat(pool.map(partial(getNutsclim, df=df, nuts_shp=nuts_shp,
-                                          coords=coords), 
-                                  arange(nuts_shp.shape[0])))
-        pool.close()
-        pool.join()
-    else:
-        df_clim = DataFrame()
-        for ind in tqdm(arange(nuts_shp.shape[0])):
-            df_clim = concat([df_clim, getNutsclim(nuts_ind=ind,
-                                                   df=df, nuts_shp=nuts_shp,
-                                                   coords=coords)])
-
-    return df_clim.reset_index(drop=True)
-
-
-# ------------------------------------------------------------------------------- # 
\ No newline at end of file
+    # Record the metrics of the stage
+    with stage("getNutsClimAll", file=path_nc if isinstance(path_nc, str) else None,
+               n_regions=nuts_shp.shape[0]) as record:
+        # Open the netcdf file (or zarr store) into an xarray
+        ds = openClim(path_nc)
+
+        # Coordinate names
+        if "time_bnds" in ds.variables:
+            ds = ds.drop("time_bnds")
+        lat_name, lon_name = latLonNames(ds)
+        ds = ds.rename({lat_name: "lat", lon_name: "lon"})
+
+        # Only keep the grid cells around the NUTS regions
+        if crop:
+            ds = cropDataset(ds, nuts_shp=nuts_shp)
+
+        # Area of the grid cells inside each region
+        if weights is None:
+            weights = nutsWeights(ds.lat.values, ds.lon.values, nuts_shp, n_jobs=n_jobs)
+        weights = weights[weights.nuts_id.isin(nuts_shp.NUTS_ID.values)]
+
+        # Convert xarray to pandas dataframe
+        df = ds[list(ds.data_vars)].to_dataframe().reset_index(drop=False)
+        df = df[["time", "lon", "lat"] + list(ds.data_vars)]
+        record["cells"] = df.shape[0]
+
+        # Delete variables that are not needed anymore and run garbage collection
+        del ds
+        collect()
+
+        df_clim = weightedMeans(df, weights, valid_weights=levels is not None)
+        if levels is not None:
+            # Weighted by the area of the cells with data behind each NUTS3 average
+            df_clim, df_weights = df_clim
+            df_clim = rollupNuts(df_clim.reset_index(drop=True), nuts_shp, levels=levels,
+                                 weights=df_weights)
+        record["rows"] = df_clim.shape[0]
+
+        return df_clim.reset_index(drop=True)
+
+
+# ------------------------------------------------------------------------------- # 
+def nutsAreas(nuts_shp):
+    """
+    Returns the area of each NUTS region, calculated in the ETRS89-LAEA equal area
+    projection (epsg 3035)
+
+    Args:
+        nuts_shp: NUTS administrative level shapefile
+
+    Returns:
+        pandas series of the areas (km^2), indexed by the NUTS_ID
+    """
+
+    from pandas import Series
+
+    return Series(nuts_shp.to_crs(epsg=3035).area.values / 1e6, index=nuts_shp.NUTS_ID.values)
+
+
+# ------------------------------------------------------------------------------- # 
+def rollupNuts(df_clim, nuts_shp, levels=[0, 1, 2, 3], weights=None):
+    """
+    Aggregates the NUTS3 area averaged climate data to the higher NUTS levels. NUTS2, NUTS1
+    and NUTS0 regions are unions of NUTS3 regions whose NUTS_ID starts with their own
+    (eg. CY000 -> CY00 -> CY0 -> CY), so their averages are the averages of their NUTS3
+    regions weighted by the area of the grid cells behind each of them (the same as the
+    average of all their cells).
+
+    Args:
+        df_clim: NUTS3 area averaged climate data (see getNutsClimAll)
+        nuts_shp: NUTS3 administrative level shapefile used for df_clim
+        levels: NUTS levels to return (default: [0, 1, 2, 3])
+        weights: Weights of the NUTS3 averages: the total weight of the cells with data
+                 behind each one (see weightedMeans), or the weights of the grid cells
+                 (see nutsWeights), summed for each region (default: None, the EPSG:3035
+                 area of the whole regions)
+
+    Returns:
+        pandas dataframe of the area averaged climate data of all the levels, with a
+        level column
+    """
+
+    from pandas import concat, DataFrame
+    from .instrument import stage
+
+    variables = [x for x in df_clim.columns if x not in ["time", "nuts_id"]]
+
+    with stage("rollupNuts", n_regions=df_clim.nuts_id.nunique(), levels=list(levels)) as record:
+        df = df_clim.reset_index(drop=True)
+        if weights is not None and "time" in weights.columns:
+            area = df[["time", "nuts_id"]].merge(weights, on=["time", "nuts_id"],
+                                                 how="left")[variables].set_axis(df.index)
+        else:
+            areas = nutsAreas(nuts_shp) if weights is None else \
+                weights.groupby("nuts_id").weight.sum()
+            area = DataFrame({var: df.nuts_id.map(areas).values for var in variables},
+                             index=df.index)
+        # Weighted sums, the weights of the missing values are not counted
+        weights = area.where(df[variables].notna(), 0)
+        weighted = df[variables].mul(weights)
+
+        out = []
+        for level in sorted(levels):
+            if level == 3:
+                out.append(df_clim.assign(level=3))
+                continue
+            keys = [df.time, df.nuts_id.str[:level + 2]]
+            df_level = weighted.groupby(keys).sum(min_count=1) / weights.groupby(keys).sum()
+            out.append(df_level.reset_index().assign(level=level))
+
+        df_out = concat(out)[["time", "nuts_id", "level"] + variables]
+        record["rows"] = df_out.shape[0]
+
+    return df_out.sort_values(by=["level", "nuts_id", "time"]).reset_index(drop=True)
+
+
+# ------------------------------------------------------------------------------- # 
@@ -0,0 +1,239 @@
+# ------------------------------------------------------------------------------- #
+# Stage level instrumentation: wall time, bytes read/written, cells/rows processed
+# and peak RSS (sampled) of the pipeline stages, emitted through the emme_roch logger and
+# (optionally) to a callback and/or a JSON-lines file
+# ------------------------------------------------------------------------------- #
+
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger("emme_roch")
+
+# Metrics sinks (callbacks and JSON-lines files) and the tqdm progress bar switch
+_sinks = {"callbacks": [], "jsonl": []}
+_progress = {"enabled": True}
+_lock = threading.Lock()
+
+# Seconds between the RSS samples of a stage
+RSS_INTERVAL = 0.1
+
+
+# ------------------------------------------------------------------------------- #
+def setMetricsSink(callback=None, path_jsonl=None, append=True):
+    """
+    Sets where the stage metrics records are sent to, in addition to the emme_roch logger
+
+    Args:
+        callback: Function called with each metrics record (dictionary) (default: None)
+        path_jsonl: Path to a JSON-lines file to append the metrics records to (default: None)
+        append: Add the sinks to the existing ones, otherwise replaces them (default: True)
+    """
+
+    with _lock:
+        if not append:
+            _sinks["callbacks"], _sinks["jsonl"] = [], []
+        if callback is not None:
+            _sinks["callbacks"].append(callback)
+        if path_jsonl is not None:
+            _sinks["jsonl"].append(path_jsonl)
+
+
+# ------------------------------------------------------------------------------- #
+def setProgress(enabled=True):
+    """
+    Switches the tqdm progress bars of the pipeline functions on or off
+
+    Args:
+        enabled: Show the progress bars (default: True)
+    """
+
+    _progress["enabled"] = enabled
+
+
+# ------------------------------------------------------------------------------- #
+def progress(iterable, **kwargs):
+    """
+    Wraps an iterable in a tqdm progress bar, unless the progress bars are switched off
+
+    Args:
+        iterable: Iterable to loop through
+        kwargs: Keyword arguments for tqdm
+
+    Returns:
+        iterable
+    """
+
+    if not _progress["enabled"]:
+        return iterable
+
+    from tqdm import tqdm
+
+    return tqdm(iterable, **kwargs)
+
+
+# ------------------------------------------------------------------------------- #
+def peakRSS():
+    """
+    Returns the peak resident set size of the process so far (its lifetime high-water mark,
+    not the peak of a stage, see currentRSS) in MB (None if not available)
+    """
+
+    import sys
+
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except Exception:
+        return None
+
+    # Bytes on macOS, kilobytes on Linux
+    return rss / 1e6 if sys.platform == "darwin" else rss / 1e3
+
+
+# ------------------------------------------------------------------------------- #
+def currentRSS():
+    """
+    Returns the current resident set size of the process in MB, from psutil if it's
+    installed or /proc (None if not available)
+    """
+
+    import os
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1e6
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except Exception:
+        return None
+
+
+# ------------------------------------------------------------------------------- #
+def fileSize(path):
+    """
+    Returns the size of a file (or zarr store) in bytes, 0 if it doesn't exist
+    """
+
+    import os
+    from .storage import datasetSize
+
+    return datasetSize(path) if os.path.exists(path) else 0
+
+
+# ------------------------------------------------------------------------------- #
+def emit(record, level=logging.INFO):
+    """
+    Sends a metrics record to the emme_roch logger and the metrics sinks
+
+    Args:
+        record: Metrics record (dictionary)
+        level: Logging level (default: INFO)
+    """
+
+    import json
+
+    logger.log(level, " ".join(f"{k}={v}" for k, v in record.items()),
+               extra={"metrics": record})
+
+    with _lock:
+        callbacks, files = list(_sinks["callbacks"]), list(_sinks["jsonl"])
+        for path in files:
+            with open(path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    for callback in callbacks:
+        try:
+            callback(record)
+        except Exception as e:
+            logger.error(f"Metrics callback failed because of: {e}")
+
+
+# ------------------------------------------------------------------------------- #
+@contextmanager
+def stage(name, **fields):
+    """
+    Context manager which records the wall time, status and peak RSS of a stage (or of one
+    file processed in a stage) and emits the record when the stage finishes. The peak RSS
+    of the stage is sampled every RSS_INTERVAL seconds while it runs (process_max_rss_mb is
+    the peak of the whole process so far). The record is yielded, so counters (bytes_read,
+    bytes_written, cells, rows) can be added to it.
+
+    Example:
+        with stage("hourly_to_daily", file=f) as record:
+            ...
+            record["cells"] = ds.t2m.size
+
+    Args:
+        name: Name of the stage
+        fields: Additional fields for the record (eg. file, year, month)
+
+    Yields:
+        record: metrics record (dictionary)
+    """
+
+    from time import perf_counter
+    from datetime import datetime
+
+    record = {"stage": name, **fields,
+              "start": datetime.now().isoformat(timespec="seconds")}
+
+    # Peak RSS of the stage, sampled in a background thread
+    peak = {"rss": currentRSS()}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(RSS_INTERVAL):
+            rss = currentRSS()
+            if rss is not None and (peak["rss"] is None or rss > peak["rss"]):
+                peak["rss"] = rss
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    t0 = perf_counter()
+    try:
+        yield record
+        record.setdefault("status", "ok")
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["wall_s"] = round(perf_counter() - t0, 4)
+        done.set()
+        sampler.join()
+        rss = currentRSS()
+        if rss is not None and (peak["rss"] is None or rss > peak["rss"]):
+            peak["rss"] = rss
+        record["peak_rss_mb"] = None if peak["rss"] is None else round(peak["rss"], 1)
+        record["process_max_rss_mb"] = peakRSS()
+        emit(record, level=logging.ERROR if record["status"] in ["error", "failed"] else logging.INFO)
+
+
+# ------------------------------------------------------------------------------- #
+def logMissingDates(df_data_complete, stage_name):
+    """
+    Warns about the missing months found by checkYears and emits them as a metrics record
+
+    Args:
+        df_data_complete: Output of checkYears (pandas dataframe or None)
+        stage_name: Name of the stage the check was performed in
+    """
+
+    from warnings import warn
+
+    if df_data_complete is None:
+        return
+
+    missing = {int(year): [int(m) for m in months] for year, months in
+               zip(df_data_complete.year.values, df_data_complete.months_missing.values)}
+    warn(f"\n        WARNING: There are missing dates in the datasets: {missing}\n")
+    emit({"stage": stage_name, "event": "missing_dates", "missing": missing},
+         level=logging.WARNING)
+
+
+# ------------------------------------------------------------------------------- #
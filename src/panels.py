@@ -0,0 +1,137 @@
+# ------------------------------------------------------------------------------- #
+# NUTS level climate (and Eurostat) panels as Parquet datasets, partitioned by NUTS level,
+# country and year, with float32 variables and categorical IDs. The readers push the
+# filters (NUTS IDs, dates, variables) down to the scan, so only the matching partitions,
+# row groups and columns are read.
+# ------------------------------------------------------------------------------- #
+
+# Partition columns of the panels (derived from the nuts_id and time columns)
+PARTITIONS = ["level", "country", "year"]
+
+
+# ------------------------------------------------------------------------------- #
+def writePanel(df, path, partitions=PARTITIONS):
+    """
+    Writes a NUTS level panel (eg. from getNutsClimAll or mergeEurostatClim) to a Parquet
+    dataset. The rows of df are merged with the existing rows of the partitions they fall
+    in (the rows with the same IDs and time are replaced), so updated weeks can be written
+    without rewriting the rest of the dataset or losing the rest of their year.
+
+    Args:
+        df: Pandas dataframe with the nuts_id and time columns
+        path: Path to the Parquet dataset (directory)
+        partitions: Partition columns (default: level, country and year)
+
+    Returns:
+        number of rows written (including the existing rows rewritten)
+    """
+
+    import os
+    import pyarrow as pa
+    import pyarrow.dataset as pds
+    from pandas import to_datetime, concat
+    from .instrument import stage
+
+    with stage("writePanel", path=path, rows=df.shape[0]) as record:
+        df = df.assign(time=to_datetime(df.time.values))
+        if "level" not in df.columns:
+            df = df.assign(level=df.nuts_id.astype(str).str.len() - 2)
+        df = df.assign(country=df.nuts_id.astype(str).str[:2], year=df.time.dt.year)
+
+        # Existing rows of the partitions being written, which are rewritten with them
+        record["rows_kept"] = 0
+        if os.path.isdir(path) and len(os.listdir(path)) > 0:
+            keys = [col for col in df.columns if col not in partitions and
+                    df[col].dtype.kind != "f"]
+            filters = None
+            for values in df[partitions].drop_duplicates().to_dict("records"):
+                x = None
+                for col, v in values.items():
+                    x = pds.field(col) == v if x is None else x & (pds.field(col) == v)
+                filters = x if filters is None else filters | x
+            existing = pds.dataset(path, format="parquet", partitioning="hive") \
+                .to_table(filter=filters).to_pandas()
+            n_new = df.shape[0]
+            df = concat([existing, df], ignore_index=True) \
+                .drop_duplicates(subset=keys, keep="last")
+            record["rows_kept"] = df.shape[0] - n_new
+        df = df.assign(level=df.level.astype("int8"), country=df.country.astype(str),
+                       year=df.year.astype("int16"))
+
+        # float32 variables and categorical IDs
+        for col in df.columns:
+            if df[col].dtype == "float64":
+                df[col] = df[col].astype("float32")
+            elif df[col].dtype == "object" and col not in partitions:
+                df[col] = df[col].astype("category")
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pds.write_dataset(table, path, format="parquet",
+                          partitioning=pds.partitioning(
+                              pa.schema([table.schema.field(x) for x in partitions]),
+                              flavor="hive"),
+                          existing_data_behavior="delete_matching")
+        record["columns"] = len(df.columns)
+
+    return df.shape[0]
+
+
+# ------------------------------------------------------------------------------- #
+def readPanel(path, nuts_ids=None, start=None, end=None, variables=None, where=None):
+    """
+    Reads a NUTS level panel from a Parquet dataset (see writePanel), reading only the
+    partitions, row groups and columns which match the filters
+
+    Args:
+        path: Path to the Parquet dataset
+        nuts_ids: NUTS IDs to read, of any level (default: None, all of them)
+        start: First date to read (default: None)
+        end: Last date to read (default: None)
+        variables: Variables (float columns) to read, the ID columns are always read
+                   (default: None, all of them)
+        where: Dictionary of other column: list of values to read, eg. {"age": ["TOTAL"]}
+               (default: None)
+
+    Returns:
+        pandas dataframe of the panel
+    """
+
+    import pyarrow as pa
+    import pyarrow.dataset as pds
+    from pandas import Timestamp
+    from .instrument import stage
+
+    dataset = pds.dataset(path, format="parquet", partitioning="hive")
+
+    # The partitions of the NUTS IDs and dates are skipped without being opened
+    expr = []
+    if nuts_ids is not None:
+        nuts_ids = list(nuts_ids)
+        expr += [pds.field("level").isin(sorted({len(x) - 2 for x in nuts_ids})),
+                 pds.field("country").isin(sorted({x[:2] for x in nuts_ids})),
+                 pds.field("nuts_id").isin(nuts_ids)]
+    if start is not None:
+        expr += [pds.field("year") >= Timestamp(start).year,
+                 pds.field("time") >= pa.scalar(Timestamp(start).to_pydatetime(),
+                                                type=dataset.schema.field("time").type)]
+    if end is not None:
+        expr += [pds.field("year") <= Timestamp(end).year,
+                 pds.field("time") <= pa.scalar(Timestamp(end).to_pydatetime(),
+                                                type=dataset.schema.field("time").type)]
+    for col, values in (where or {}).items():
+        expr.append(pds.field(col).isin(list(values)))
+    filters = None
+    for x in expr:
+        filters = x if filters is None else filters & x
+
+    # ID columns and the selected variables
+    columns = None
+    if variables is not None:
+        columns = [f.name for f in dataset.schema if not pa.types.is_floating(f.type)
+                   or f.name in variables]
+
+    with stage("readPanel", path=path) as record:
+        df = dataset.to_table(columns=columns, filter=filters).to_pandas()
+        record["rows"] = df.shape[0]
+
+    return df.sort_values(by=["nuts_id", "time"]).reset_index(drop=True)
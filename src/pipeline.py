@@ -0,0 +1,547 @@
+# ------------------------------------------------------------------------------- #
+# Incremental pipeline runner: raw monthly CDS datasets -> hurs/wb -> daily -> weekly
+# -> NUTS averaged climate data -> Eurostat merge. The inputs (size, mtime) and the
+# parameters of each output are recorded in a manifest in the working directory, so
+# only the outputs affected by a new or changed month are rebuilt
+# ------------------------------------------------------------------------------- #
+
+MANIFEST = "pipeline_manifest.json"
+
+
+# ------------------------------------------------------------------------------- #
+def signature(path):
+    """
+    Returns the [size, mtime_ns] signature of a file (None if it doesn't exist)
+    """
+
+    import os
+
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+# ------------------------------------------------------------------------------- #
+def paramsHash(params):
+    """
+    Returns a short hash of the parameters (dictionary) an output was created with
+    """
+
+    import json
+    import hashlib
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+# ------------------------------------------------------------------------------- #
+def nutsKey(nuts_shp):
+    """
+    Returns a hash of the NUTS regions (IDs and geometries), to detect changes in them
+    """
+
+    import hashlib
+
+    h = hashlib.sha1()
+    h.update(",".join(nuts_shp.NUTS_ID.astype(str).values).encode())
+    for geom in nuts_shp.geometry.values:
+        h.update(geom.wkb)
+    return h.hexdigest()[:16]
+
+
+# ------------------------------------------------------------------------------- #
+def readManifest(path_work):
+    """
+    Reads the manifest of the pipeline outputs in path_work (empty if it doesn't exist)
+    """
+
+    import os
+    import json
+
+    path = os.path.join(path_work, MANIFEST)
+    if not os.path.isfile(path):
+        return {"outputs": {}, "pending_weeks": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+# ------------------------------------------------------------------------------- #
+def writeManifest(path_work, manifest):
+    """
+    Writes the manifest of the pipeline outputs (atomically, so a crash can't corrupt it)
+    """
+
+    import os
+    import json
+
+    path = os.path.join(path_work, MANIFEST)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+# ------------------------------------------------------------------------------- #
+def staleReason(manifest, output, inputs, params):
+    """
+    Checks if an output needs to be (re)built
+
+    Args:
+        manifest: Pipeline manifest (see readManifest)
+        output: Path of the output
+        inputs: List of the paths of the inputs of the output
+        params: Hash of the parameters of the output
+
+    Returns:
+        reason the output is stale (str) or None if it's up to date
+    """
+
+    import os
+
+    if not os.path.exists(output):
+        return "missing"
+    entry = manifest["outputs"].get(output)
+    if entry is None:
+        return "not in manifest"
+    if entry["params"] != params:
+        return "parameters changed"
+    if entry["inputs"] != {x: signature(x) for x in inputs}:
+        return "inputs changed"
+    return None
+
+
+# ------------------------------------------------------------------------------- #
+def affectedWeeks(year, month):
+    """
+    Returns the weeks (Mondays) which contain days of a month
+    """
+
+    from pandas import Timestamp, Timedelta, date_range
+
+    start = Timestamp(year=year, month=month, day=1)
+    end = start + Timedelta(days=start.days_in_month)
+    return date_range(start - Timedelta(days=start.weekday()), end - Timedelta(days=1),
+                      freq="W-MON")
+
+
+# ------------------------------------------------------------------------------- #
+def weeklyUpdate(files, path_weekly, months=None, encoding=None, daily=False):
+    """
+    Calculates the weekly means (weeks starting on a Monday) of the weeks affected by
+    the given months and splices them into an existing weekly dataset, so only the
+    changed months are read. The first (partial) week of the data is dropped, as in weekly_cdo,
+    and so is the last one until all its days are available.
+
+    Args:
+        files: Pandas dataframe with the year, month and path of the hourly (or daily) datasets
+        path_weekly: Path to the weekly dataset
+        months: List of (year, month) tuples that changed, all of them if None (default: None)
+        encoding: Encoding policy for the output (see storage.ENCODING) (default: None)
+        daily: The datasets are daily (see hourly_to_daily), tp is summed and t2m_min/t2m_max
+               are the minimum/maximum of the week instead of averaged (see weeklyStats)
+               (default: False)
+
+    Returns:
+        list of the updated weeks (iso format)
+    """
+
+    import os
+    from pandas import Timestamp, Timedelta, DatetimeIndex
+    from xarray import open_dataset, concat
+    from .storage import netcdfEncoding
+    from .climate_temporal import weeklyStats, completeWeeks
+
+    files = files.sort_values(by=["year", "month"]).reset_index(drop=True)
+    if months is None or not os.path.isfile(path_weekly):
+        months = list(zip(files.year.values, files.month.values))
+        old = None
+    else:
+        with open_dataset(path_weekly) as ds_old:
+            old = ds_old.load()
+
+    # The weeks to recompute, from the first Monday of the data
+    weeks = DatetimeIndex(sorted(set().union(*[affectedWeeks(y, m) for y, m in months])))
+    start = Timestamp(year=files.year.values[0], month=files.month.values[0], day=1)
+    weeks = weeks[weeks >= start + Timedelta(days=(7 - start.weekday()) % 7)]
+    if len(weeks) == 0:
+        return []
+
+    # Month start/end of each file, to read only the files overlapping a week
+    starts = [affectedWeeks(y, m)[0] for y, m in zip(files.year.values, files.month.values)]
+    ends = [affectedWeeks(y, m)[-1] + Timedelta(days=7)
+            for y, m in zip(files.year.values, files.month.values)]
+
+    # Process the weeks in groups (one per month of their Monday) to limit the memory
+    pieces = []
+    for _, group in weeks.to_series().groupby([weeks.year, weeks.month]):
+        t0, t1 = group.index[0], group.index[-1] + Timedelta(days=7)
+        dss = []
+        for path, s, e in zip(files.path.values, starts, ends):
+            if s < t1 and e > t0:
+                with open_dataset(path) as ds:
+                    dss.append(ds.sel(time=slice(t0, t1 - Timedelta(seconds=1))).load())
+        ds = concat(dss, dim="time").sortby("time")
+        ds = weeklyStats(ds) if daily else \
+            ds.resample(time="W-MON", closed="left", label="left").mean() \
+            .sel(time=completeWeeks(ds.time.values))
+        pieces.append(ds.sel(time=ds.time.isin(group.index)))
+        del dss, ds
+
+    ds_new = concat(pieces, dim="time")
+    if old is not None:
+        # The recomputed weeks replace the old ones (a previously partial week is removed)
+        ds_new = concat([old.sel(time=~old.time.isin(weeks.values)), ds_new],
+                        dim="time").sortby("time")
+
+    # Write it next to the old one and replace it
+    ds_new.to_netcdf(f"{path_weekly}.tmp", encoding=netcdfEncoding(ds_new, encoding=encoding))
+    os.replace(f"{path_weekly}.tmp", path_weekly)
+
+    return [str(x.date()) for x in weeks[weeks.isin(ds_new.time.values)]]
+
+
+# ------------------------------------------------------------------------------- #
+def nutsUpdate(path_weekly, path_nuts, nuts_shp, weeks=None, n_jobs=1, crop=True, levels=None):
+    """
+    Calculates the NUTS area averaged climate data of the given weeks and merges them into
+    an existing NUTS level dataset (pickled pandas dataframe)
+
+    Args:
+        path_weekly: Path to the weekly dataset
+        path_nuts: Path to the NUTS level dataset (pickle)
+        nuts_shp: NUTS administrative level shapefile
+        weeks: List of the weeks to (re)calculate, all of them if None (default: None)
+        n_jobs: Number of processes for getNutsClimAll (default: 1)
+        crop: Crop the dataset to the NUTS regions (default: True)
+        levels: NUTS levels to aggregate the NUTS3 regions to (see rollupNuts) (default: None)
+
+    Returns:
+        number of rows updated
+    """
+
+    import os
+    from pandas import concat, read_pickle, to_datetime
+    from .storage import openClim
+    from .geometries import getNutsClimAll
+
+    if weeks is not None and len(weeks) == 0:
+        return 0
+
+    ds = openClim(path_weekly)
+    df_old = None
+    if weeks is not None and os.path.isfile(path_nuts):
+        weeks = to_datetime(weeks)
+        ds = ds.sel(time=ds.time.isin(weeks.values))
+        df_old = read_pickle(path_nuts)
+        df_old = df_old[~df_old.time.isin(weeks)]
+
+    df_clim = getNutsClimAll(ds, nuts_shp, n_jobs=n_jobs, crop=crop, levels=levels)
+    rows = df_clim.shape[0]
+    if df_old is not None:
+        df_clim = concat([df_old, df_clim])
+    df_clim = df_clim.sort_values(by=["nuts_id", "time"]).reset_index(drop=True)
+
+    df_clim.to_pickle(f"{path_nuts}.tmp")
+    os.replace(f"{path_nuts}.tmp", path_nuts)
+
+    return rows
+
+
+# ------------------------------------------------------------------------------- #
+def eurostatUpdate(dataset, path_nuts, path_cache, path_out, refresh=False):
+    """
+    Downloads a weekly Eurostat dataset (cached) and combines it with the NUTS level
+    climate dataset
+
+    Args:
+        dataset: Eurostat dataset identifier
+        path_nuts: Path to the NUTS level climate dataset (pickle)
+        path_cache: Path to cache the Eurostat dataset in (gzipped TSV, see downloadEurostat)
+        path_out: Path to save the combined dataset to (pickle)
+        refresh: Download the Eurostat dataset again (default: False)
+    """
+
+    import os
+    from pandas import read_pickle
+    from .eurostat_data import downloadEurostat, readEurostat, mergeEurostatClim
+
+    if refresh or not os.path.isfile(path_cache):
+        downloadEurostat(dataset, path_cache)
+
+    # Only the rows of the NUTS regions of the climate dataset are read
+    df_clim = read_pickle(path_nuts)
+    df = mergeEurostatClim(readEurostat(path_cache, geo=df_clim.nuts_id.unique()), df_clim)
+    df.to_pickle(f"{path_out}.tmp")
+    os.replace(f"{path_out}.tmp", path_out)
+
+
+# ------------------------------------------------------------------------------- #
+def runTask(name, func, kwargs):
+    """
+    Runs a pipeline task (in a worker process) and records its metrics
+    """
+
+    from .instrument import stage
+
+    with stage(f"pipeline.{name.split('/')[0]}", task=name):
+        return func(**kwargs)
+
+
+# ------------------------------------------------------------------------------- #
+def runTasks(tasks, n_jobs=1, on_done=None):
+    """
+    Runs a graph of tasks, each as soon as the tasks it depends on are finished. Independent
+    tasks (eg. different months, the daily and weekly stages) run concurrently in n_jobs
+    processes. The dependents of a failed task are skipped.
+
+    Args:
+        tasks: Dictionary of name: {"func": function, "kwargs": dictionary (or function
+               returning it, called when the task is submitted), "deps": list of names,
+               "inline": run in the main process (optional)}
+        n_jobs: Number of processes (default: 1, runs the tasks in order in this process)
+        on_done: Function called in the main process with the name and result of each
+                 finished task (default: None)
+
+    Returns:
+        dictionary of name: status ("ok", "failed" or "skipped")
+    """
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from .instrument import logger
+
+    status = {}
+
+    def ready():
+        out = []
+        for name, task in tasks.items():
+            if name in status or name in running.values():
+                continue
+            deps = [status.get(d) for d in task["deps"] if d in tasks]
+            if any(d in ["failed", "skipped"] for d in deps):
+                status[name] = "skipped"
+                logger.warning(f"Pipeline task {name} skipped, a task it depends on failed")
+            elif all(d == "ok" for d in deps):
+                out.append(name)
+        return out
+
+    def finish(name, func_result):
+        try:
+            result = func_result()
+            if on_done is not None:
+                on_done(name, result)
+            status[name] = "ok"
+        except Exception as e:
+            status[name] = "failed"
+            logger.error(f"Pipeline task {name} failed because of: {e}")
+
+    def kwargs(name):
+        kw = tasks[name]["kwargs"]
+        return kw() if callable(kw) else kw
+
+    running = {}
+    if n_jobs <= 1:
+        while len(status) < len(tasks):
+            for name in ready():
+                finish(name, lambda: runTask(name, tasks[name]["func"], kwargs(name)))
+        return status
+
+    with ProcessPoolExecutor(n_jobs) as executor:
+        while len(status) < len(tasks):
+            for name in ready():
+                if tasks[name].get("inline", False):
+                    finish(name, lambda: runTask(name, tasks[name]["func"], kwargs(name)))
+                else:
+                    running[executor.submit(runTask, name, tasks[name]["func"], kwargs(name))] = name
+            if len(running) == 0:
+                continue
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(running.pop(future), future.result)
+
+    return status
+
+
+# ------------------------------------------------------------------------------- #
+def runPipeline(path_raw, path_work, nuts_shp, name_prefix="ERA_land", eurostat_dataset=None,
+                n_jobs=1, crop=True, encoding=None, download=None, refresh_eurostat=False,
+                force=False, dry_run=False, levels=None):
+    """
+    Runs the pipeline from the monthly hourly CDS datasets to the weekly NUTS level climate
+    dataset (and its merge with a Eurostat dataset), rebuilding only the outputs whose inputs
+    or parameters changed:
+        - hurs_wb/<year>-<month>: adds hurs and wb to each month (add_hurs_wb)
+        - daily/<year>-<month>: daily dataset of each month (hourly_to_daily)
+        - weekly: weekly statistics starting on Mondays, from the daily datasets (see
+          weeklyStats), only the weeks which contain new or changed months are recalculated
+        - nuts: NUTS area averaged climate data (getNutsClimAll) of the updated weeks
+        - eurostat: combined Eurostat and climate dataset (mergeEurostatClim)
+    The months, and the daily and weekly stages run concurrently if n_jobs > 1.
+
+    Args:
+        path_raw: Path to the hourly monthly datasets (see downloadCDS)
+        path_work: Directory for the outputs and the manifest
+        nuts_shp: NUTS administrative level shapefile
+        name_prefix: Prefix identifier for the filenames (default: "ERA_land")
+        eurostat_dataset: Eurostat dataset identifier to combine with (default: None)
+        n_jobs: Number of processes (default: 1)
+        crop: Crop the datasets to the NUTS regions (default: True)
+        encoding: Encoding policy for the outputs (see storage.ENCODING) (default: None)
+        download: Keyword arguments for completeDataset to update path_raw first (default: None)
+        refresh_eurostat: Download the Eurostat dataset again (default: False)
+        force: Rebuild all the outputs (default: False)
+        dry_run: Only return the outputs that would be rebuilt (default: False)
+        levels: NUTS levels of the NUTS level dataset, aggregated from the NUTS3 regions of
+                nuts_shp (see rollupNuts) (default: None, the regions of nuts_shp)
+
+    Returns:
+        dictionary of task: reason to rebuild (dry_run) or task: status
+    """
+
+    import os
+    from glob import glob, escape
+    from pandas import DataFrame
+    from .climate_temporal import listFiles, add_hurs_wb_file, hourly_to_daily_file
+    from .geometries import nutsArea
+    from .streaming import readProcessed
+    from .instrument import logger
+
+    if download is not None and not dry_run:
+        from .downloadCDS import completeDataset
+        completeDataset(path_raw, name_prefix=name_prefix, **download)
+
+    for d in ["", "hourly_wb", "daily"]:
+        os.makedirs(os.path.join(path_work, d), exist_ok=True)
+    manifest = readManifest(path_work)
+
+    # Hourly monthly datasets, and the processed months whose raw dataset was deleted (see
+    # streamCDS)
+    files_dir = glob(os.path.join(escape(path_raw), f"{name_prefix}*.nc"))
+    processed = readProcessed(path_raw, name_prefix)
+    if len(files_dir) == 0 and len(processed) == 0:
+        logger.error(f"No {name_prefix} datasets found in {path_raw}")
+        return {}
+    files = listFiles(path_raw, name_prefix) if len(files_dir) > 0 else \
+        DataFrame(columns=["year", "month", "temp_res", "filename"])
+    files = files[files.temp_res == "hourly"].reset_index(drop=True)
+
+    params = {"hurs_wb": paramsHash({"area": nutsArea(nuts_shp) if crop else None,
+                                     "encoding": encoding}),
+              "daily": paramsHash({"encoding": encoding}),
+              "weekly": paramsHash({"encoding": encoding, "input": "daily"}),
+              "nuts": paramsHash({"nuts": nutsKey(nuts_shp), "crop": crop, "levels": levels}),
+              "eurostat": paramsHash({"dataset": eurostat_dataset})}
+
+    def reason(output, inputs, key):
+        return "forced" if force else staleReason(manifest, output, inputs, params[key])
+
+    tasks, reasons, outputs = {}, {}, {}
+
+    def add(name, why, func, kwargs, deps, output, inputs, inline=False):
+        tasks[name] = {"func": func, "kwargs": kwargs, "deps": deps, "inline": inline}
+        reasons[name] = why
+        outputs[name] = (output, inputs, name.split("/")[0])
+
+    # Per month tasks
+    daily_files = {}
+    for year, month, f in zip(files.year.values, files.month.values, files.filename.values):
+        ym = f"{year}-{month:02d}"
+        raw, wb = os.path.join(path_raw, f), os.path.join(path_work, "hourly_wb", f)
+        daily = os.path.join(path_work, "daily", f)
+        daily_files[(int(year), int(month))] = daily
+
+        why = reason(wb, [raw], "hurs_wb")
+        if why is not None:
+            add(f"hurs_wb/{ym}", why, add_hurs_wb_file,
+                {"path_in": raw, "path_out": wb, "encoding": encoding,
+                 "area": nutsArea(nuts_shp) if crop else None}, [], wb, [raw])
+        why = f"hurs_wb/{ym} rebuilt" if f"hurs_wb/{ym}" in tasks else reason(daily, [wb], "daily")
+        if why is not None:
+            add(f"daily/{ym}", why, hourly_to_daily_file,
+                {"path_in": wb, "path_out": daily, "encoding": encoding},
+                [f"hurs_wb/{ym}"], daily, [wb])
+
+    # The daily datasets of the deleted raw months can't be rebuilt, the existing ones are used
+    for f, entry in processed.items():
+        ym = (entry["year"], entry["month"])
+        daily = os.path.join(path_work, "daily", f)
+        if ym in daily_files:
+            continue
+        if os.path.isfile(daily):
+            daily_files[ym] = daily
+        else:
+            logger.warning(f"Year: {ym[0]} -- Month: {ym[1]}: the raw dataset was deleted "
+                           f"before the pipeline processed it, download it again to include it")
+
+    # Weekly dataset from the daily datasets, only the weeks of the new or changed months
+    # are recalculated
+    path_weekly = os.path.join(path_work, f"{name_prefix}_weekly.nc")
+    entry = manifest["outputs"].get(path_weekly)
+    if force or entry is None or entry["params"] != params["weekly"] or \
+            not os.path.isfile(path_weekly) or \
+            len(set(entry["inputs"].keys()) - set(daily_files.values())) > 0:
+        changed, why = None, "forced" if force else "full rebuild"
+    else:
+        changed = [ym for ym, daily in daily_files.items()
+                   if f"daily/{ym[0]}-{ym[1]:02d}" in tasks or
+                   entry["inputs"].get(daily) != signature(daily)]
+        why = f"months changed: {changed}" if len(changed) > 0 else None
+    if why is not None and len(daily_files) > 0:
+        df_daily = DataFrame([(y, m, path) for (y, m), path in sorted(daily_files.items())],
+                             columns=["year", "month", "path"])
+        add("weekly", why, weeklyUpdate,
+            {"files": df_daily, "path_weekly": path_weekly, "months": changed,
+             "encoding": encoding, "daily": True},
+            [x for x in tasks if x.startswith("daily/")], path_weekly,
+            list(daily_files.values()))
+
+    # NUTS level climate data, of the weeks updated (now or in a failed run)
+    path_nuts = os.path.join(path_work, f"{name_prefix}_nuts.pkl")
+    why = reason(path_nuts, [path_weekly], "nuts")
+    # Changed outside the pipeline, the updated weeks are not known
+    full_nuts = why not in [None, "inputs changed"] or \
+        (why == "inputs changed" and "weekly" not in tasks and len(manifest["pending_weeks"]) == 0)
+    if why is None and len(manifest["pending_weeks"]) > 0:
+        why = "pending weeks"
+    if "weekly" in tasks or why is not None:
+        def nuts_kwargs():
+            return {"path_weekly": path_weekly, "path_nuts": path_nuts, "nuts_shp": nuts_shp,
+                    "weeks": None if full_nuts or manifest["pending_weeks"] == "all"
+                    else manifest["pending_weeks"], "n_jobs": n_jobs, "crop": crop,
+                    "levels": levels}
+        add("nuts", why or "weekly rebuilt", nutsUpdate, nuts_kwargs, ["weekly"],
+            path_nuts, [path_weekly], inline=True)
+
+    # Eurostat dataset combined with the climate data
+    if eurostat_dataset is not None:
+        path_cache = os.path.join(path_work, f"eurostat_{eurostat_dataset}.tsv.gz")
+        path_eurostat = os.path.join(path_work, f"{name_prefix}_{eurostat_dataset}.pkl")
+        why = "nuts rebuilt" if "nuts" in tasks else \
+            "refresh" if refresh_eurostat else \
+            reason(path_eurostat, [path_nuts, path_cache], "eurostat")
+        if why is not None:
+            add("eurostat", why, eurostatUpdate,
+                {"dataset": eurostat_dataset, "path_nuts": path_nuts, "path_cache": path_cache,
+                 "path_out": path_eurostat, "refresh": refresh_eurostat},
+                ["nuts"], path_eurostat, [path_nuts, path_cache])
+
+    for name, why in reasons.items():
+        logger.info(f"Pipeline task {name}: {why}")
+    if dry_run:
+        return reasons
+
+    # Record the inputs and parameters of each output when its task finishes
+    def on_done(name, result):
+        output, inputs, key = outputs[name]
+        if name == "weekly":
+            if manifest["pending_weeks"] != "all":
+                manifest["pending_weeks"] = "all" if changed is None else \
+                    sorted(set(manifest["pending_weeks"]) | set(result))
+        elif name == "nuts":
+            manifest["pending_weeks"] = []
+        manifest["outputs"][output] = {"inputs": {x: signature(x) for x in inputs},
+                                       "params": params[key]}
+        writeManifest(path_work, manifest)
+
+    return runTasks(tasks, n_jobs=n_jobs, on_done=on_done)
+
+
+# ------------------------------------------------------------------------------- #
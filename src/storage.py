@@ -0,0 +1,603 @@
+# ------------------------------------------------------------------------------- #
+# Chunking layouts for the zarr stores (number of time steps per chunk and the
+# number of grid cells per chunk along each of the latitude/longitude dimensions)
+#   balanced:   ~3MB float32 chunks, good for both region time-series and maps
+#   timeseries: long time chunks over small tiles (point/region extractions)
+#   map:        one day of hourly steps over the full grid (map/snapshot reads)
+ZARR_LAYOUTS = {"balanced": {"time": 720, "space": 32},
+                "timeseries": {"time": 8760, "space": 8},
+                "map": {"time": 24, "space": None}}
+
+
+# Default encoding policy shared by all the writers (netcdf, zarr and CDO)
+#   dtype:     float32 or int16 (packed with a scale_factor/add_offset, as the CDS files)
+#   complevel: compression level (0 - 9, 0 means no compression)
+#   shuffle:   byte shuffle filter before the compression
+#   chunks:    chunking layout (see ZARR_LAYOUTS) or a dictionary of chunk sizes
+#   variables: per variable overrides of the above, eg. {"tp": {"dtype": "float32"}}
+#   range:     [min, max] int16 packing range (only per variable), see PACK_RANGES
+ENCODING = {"dtype": "float32",
+            "complevel": 5,
+            "shuffle": True,
+            "chunks": "balanced",
+            "variables": {}}
+
+
+# Fixed int16 packing ranges (physical limits) of the variables, for the zarr stores: the
+# months appended to a store reuse the packing of the first one, so it can't be derived
+# from the data (netcdf files are packed with the range of their own data). The ranges of
+# the summed variables depend on the temporal resolution (see temporalResolution).
+PACK_RANGES = {"t2m": [150, 350], "d2m": [150, 350], "skt": [150, 350],
+               "t2m_min": [150, 350], "t2m_max": [150, 350],
+               "tp": {"hourly": [0, 0.5], "daily": [0, 2], "weekly": [0, 5]},
+               "e": [-0.05, 0.05], "fal": [0, 1], "src": [0, 0.01],
+               "sshf": [-5e7, 5e7], "hurs": [0, 110], "wb": [-80, 60], "vp": [0, 100],
+               "at": [-80, 80], "humidex": [-80, 80], "wbgt": [-80, 80]}
+
+
+# ------------------------------------------------------------------------------- #
+def encodingPolicy(encoding=None, var=None):
+    """
+    Returns the encoding policy, ie. the default ENCODING updated with the user defined
+    settings and (if var is set) with the overrides for that variable
+
+    Args:
+        encoding: User defined encoding policy (dictionary, see ENCODING) (default: None)
+        var: Variable name to apply the per variable overrides for (default: None)
+
+    Returns:
+        policy: encoding policy dictionary
+    """
+
+    policy = dict(ENCODING)
+    if encoding is not None:
+        policy.update(encoding)
+
+    if var is not None:
+        policy.update(policy["variables"].get(var, {}))
+
+    if policy["dtype"] not in ["float32", "float64", "int16"]:
+        raise ValueError("dtype must be one of float32, float64 or int16")
+
+    return policy
+
+
+# ------------------------------------------------------------------------------- #
+def packInt16(da, vrange=None):
+    """
+    Returns the scale_factor, add_offset and _FillValue to pack a variable as int16
+    (same as the packing of the CDS netcdf files)
+
+    Args:
+        da: xarray DataArray
+        vrange: Fixed [min, max] range to pack (default: None, the range of the data)
+
+    Returns:
+        dictionary with the scale_factor, add_offset and _FillValue
+    """
+
+    if vrange is None and da.chunks is not None:
+        # Lazy data, the minimum and maximum are computed in one pass
+        from dask import compute
+        vrange = compute(da.min(), da.max())
+    elif vrange is None:
+        vrange = (da.min(), da.max())
+    vmin, vmax = float(vrange[0]), float(vrange[1])
+    # Leave -32767 for the missing values
+    scale_factor = (vmax - vmin) / (2**16 - 3) if vmax > vmin else 1.0
+    add_offset = (vmax + vmin) / 2
+
+    return {"scale_factor": scale_factor, "add_offset": add_offset, "_FillValue": -32767}
+
+
+# ------------------------------------------------------------------------------- #
+def netcdfEncoding(ds, encoding=None):
+    """
+    Creates the netcdf encoding of the data variables of a dataset from the encoding policy
+
+    Args:
+        ds: xarray dataset
+        encoding: User defined encoding policy (see ENCODING) (default: None)
+
+    Returns:
+        dictionary to pass to xarray's to_netcdf
+    """
+
+    # Ranges of the int16 variables of a lazy dataset, computed in one pass over it
+    packed = [var for var in ds.data_vars if encodingPolicy(encoding, var=var)["dtype"] == "int16"]
+    ranges = {}
+    if any(ds[var].chunks is not None for var in packed):
+        from dask import compute
+        ranges = dict(zip(packed, compute(*[(ds[var].min(), ds[var].max()) for var in packed])))
+
+    enc = {}
+    for var in ds.data_vars:
+        policy = encodingPolicy(encoding, var=var)
+        chunks = zarrChunks(ds, layout=policy["chunks"])
+        enc[var] = {"dtype": policy["dtype"],
+                    "zlib": policy["complevel"] > 0,
+                    "complevel": policy["complevel"],
+                    "shuffle": policy["shuffle"],
+                    "chunksizes": tuple(chunks[d] for d in ds[var].dims)}
+        if policy["dtype"] == "int16":
+            enc[var].update(packInt16(ds[var], vrange=ranges.get(var)))
+        if policy["complevel"] == 0:
+            del enc[var]["complevel"]
+
+    return enc
+
+
+# ------------------------------------------------------------------------------- #
+def cdoOptions(encoding=None):
+    """
+    Returns the CDO command line options for the encoding policy. CDO does not pack
+    variables with a scale_factor, so int16 policies are written as float32.
+
+    Args:
+        encoding: User defined encoding policy (see ENCODING) (default: None)
+
+    Returns:
+        string of CDO options (eg. "-b F32 -f nc4 -z zip_5 --shuffle")
+    """
+
+    policy = encodingPolicy(encoding)
+
+    options = f"-b {'F64' if policy['dtype'] == 'float64' else 'F32'} -f nc4"
+    if policy["complevel"] > 0:
+        options = f"{options} -z zip_{policy['complevel']}"
+        if policy["shuffle"]:
+            options = f"{options} --shuffle"
+
+    return options
+
+
+# ------------------------------------------------------------------------------- #
+def isZarr(path):
+    """
+    Checks if a path points to a zarr store (directory ending with .zarr or containing
+    the zarr metadata files)
+
+    Args:
+        path: Path to a dataset
+
+    Returns:
+        True if the path is a zarr store, False otherwise
+    """
+
+    import os
+
+    if not isinstance(path, str):
+        return False
+    path = path.rstrip('/')
+
+    return path.endswith('.zarr') or \
+        os.path.isfile(os.path.join(path, '.zmetadata')) or \
+        os.path.isfile(os.path.join(path, '.zgroup'))
+
+
+# ------------------------------------------------------------------------------- #
+def zarrChunks(ds, layout="balanced"):
+    """
+    Returns the zarr chunk sizes for the dimensions of a climate dataset
+
+    Args:
+        ds: xarray dataset
+        layout: Chunking layout, one of the ZARR_LAYOUTS keys (default: balanced)
+                or a dictionary of {dimension: chunk size}
+
+    Returns:
+        chunks: dictionary of {dimension: chunk size}
+    """
+
+    from .geometries import latLonNames
+
+    if isinstance(layout, dict):
+        return {d: min(layout.get(d, ds.sizes[d]), ds.sizes[d]) for d in ds.dims}
+
+    if layout not in ZARR_LAYOUTS.keys():
+        raise ValueError(f"layout must be one of {list(ZARR_LAYOUTS.keys())}")
+
+    lat_name, lon_name = latLonNames(ds)
+    time_chunk = ZARR_LAYOUTS[layout]["time"]
+    space_chunk = ZARR_LAYOUTS[layout]["space"]
+
+    chunks = {}
+    for d in ds.dims:
+        if d == "time":
+            chunks[d] = min(time_chunk, ds.sizes[d])
+        elif d in [lat_name, lon_name] and space_chunk is not None:
+            chunks[d] = min(space_chunk, ds.sizes[d])
+        else:
+            chunks[d] = ds.sizes[d]
+
+    return chunks
+
+
+# ------------------------------------------------------------------------------- #
+def memoryChunks(ds, memory_budget="2GB", n_workers=None, overhead=4):
+    """
+    Returns the dask chunks which keep the processing of a dataset (eg. in hourly_to_daily
+    or add_hurs_wb) within a memory budget: spatial tiles over whole days of hourly time
+    steps (multiples of 24, so the daily means don't cross the chunks), with as many days
+    as fit in the budget over tiles of at least 32x32 grid cells.
+
+    Args:
+        ds: xarray dataset (opened lazily)
+        memory_budget: Memory budget, in bytes or as a string (eg. "2GB") (default: "2GB")
+        n_workers: Number of chunks processed at the same time by dask (default: None,
+                   the number of CPUs)
+        overhead: Number of copies of the variables in memory per chunk (inputs, derived
+                  variables and outputs) (default: 4)
+
+    Returns:
+        chunks: dictionary of {dimension: chunk size}
+    """
+
+    import os
+    from math import floor, sqrt
+    from dask.utils import parse_bytes
+    from .geometries import latLonNames
+
+    budget = parse_bytes(memory_budget) if isinstance(memory_budget, str) else int(memory_budget)
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    lat_name, lon_name = latLonNames(ds)
+
+    # Grid cells x time steps per chunk (float64 once decoded)
+    cells = budget / n_workers / (overhead * 8 * max(len(ds.data_vars), 1))
+    n_time = ds.sizes["time"]
+    step = min(24, n_time)
+    time = min(n_time, max(step, floor(cells / 32 ** 2 / step) * step))
+    side = max(1, floor(sqrt(cells / time)))
+
+    chunks = {d: ds.sizes[d] for d in ds.dims}
+    chunks.update({"time": time, lat_name: min(side, ds.sizes[lat_name]),
+                   lon_name: min(side, ds.sizes[lon_name])})
+
+    return chunks
+
+
+# ------------------------------------------------------------------------------- #
+def alignedChunks(n, chunk, offset=0):
+    """
+    Returns the dask chunk sizes of a dimension of length n which line up with the zarr
+    chunks of a store it is appended to, starting offset steps into the dimension
+    """
+
+    first = min(n, chunk - offset % chunk)
+    rest = n - first
+
+    return (first,) + (chunk,) * (rest // chunk) + ((rest % chunk,) if rest % chunk > 0 else ())
+
+
+# ------------------------------------------------------------------------------- #
+def zarrCompressor(policy):
+    """
+    Returns the compressor encoding (Blosc zstd) of the encoding policy for the installed
+    zarr version: the "compressor" of zarr 2 or the "compressors" codecs of zarr 3
+
+    Args:
+        policy: Encoding policy (see encodingPolicy)
+
+    Returns:
+        dictionary to add to the encoding of a variable
+    """
+
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        if policy["complevel"] == 0:
+            return {"compressors": None}
+        return {"compressors": (BloscCodec(cname="zstd", clevel=policy["complevel"],
+                                           shuffle="shuffle" if policy["shuffle"] else "noshuffle"),)}
+
+    from numcodecs import Blosc
+    if policy["complevel"] == 0:
+        return {"compressor": None}
+    return {"compressor": Blosc(cname="zstd", clevel=policy["complevel"],
+                                shuffle=Blosc.SHUFFLE if policy["shuffle"] else Blosc.NOSHUFFLE)}
+
+
+# ------------------------------------------------------------------------------- #
+def zarrEncoding(ds, layout=None, encoding=None):
+    """
+    Creates the zarr encoding (chunk shapes, dtype and compressor) for the data variables
+    of a dataset from the encoding policy
+
+    Args:
+        ds: xarray dataset
+        layout: Chunking layout (see zarrChunks), overrides the chunks of the encoding
+                policy (default: None)
+        encoding: User defined encoding policy (see ENCODING) (default: None)
+
+    Returns:
+        dictionary to pass to xarray's to_zarr
+    """
+
+    enc = {}
+    for var in ds.data_vars:
+        policy = encodingPolicy(encoding, var=var)
+        chunks = zarrChunks(ds, layout=layout if layout is not None else policy["chunks"])
+        enc[var] = {"chunks": tuple(chunks[d] for d in ds[var].dims),
+                    "dtype": policy["dtype"]}
+        enc[var].update(zarrCompressor(policy))
+        if policy["dtype"] == "int16":
+            vrange = packRange(ds, var, policy)
+            if vrange is None:
+                raise ValueError(f"{var}: int16 zarr stores need a fixed packing range, add it "
+                                 f"to PACK_RANGES or to the encoding policy, eg. "
+                                 f"{{'variables': {{'{var}': {{'range': [min, max]}}}}}}")
+            enc[var].update(packInt16(ds[var], vrange=vrange))
+
+    return enc
+
+
+# ------------------------------------------------------------------------------- #
+def temporalResolution(ds):
+    """
+    Returns the temporal resolution ("hourly", "daily" or "weekly") of a dataset, from its
+    time step
+    """
+
+    from numpy import diff, timedelta64
+
+    if "time" not in ds.dims or ds.time.size < 2:
+        return "hourly"
+    step = diff(ds.time.values).min()
+
+    return "hourly" if step < timedelta64(1, "D") else \
+        "daily" if step < timedelta64(7, "D") else "weekly"
+
+
+# ------------------------------------------------------------------------------- #
+def packRange(ds, var, policy):
+    """
+    Returns the fixed int16 packing range of a variable, from the encoding policy or
+    PACK_RANGES (for the temporal resolution of the dataset), None if there's none
+
+    Args:
+        ds: xarray dataset
+        var: Variable name
+        policy: Encoding policy of the variable (see encodingPolicy)
+    """
+
+    vrange = policy.get("range", PACK_RANGES.get(var))
+    if isinstance(vrange, dict):
+        vrange = vrange.get(temporalResolution(ds))
+
+    return vrange
+
+
+# ------------------------------------------------------------------------------- #
+def clipPacked(ds, enc):
+    """
+    Clips the int16 packed variables of a dataset to their packing range (values outside
+    it would overflow) and logs the number of values clipped
+
+    Args:
+        ds: xarray dataset
+        enc: Dictionary of variable: encoding (with the scale_factor and add_offset)
+    """
+
+    from xarray import Dataset
+    from .instrument import logger
+
+    bounds = {}
+    for var, e in enc.items():
+        if var in ds.data_vars and "scale_factor" in e:
+            half = 32766 * e["scale_factor"]
+            bounds[var] = (e["add_offset"] - half, e["add_offset"] + half)
+    if len(bounds) == 0:
+        return ds
+
+    # Counted for all the variables at once (one pass over lazy datasets)
+    outside = Dataset({var: ((ds[var] < lo) | (ds[var] > hi)).sum()
+                       for var, (lo, hi) in bounds.items()}).compute()
+    for var, (lo, hi) in bounds.items():
+        n = int(outside[var].values)
+        if n > 0:
+            logger.warning(f"{var}: {n} values outside the int16 packing range "
+                           f"[{lo:.6g}, {hi:.6g}] were clipped, set a wider range in the "
+                           f"encoding policy")
+        ds[var] = ds[var].clip(lo, hi)
+
+    return ds
+
+
+# ------------------------------------------------------------------------------- #
+def writeZarr(ds, store, layout=None, encoding=None):
+    """
+    Appends a dataset to a zarr store along the time dimension, creating the store if it
+    doesn't exist. The time steps already present in the store are skipped, so monthly
+    files can be written to the store repeatedly. Datasets chunked with dask (see
+    memoryChunks) are written chunk by chunk instead of being loaded. The int16 packed
+    variables use fixed packing ranges (see PACK_RANGES) and are clipped to them.
+
+    Args:
+        ds: xarray dataset to write
+        store: Path to the zarr store (eg. ../data/ERA_land_daily.zarr)
+        layout: Chunking layout used when the store is created (see zarrChunks), overrides 
+                the chunks of the encoding policy (default: None)
+        encoding: Encoding policy used when the store is created (see ENCODING)
+
+    Returns:
+        True if new data was written to the store, False otherwise
+    """
+
+    import os
+    from xarray import open_zarr
+    from .instrument import logger
+
+    if "time_bnds" in ds.variables:
+        ds = ds.drop_vars("time_bnds")
+
+    # The encodings inherited from the netcdf files (int16 packing, netcdf chunks)
+    # are not valid for the zarr store
+    ds = ds.copy()
+    for var in ds.variables:
+        ds[var].encoding = {}
+
+    # Dask chunks are computed and written one at a time, lined up with the zarr chunks
+    lazy = len(ds.chunks) > 0
+
+    # Create the store
+    if not os.path.exists(store):
+        enc = zarrEncoding(ds, layout=layout, encoding=encoding)
+        if lazy:
+            ds = ds.chunk(zarrChunks(ds, layout=layout if layout is not None
+                                     else encodingPolicy(encoding)["chunks"]))
+        else:
+            ds = ds.load()
+        ds = clipPacked(ds, enc)
+        ds.to_zarr(store, mode='w', encoding=enc, consolidated=True)
+        return True
+
+    # Skip the time steps that are already in the store
+    ds_store = open_zarr(store, consolidated=True)
+    times = ds_store.time.values
+    new_times = ~ds.time.isin(times).values
+    if not new_times.any():
+        return False
+    ds = ds.isel(time=new_times)
+
+    # Zarr stores can only be extended at the end of the time dimension
+    if ds.time.values.min() < times.max():
+        logger.warning(f"{store} ends on {times.max()}, the dataset starting on "
+                       f"{ds.time.values.min()} can't be appended. Rebuild the store to add it.")
+        return False
+
+    if lazy:
+        var = list(ds_store.data_vars)[0]
+        store_chunks = dict(zip(ds_store[var].dims, ds_store[var].encoding["chunks"]))
+        ds = ds.chunk({d: alignedChunks(ds.sizes[d], store_chunks[d], len(times))
+                       if d == "time" else store_chunks.get(d, ds.sizes[d]) for d in ds.dims})
+    else:
+        ds = ds.load()
+    # Appended with the packing of the store
+    ds = clipPacked(ds, {var: ds_store[var].encoding for var in ds_store.data_vars})
+    ds.to_zarr(store, mode='a', append_dim='time', consolidated=True)
+
+    return True
+
+
+# ------------------------------------------------------------------------------- #
+def openClim(path, chunks=None):
+    """
+    Opens a climate dataset, which can be a netcdf file or a zarr store. Zarr stores
+    are opened lazily, so only the chunks which are selected afterwards are read.
+
+    Args:
+        path: Path to the netcdf file or zarr store (an xarray dataset is returned as is)
+        chunks: Dask chunks to open the dataset with (default: None)
+
+    Returns:
+        ds: xarray dataset
+    """
+
+    from xarray import Dataset, open_dataset, open_zarr
+
+    if isinstance(path, Dataset):
+        return path
+
+    if isZarr(path):
+        return open_zarr(path, consolidated=True, chunks=chunks)
+
+    return open_dataset(path, chunks=chunks)
+
+
+# ------------------------------------------------------------------------------- #
+def datasetSize(path):
+    """
+    Returns the size of a netcdf file or a zarr store (directory) on disk in bytes
+
+    Args:
+        path: Path to the netcdf file or zarr store
+
+    Returns:
+        size in bytes
+    """
+
+    import os
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+
+# ------------------------------------------------------------------------------- #
+def benchmarkEncoding(ds, candidates=None, path_tmp=None, backend="netcdf"):
+    """
+    Writes a dataset with a set of candidate encoding policies and reports the size on disk,
+    the write and read times and the maximum absolute error for each of them
+
+    Args:
+        ds: xarray dataset (eg. one month of the daily dataset)
+        candidates: dictionary of {name: encoding policy} to compare (default: None, 
+                    compares float64, float32 and int16 with different compression levels)
+        path_tmp: Directory to write the test datasets in (default: None, uses a 
+                  temporary directory which is deleted afterwards)
+        backend: netcdf or zarr (default: netcdf)
+
+    Returns:
+        pandas dataframe with the size (MB), write/read times (s) and maximum error of
+        each candidate, sorted by size
+    """
+
+    import os
+    import shutil
+    from time import perf_counter
+    from tempfile import mkdtemp
+    from pandas import DataFrame, concat
+
+    if candidates is None:
+        candidates = {"float64_none": {"dtype": "float64", "complevel": 0},
+                      "float32_none": {"dtype": "float32", "complevel": 0},
+                      "float32_zip1": {"dtype": "float32", "complevel": 1},
+                      "float32_zip4": {"dtype": "float32", "complevel": 4},
+                      "float32_zip9": {"dtype": "float32", "complevel": 9},
+                      "int16_zip4": {"dtype": "int16", "complevel": 4}}
+
+    if backend not in ["netcdf", "zarr"]:
+        raise ValueError("backend must be either netcdf or zarr")
+
+    tmp_dir = mkdtemp() if path_tmp is None else path_tmp
+    if not os.path.isdir(tmp_dir):
+        os.mkdir(tmp_dir)
+
+    ds = ds.load()
+    for var in ds.variables:
+        ds[var].encoding = {}
+
+    df = DataFrame()
+    for name, policy in candidates.items():
+        path = os.path.join(tmp_dir, f"bench_{name}.{'nc' if backend == 'netcdf' else 'zarr'}")
+        # Write
+        t0 = perf_counter()
+        if backend == "netcdf":
+            ds.to_netcdf(path, encoding=netcdfEncoding(ds, encoding=policy))
+        else:
+            ds.to_zarr(path, mode='w', encoding=zarrEncoding(ds, encoding=policy))
+        t_write = perf_counter() - t0
+        # Read
+        t0 = perf_counter()
+        ds_read = openClim(path).load()
+        t_read = perf_counter() - t0
+        # Maximum absolute error wrt to the original dataset
+        max_error = max(float(abs(ds_read[var] - ds[var]).max().values) for var in ds.data_vars)
+        df = concat([df, DataFrame({"encoding": [name],
+                                    "size_mb": [datasetSize(path) / 1e6],
+                                    "write_s": [t_write],
+                                    "read_s": [t_read],
+                                    "max_error": [max_error]})])
+        ds_read.close()
+        del ds_read
+
+    if path_tmp is None:
+        shutil.rmtree(tmp_dir)
+
+    return df.sort_values(by='size_mb').reset_index(drop=True)
+
+
+# ------------------------------------------------------------------------------- #
@@ -0,0 +1,250 @@
+# ------------------------------------------------------------------------------- #
+# Streaming mode: each month is processed (derived variables, daily reduction, raw file
+# retention) as soon as its download completes, so the processing overlaps the CDS
+# waiting time and only a few raw hourly months are on disk at a time
+# ------------------------------------------------------------------------------- #
+
+# What to do with the raw hourly dataset of a month once it's processed
+RETENTION = ["keep", "delete", "compact"]
+
+
+# ------------------------------------------------------------------------------- #
+def processedPath(path_save, name_prefix="ERA_land"):
+    """
+    Returns the path of the catalog of the processed months whose raw dataset was deleted
+    """
+
+    import os
+
+    return os.path.join(path_save, f".processed_{name_prefix}.json")
+
+
+# ------------------------------------------------------------------------------- #
+def readProcessed(path_save, name_prefix="ERA_land"):
+    """
+    Reads the catalog of the processed months whose raw dataset was deleted (see streamCDS),
+    so planUpdate and runPipeline don't take them as missing
+
+    Args:
+        path_save: Path to the directory of the raw hourly datasets
+        name_prefix: Dataset identifier (default: "ERA_land")
+
+    Returns:
+        dictionary of filename: {"year", "month", "runs" (see coverage.fileCoverage),
+        "daily" (path of the daily dataset), "processed"}
+    """
+
+    import os
+    import json
+
+    path = processedPath(path_save, name_prefix)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# ------------------------------------------------------------------------------- #
+def markProcessed(path_save, name_prefix, year, month, runs, path_daily):
+    """
+    Adds a processed month whose raw dataset was deleted to the catalog (see readProcessed)
+    """
+
+    import os
+    import json
+    from datetime import datetime
+
+    processed = readProcessed(path_save, name_prefix)
+    processed[f"{name_prefix}_yr_{year}_mnth_{month}.nc"] = {
+        "year": int(year), "month": int(month), "runs": runs, "daily": path_daily,
+        "processed": datetime.now().isoformat(timespec="seconds")}
+
+    path = processedPath(path_save, name_prefix)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(processed, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+# ------------------------------------------------------------------------------- #
+def retainRaw(path, retention="keep"):
+    """
+    Applies the retention policy to a processed raw hourly dataset
+
+    Args:
+        path: Path to the raw hourly dataset
+        retention: "keep" it, "delete" it or "compact" it (rewritten packed as int16 and
+                   compressed) (default: "keep")
+    """
+
+    import os
+    from xarray import open_dataset
+    from .storage import netcdfEncoding
+    from .instrument import stage, fileSize
+
+    if retention == "delete":
+        os.remove(path)
+    elif retention == "compact":
+        with stage("retainRaw.compact", file=os.path.basename(path)) as record:
+            record["bytes_read"] = fileSize(path)
+            with open_dataset(path) as ds:
+                ds = ds.load()
+            ds.to_netcdf(f"{path}.tmp", encoding=netcdfEncoding(ds, {"dtype": "int16"}))
+            os.replace(f"{path}.tmp", path)
+            record["bytes_written"] = fileSize(path)
+
+
+# ------------------------------------------------------------------------------- #
+def processMonth(path_raw, path_daily, path_hourly=None, retention="keep", area=None,
+                 encoding=None):
+    """
+    Processes a downloaded month: adds the derived variables (if path_hourly is set),
+    calculates the daily dataset and applies the retention policy to the raw dataset
+
+    Args:
+        path_raw: Path to the raw hourly dataset
+        path_daily: Path to save the daily dataset to
+        path_hourly: Path to save the hourly dataset with hurs and wb to (default: None)
+        retention: Retention policy of the raw dataset (see retainRaw) (default: "keep")
+        area: Bounding box [north, west, south, east] to crop to (default: None)
+        encoding: Encoding policy for the outputs (see storage.ENCODING) (default: None)
+
+    Returns:
+        coverage runs of the raw dataset if it's deleted (see coverage.fileCoverage), else None
+    """
+
+    from .climate_temporal import add_hurs_wb_file, hourly_to_daily_file
+    from .coverage import fileCoverage
+
+    if path_hourly is not None:
+        add_hurs_wb_file(path_raw, path_hourly, area=area, encoding=encoding)
+        hourly_to_daily_file(path_hourly, path_daily, encoding=encoding)
+    else:
+        hourly_to_daily_file(path_raw, path_daily, area=area, encoding=encoding)
+
+    # The time axis of a deleted dataset is kept in the catalog of the processed months
+    runs = fileCoverage(path_raw) if retention == "delete" else None
+    retainRaw(path_raw, retention)
+
+    return runs
+
+
+# ------------------------------------------------------------------------------- #
+def streamCDS(months, path_save, path_daily,
+              path_hourly = None,
+              retention = "keep",
+              max_pending = 3,
+              n_download = 2,
+              n_process = 2,
+              days = range(1, 32),
+              area = [43, 18, 33, 36],
+              dataset = "reanalysis-era5-land",
+              name_prefix = "ERA_land",
+              variables = ["2m_dewpoint_temperature", "2m_temperature",
+                           "forecast_albedo", "skin_reservoir_content",
+                           "surface_sensible_heat_flux", "total_evaporation",
+                           "total_precipitation"],
+              max_fields = None,
+              max_cost = None,
+              crop_area = None,
+              encoding = None):
+    """
+    Downloads the months (in n_download threads) and processes each one (in n_process
+    processes) as soon as its download completes. At most max_pending raw months are
+    downloaded or waiting to be processed at a time, so with the "delete" or "compact"
+    retention policies the disk use is bounded to a few months of hourly data. The months
+    whose raw dataset is deleted are recorded in a catalog in path_save (see readProcessed),
+    which completeDataset and runPipeline read, so they are not downloaded again.
+
+    Args:
+        months: List of (year, month) tuples
+        path_save: Path to the directory of the raw hourly datasets
+        path_daily: Path to the directory of the daily datasets
+        path_hourly: Path to the directory of the hourly datasets with hurs and wb, these are
+                     not kept if not set (default: None)
+        retention: What to do with the raw datasets once processed: "keep", "delete" or
+                   "compact" (see retainRaw) (default: "keep")
+        max_pending: Maximum number of raw months downloading or waiting to be processed
+                     (default: 3)
+        n_download: Number of concurrent downloads (default: 2)
+        n_process: Number of processes for the processing (default: 2)
+        days, area, dataset, name_prefix, variables, max_fields, max_cost: see downloadCDS
+        crop_area: Bounding box [north, west, south, east] to crop the processed datasets
+                   to (default: None)
+        encoding: Encoding policy for the outputs (see storage.ENCODING) (default: None)
+
+    Returns:
+        dictionary of (year, month): status ("ok", "download failed" or "processing failed")
+    """
+
+    import os
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, \
+        FIRST_COMPLETED
+    from .downloadCDS import downloadCDS
+    from .instrument import logger
+
+    if retention not in RETENTION:
+        raise ValueError(f"retention must be one of {RETENTION}")
+
+    for path in [path_save, path_daily, path_hourly]:
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def name(year, month):
+        return f"{name_prefix}_yr_{year}_mnth_{month}.nc"
+
+    def process(executor, year, month):
+        return executor.submit(
+            processMonth, os.path.join(path_save, name(year, month)),
+            os.path.join(path_daily, name(year, month)),
+            path_hourly=None if path_hourly is None else os.path.join(path_hourly, name(year, month)),
+            retention=retention, area=crop_area, encoding=encoding)
+
+    # The months already processed are skipped
+    todo = deque([(year, month) for year, month in months
+                  if not os.path.isfile(os.path.join(path_daily, name(year, month)))])
+    status = {}
+    downloads, processing = {}, {}
+
+    with ThreadPoolExecutor(n_download) as downloader, ProcessPoolExecutor(n_process) as processor:
+        while len(todo) > 0 or len(downloads) > 0 or len(processing) > 0:
+            # Start downloads while there's room for raw months
+            while len(todo) > 0 and len(downloads) + len(processing) < max_pending:
+                year, month = todo.popleft()
+                if os.path.isfile(os.path.join(path_save, name(year, month))):
+                    processing[process(processor, year, month)] = (year, month)
+                else:
+                    downloads[downloader.submit(
+                        downloadCDS, month=month, year=year, path_save=path_save, days=days,
+                        area=area, dataset=dataset, name_prefix=name_prefix, variables=variables,
+                        max_fields=max_fields, max_cost=max_cost)] = (year, month)
+
+            done, _ = wait(list(downloads.keys()) + list(processing.keys()),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    year, month = downloads.pop(future)
+                    # downloadCDS logs and records the failed requests
+                    if future.exception() is not None:
+                        logger.error(f"Year: {year} -- Month: {month} has failed to download "
+                                     f"because of: {future.exception()}")
+                    if not os.path.isfile(os.path.join(path_save, name(year, month))):
+                        status[(year, month)] = "download failed"
+                        continue
+                    processing[process(processor, year, month)] = (year, month)
+                else:
+                    year, month = processing.pop(future)
+                    try:
+                        runs = future.result()
+                        if retention == "delete":
+                            markProcessed(path_save, name_prefix, year, month, runs,
+                                          os.path.join(path_daily, name(year, month)))
+                        status[(year, month)] = "ok"
+                    except Exception as e:
+                        status[(year, month)] = "processing failed"
+                        logger.error(f"Year: {year} -- Month: {month} failed to be processed because of: {e}")
+
+    return status
+
+
+# ------------------------------------------------------------------------------- #
@@ -0,0 +1,49 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("cdsapi")
+pytest.importorskip("xarray")
+cds_jobs = pytest.importorskip("emme_roch.cds_jobs")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+import mock_cds  # noqa: E402
+
+
+@pytest.fixture
+def mock_server():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    counts, server = {}, []
+    thread = threading.Thread(target=mock_cds.serve, daemon=True,
+                              kwargs={"port": port, "delay": 3, "counts": counts,
+                                      "server": server})
+    thread.start()
+    while len(server) == 0:
+        time.sleep(0.01)
+    yield f"http://localhost:{port}/api/v2", counts
+    server[0].shutdown()
+
+
+def test_resume_without_resubmitting(mock_server, tmp_path):
+    url, counts = mock_server
+    path_save = str(tmp_path / "data")
+    kwargs = {"days": [1], "area": [35, 32, 34.5, 32.5], "variables": ["2m_temperature"],
+              "poll_interval": 0.2, "url": url, "key": "1:mock"}
+
+    # Times out before the request is completed
+    jobs = cds_jobs.downloadAsyncCDS([(2000, 1)], path_save, timeout=1, **kwargs)
+    assert len(jobs) == 1
+    assert counts["POST"] == 1
+    assert not os.path.isfile(os.path.join(path_save, "ERA_land_yr_2000_mnth_1.nc"))
+
+    # Resumes polling the submitted request
+    jobs = cds_jobs.downloadAsyncCDS([(2000, 1)], path_save, **kwargs)
+    assert len(jobs) == 0
+    assert counts["POST"] == 1
+    assert os.path.isfile(os.path.join(path_save, "ERA_land_yr_2000_mnth_1.nc"))
@@ -0,0 +1,37 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+panels = pytest.importorskip("emme_roch.panels")
+
+
+def weekly(start, periods, nuts_ids=("CY000", "EL301")):
+    times = pd.date_range(start, periods=periods, freq="W-MON")
+    return pd.DataFrame({"nuts_id": [x for x in nuts_ids for _ in times],
+                         "time": list(times) * len(nuts_ids),
+                         "t2m": [float(i) for i in range(periods * len(nuts_ids))]})
+
+
+def test_read_string_dates(tmp_path):
+    path = str(tmp_path / "panel")
+    panels.writePanel(weekly("2020-01-06", 10), path)
+
+    df = panels.readPanel(path, nuts_ids=["CY000"], start="2020-01-20", end="2020-02-10")
+
+    assert df.nuts_id.astype(str).unique().tolist() == ["CY000"]
+    assert df.time.min() == pd.Timestamp("2020-01-20")
+    assert df.time.max() == pd.Timestamp("2020-02-10")
+    assert df.shape[0] == 4
+
+
+def test_write_updated_weeks_keeps_year(tmp_path):
+    path = str(tmp_path / "panel")
+    panels.writePanel(weekly("2020-01-06", 10), path)
+    update = weekly("2020-03-02", 3).assign(t2m=-1.0)
+    panels.writePanel(update, path)
+
+    df = panels.readPanel(path)
+
+    assert df.shape[0] == 22
+    assert (df[df.time >= pd.Timestamp("2020-03-02")].t2m == -1.0).all()
+    assert (df[df.time < pd.Timestamp("2020-03-02")].t2m >= 0).all()
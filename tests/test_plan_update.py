@@ -0,0 +1,53 @@
+import datetime
+import os
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+xr = pytest.importorskip("xarray")
+pytest.importorskip("netCDF4")
+downloadCDS = pytest.importorskip("emme_roch.downloadCDS")
+
+
+def write_month(path_save, year, month, end=None):
+    start = pd.Timestamp(year, month, 1)
+    end = start + pd.offsets.MonthEnd(0) + pd.Timedelta(hours=23) if end is None \
+        else pd.Timestamp(end)
+    times = pd.date_range(start, end, freq="h")
+    filename = f"ERA_land_yr_{year}_mnth_{month}.nc"
+    xr.Dataset({"t2m": ("time", [280.0] * len(times))},
+               coords={"time": times}).to_netcdf(os.path.join(path_save, filename))
+    return {"year": year, "month": month, "filename": filename}
+
+
+def test_december_january_lag(tmp_path):
+    files = pd.DataFrame([write_month(str(tmp_path), 2022, 11)])
+
+    # 65 days before the 7th of March is the 1st of January
+    plan = downloadCDS.planUpdate(files, str(tmp_path), today=datetime.date(2023, 3, 7))
+
+    assert list(zip(plan.year, plan.month, plan.action)) == \
+        [(2022, 12, "download"), (2023, 1, "download")]
+    assert plan.days.values[0] == list(range(1, 32))
+    assert plan.days.values[1] == [1]
+
+
+def test_partial_last_day_is_refreshed(tmp_path):
+    files = pd.DataFrame([write_month(str(tmp_path), 2022, 11),
+                          write_month(str(tmp_path), 2022, 12, end="2022-12-20 12:00")])
+
+    plan = downloadCDS.planUpdate(files, str(tmp_path), today="2023-03-06")
+
+    assert list(zip(plan.year, plan.month, plan.action)) == [(2022, 12, "refresh")]
+    assert "downloaded up to 2022-12-19" in plan.reason.values[0]
+
+
+def test_start_with_empty_catalog(tmp_path):
+    plan = downloadCDS.planUpdate(None, str(tmp_path), start=(2022, 11),
+                                  today=datetime.datetime(2023, 3, 6))
+
+    assert list(zip(plan.year, plan.month, plan.action)) == \
+        [(2022, 11, "download"), (2022, 12, "download")]
+
+    with pytest.raises(ValueError):
+        downloadCDS.planUpdate(None, str(tmp_path), today=datetime.datetime(2023, 3, 6))